@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/4.1/ref/settings/
 """
 
 import os
+import tempfile
 from pathlib import Path
 
 import dj_database_url
@@ -123,6 +124,40 @@ ELASTICSEARCH_DSL = {
     "default": {"hosts": os.environ.get("ELASTICSEARCH_URL")},
 }
 
+# Settings for the search index. While the index is being rebuilt it has no
+# replicas and isn't refreshed, and these are set once it has been loaded.
+SEARCH_INDEX_SETTINGS = {
+    "number_of_shards": int(os.environ.get("SEARCH_INDEX_SHARDS", 1)),
+    "number_of_replicas": int(os.environ.get("SEARCH_INDEX_REPLICAS", 1)),
+    "refresh_interval": os.environ.get("SEARCH_INDEX_REFRESH_INTERVAL", "1s"),
+}
+
+# Bulk indexing (see `documents.indexing`). Documents are read from the
+# database SEARCH_INDEX_BATCH_SIZE at a time and sent to Elasticsearch in
+# requests of up to SEARCH_INDEX_CHUNK_SIZE documents (or
+# SEARCH_INDEX_MAX_CHUNK_BYTES), using SEARCH_INDEX_THREADS threads.
+SEARCH_INDEX_BATCH_SIZE = 200
+SEARCH_INDEX_CHUNK_SIZE = 50
+SEARCH_INDEX_MAX_CHUNK_BYTES = 20 * 1024 * 1024
+SEARCH_INDEX_THREADS = int(os.environ.get("SEARCH_INDEX_THREADS", 4))
+# A rebuilt index is only used if no more than this many documents failed -
+# the ones that did are added to the indexing queue to be tried again.
+SEARCH_INDEX_REBUILD_MAX_FAILURES = int(
+    os.environ.get("SEARCH_INDEX_REBUILD_MAX_FAILURES", 100)
+)
+
+# Newly fetched documents are added to a queue that is sent to Elasticsearch
+# in batches of INDEX_QUEUE_BATCH_SIZE, or after INDEX_QUEUE_FLUSH_INTERVAL
+# seconds if fewer are waiting. Each flush sends up to INDEX_QUEUE_MAX_BATCHES
+# batches, and pauses for INDEX_QUEUE_FLUSH_INTERVAL if a batch takes more
+# than INDEX_QUEUE_SLOW_BATCH seconds.
+INDEX_QUEUE_BATCH_SIZE = 200
+INDEX_QUEUE_FLUSH_INTERVAL = 60
+INDEX_QUEUE_MAX_BATCHES = 20
+INDEX_QUEUE_SLOW_BATCH = 30
+# seconds before a flush that didn't finish is assumed to have died
+INDEX_QUEUE_FLUSH_TIMEOUT = 10 * 60
+
 # Django Q
 Q_CLUSTER = {
     "name": "DjangORM",
@@ -133,8 +168,93 @@ Q_CLUSTER = {
     "orm": "default",
     "max_attempts": 1,
     "cpu_affinity": 1,
+    # allow workers to start the processes used for extracting text from PDFs
+    # (see PDF_EXTRACT_WORKERS)
+    "daemonize_workers": False,
+    # queues for the document processing stages (see DOCUMENT_PIPELINE_ENABLED),
+    # run with `Q_CLUSTER_NAME=<cluster> python manage.py qcluster` (django-q2
+    # reads its settings on import, before `qcluster --name` would apply)
+    "ALT_CLUSTERS": {
+        "extract": {"workers": 2, "timeout": 600, "retry": 620},
+        "ocr": {"workers": 1, "timeout": 1200, "retry": 1220},
+        "index": {"workers": 1, "timeout": 600, "retry": 620},
+    },
 }
 
+# Queue each stage of processing a document (extract, ocr, index) as a
+# separate task on its own cluster, rather than running them all in the
+# task that downloads the document
+DOCUMENT_PIPELINE_ENABLED = (
+    os.environ.get("DOCUMENT_PIPELINE", "false").lower().startswith("t")
+)
+DOCUMENT_PIPELINE_CLUSTERS = {
+    "extract": "extract",
+    "ocr": "ocr",
+    "index": "index",
+}
+DOCUMENT_PIPELINE_MAX_ATTEMPTS = 3
+
+# Document fetching
+# number of documents fetched at the same time by a batch task
+FETCH_CONCURRENCY = int(os.environ.get("FETCH_CONCURRENCY", 4))
+
+# requests per second (rate) and burst size (capacity) allowed for each
+# regulator's website, shared by all the workers through the cache. CCEW was
+# fetched by two workers each pausing 15 seconds after every document (a
+# couple of requests) - about 0.25 requests a second - so it's kept to that
+FETCH_RATE_LIMITS = {
+    "default": {"rate": 0.2, "capacity": 1},
+    "ccew": {"rate": 0.25, "capacity": 2},
+    "oscr": {"rate": 0.5, "capacity": 2},
+    "ccni": {"rate": 0.5, "capacity": 2},
+}
+# seconds to wait for another worker to finish updating a rate limit
+FETCH_RATE_LIMIT_LOCK_TIMEOUT = 5
+
+# connections to the regulators' websites are kept open and shared by all the
+# tasks in a worker. HTTP_POOL_MAXSIZE connections are kept for each host, and
+# requests time out after HTTP_TIMEOUT (connect, read) seconds
+HTTP_POOL_CONNECTIONS = 10
+HTTP_POOL_MAXSIZE = max(FETCH_CONCURRENCY, 10)
+HTTP_TIMEOUT = (10, 60)
+
+# failed connections and these statuses are retried, waiting a little longer
+# before each retry (backoff factor, in seconds)
+HTTP_RETRIES = 3
+HTTP_RETRY_BACKOFF = 1
+HTTP_RETRY_STATUS_CODES = (502, 503, 504)
+
+# after this many failures in a row (timeouts, 429 or 5xx responses) no more
+# requests are made to a regulator's website for the backoff period (seconds),
+# which doubles each time the website fails again, up to the maximum
+CIRCUIT_BREAKER_FAILURE_THRESHOLD = 5
+CIRCUIT_BREAKER_BACKOFF = 60
+CIRCUIT_BREAKER_MAX_BACKOFF = 60 * 60
+
+# downloaded files larger than this are written to a temporary file on disk
+# rather than being held in memory
+DOWNLOAD_SPOOL_MAX_MEMORY = 10 * 1024 * 1024
+
+# files larger than this won't be downloaded
+DOWNLOAD_MAX_SIZE = 500 * 1024 * 1024
+
+# Cache for pages fetched from the regulators' websites, only used by the
+# sessions that fetch documents. Times are in seconds for account listing
+# pages and for documents (0 means not cached).
+HTTP_CACHE_ENABLED = os.environ.get("HTTP_CACHE", "false").lower().startswith("t")
+HTTP_CACHE_PATH = os.environ.get(
+    "HTTP_CACHE_PATH", os.path.join(BASE_DIR, "http_cache.sqlite")
+)
+HTTP_CACHE_MAX_SIZE = 100 * 1024 * 1024
+HTTP_CACHE_EXPIRE_AFTER = {
+    "listing": 6 * 60 * 60,
+    "document": 0,
+}
+
+# Seconds to keep the list of accounts found for a charity, shared between
+# all the tasks fetching documents for that charity
+ACCOUNT_LISTING_CACHE_TIMEOUT = 12 * 60 * 60
+
 # Caching
 CACHES = {
     "default": {
@@ -233,16 +353,100 @@ STORAGES = {
     "default": {
         "BACKEND": "storages.backends.s3boto3.S3Boto3Storage",
     },
+    # cache of text extracted from PDFs (see EXTRACTION_CACHE_ENABLED)
+    "extraction_cache": (
+        {
+            "BACKEND": "storages.backends.s3boto3.S3Boto3Storage",
+            "OPTIONS": {"location": "extraction-cache"},
+        }
+        if os.environ.get("EXTRACTION_CACHE_STORAGE") == "s3"
+        else {
+            "BACKEND": "django.core.files.storage.FileSystemStorage",
+            "OPTIONS": {
+                "location": os.environ.get(
+                    "EXTRACTION_CACHE_PATH", os.path.join(BASE_DIR, "extraction_cache")
+                ),
+            },
+        }
+    ),
 }
 
+# Reuse the text extracted from (and OCR versions of) PDFs that have been
+# processed before, keyed by the hash of the PDF. Stored in the
+# "extraction_cache" storage, either on local disk (EXTRACTION_CACHE_PATH) or
+# in S3 if EXTRACTION_CACHE_STORAGE is "s3".
+EXTRACTION_CACHE_ENABLED = (
+    os.environ.get("EXTRACTION_CACHE", "false").lower().startswith("t")
+)
+
 
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.1/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
-# minimum number of characters to be considered a complete document
+# minimum number of characters to be considered a complete document - all
+# the pages of documents with less text than this are OCRed if they have
+# fewer than MIN_PAGE_LENGTH characters
 MIN_DOC_LENGTH = 1000
+MIN_PAGE_LENGTH = 50
+
+# in other documents, pages with fewer than MIN_PAGE_LENGTH characters are
+# only OCRed if they have an image covering OCR_MIN_IMAGE_AREA of the page,
+# and only if at least OCR_MIN_PAGE_RATIO of the pages need OCR. The PDF is
+# only replaced with the OCRed version if at least OCR_REPLACE_FILE_RATIO of
+# its pages were OCRed.
+OCR_MIN_IMAGE_AREA = 0.3
+OCR_MIN_PAGE_RATIO = 0.1
+OCR_REPLACE_FILE_RATIO = 0.5
+
+# text extracted from PDFs larger than this is written to a temporary file on
+# disk rather than being held in memory
+TEXT_SPOOL_MAX_MEMORY = 1024 * 1024
+
+# Backends used to get the text from PDFs (see documents.extractors), in the
+# order they are tried. If the text from a backend has more than this
+# proportion of unreadable characters or words without spaces, the next
+# backend is tried.
+PDF_EXTRACTORS = os.environ.get("PDF_EXTRACTORS", "pdfium,pdfplumber").split(",")
+PDF_EXTRACT_MAX_BAD_CHARACTERS = 0.01
+PDF_EXTRACT_MAX_LONG_WORDS = 0.05
+
+# Text is extracted from PDFs with at least PDF_EXTRACT_PARALLEL_MIN_PAGES pages
+# by a pool of PDF_EXTRACT_WORKERS processes, each handling
+# PDF_EXTRACT_PAGES_PER_TASK pages at a time. Set PDF_EXTRACT_WORKERS to 1 to
+# extract all the text in the worker process.
+PDF_EXTRACT_WORKERS = int(
+    os.environ.get("PDF_EXTRACT_WORKERS", min(4, os.cpu_count() or 1))
+)
+PDF_EXTRACT_PAGES_PER_TASK = 20
+PDF_EXTRACT_PARALLEL_MIN_PAGES = 40
+PDF_EXTRACT_MAX_TASKS_PER_CHILD = 100
+
+# OCR runs in a separate process (see documents.ocr). At most OCR_SLOTS jobs
+# run at once on each server, waiting up to OCR_SLOT_TIMEOUT seconds for a
+# free slot. Jobs are stopped if they take longer than OCR_TIMEOUT seconds
+# (less than the task timeout) or use more than OCR_MAX_MEMORY bytes.
+OCR_SLOTS = int(os.environ.get("OCR_SLOTS", 1))
+OCR_SLOT_TIMEOUT = 120
+# if no slot is free, OCR is tried again after OCR_RETRY_DELAY to twice that
+# many seconds (this doesn't count as a failed attempt)
+OCR_RETRY_DELAY = 5 * 60
+OCR_TIMEOUT = int(os.environ.get("OCR_TIMEOUT", 450))
+OCR_MAX_MEMORY = int(os.environ.get("OCR_MAX_MEMORY", 2 * 1024 * 1024 * 1024))
+OCR_LOCK_DIR = os.environ.get(
+    "OCR_LOCK_DIR", os.path.join(tempfile.gettempdir(), "docdisplay-ocr")
+)
+
+# Document content is stored compressed with zstd at this level. If any
+# dictionaries are given (see the train_content_dictionary command), the first
+# is used to compress new content and all of them can be used to decompress it.
+CONTENT_COMPRESSION_LEVEL = 10
+CONTENT_COMPRESSION_DICTIONARIES = [
+    path
+    for path in os.environ.get("CONTENT_COMPRESSION_DICTIONARIES", "").split(",")
+    if path
+]
 
 # Options for ocrmypdf
 OCRMYPDF_OPTIONS = dict(
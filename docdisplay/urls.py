@@ -40,6 +40,11 @@ urlpatterns = [
     path("doc/bulkupload", views.bulk.doc_upload_bulk, name="doc.doc_upload_bulk"),
     path("doc/<str:id>.pdf", views.doc.doc_get_pdf, name="doc.doc_get_pdf"),
     path("doc/<str:id>/embed", views.doc.doc_get_embed, name="doc.doc_get_embed"),
+    path(
+        "doc/<str:id>/page/<int:page>/embed",
+        views.doc.doc_get_page_embed,
+        name="doc.doc_get_page_embed",
+    ),
     path("doc/<str:id>", views.doc.doc_get, name="doc.doc_get"),
     path("charity/search", views.charity.charity_search, name="charity.charity_search"),
     path("charity/<str:regno>", views.charity.charity_get, name="charity.charity_get"),
@@ -157,10 +157,13 @@ class DocumentAdmin(admin.ModelAdmin):
         "pages",
         "content_type",
         "language",
+        "extractor",
+        "extractor_version",
         "created_at",
     )
     list_filter = (
         ("content_type", admin.AllValuesFieldListFilter),
+        ("extractor", admin.AllValuesFieldListFilter),
         "created_at",
     )
     list_display = (
@@ -0,0 +1,119 @@
+import logging
+import time
+
+import requests
+from django.conf import settings
+from django.core.cache import cache
+
+from documents.exceptions import HostUnavailable
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+# statuses that suggest the host is overloaded or broken rather than that
+# the particular request was wrong
+FAILURE_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+def is_host_failure(exception):
+    """
+    Whether an exception (or the exception that caused it) means the host is unhealthy
+    """
+    while exception is not None:
+        if isinstance(exception, HostUnavailable):
+            return True
+        if isinstance(
+            exception,
+            (requests.exceptions.Timeout, requests.exceptions.ConnectionError),
+        ):
+            return True
+        if isinstance(exception, requests.exceptions.HTTPError):
+            response = exception.response
+            return response is not None and (
+                response.status_code in FAILURE_STATUS_CODES
+            )
+        exception = exception.__cause__
+    return False
+
+
+class CircuitBreaker:
+    """
+    Health of a regulator's website, shared between workers through the cache.
+
+    After `settings.CIRCUIT_BREAKER_FAILURE_THRESHOLD` failures in a row the
+    circuit opens and requests to the host are refused until the backoff
+    period has passed. The backoff doubles each time the circuit opens, up
+    to `settings.CIRCUIT_BREAKER_MAX_BACKOFF` seconds. After the backoff one
+    trial request is allowed (half-open): if it succeeds the circuit closes,
+    otherwise it opens again.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.cache_key = "circuit-breaker:{}".format(name)
+        self.trial_cache_key = "circuit-breaker-trial:{}".format(name)
+
+    def get_state(self):
+        return cache.get(
+            self.cache_key,
+            {"state": CLOSED, "failures": 0, "opened": 0, "retry_at": None},
+        )
+
+    def set_state(self, state):
+        cache.set(self.cache_key, state, None)
+
+    def before_request(self):
+        """
+        Raise `HostUnavailable` if requests to the host shouldn't be made yet
+        """
+        state = self.get_state()
+        if state["state"] == CLOSED:
+            return
+        if state["retry_at"] > time.time():
+            raise HostUnavailable(self.name, state["retry_at"])
+
+        # only one worker gets to make the trial request
+        if not cache.add(self.trial_cache_key, True, settings.CIRCUIT_BREAKER_BACKOFF):
+            raise HostUnavailable(
+                self.name, time.time() + settings.CIRCUIT_BREAKER_BACKOFF
+            )
+        state["state"] = HALF_OPEN
+        self.set_state(state)
+        logging.info("Circuit for {} half-open - trying a request".format(self.name))
+
+    def record_success(self):
+        state = self.get_state()
+        if state["state"] == CLOSED and not state["failures"]:
+            return
+        if state["state"] != CLOSED:
+            logging.info("Circuit for {} closed".format(self.name))
+        cache.delete(self.trial_cache_key)
+        self.set_state({"state": CLOSED, "failures": 0, "opened": 0, "retry_at": None})
+
+    def record_failure(self):
+        state = self.get_state()
+        state["failures"] += 1
+        # requests that were already in flight when the circuit opened
+        # don't extend the backoff
+        if state["state"] == OPEN:
+            self.set_state(state)
+            return
+        if (
+            state["state"] == HALF_OPEN
+            or state["failures"] >= settings.CIRCUIT_BREAKER_FAILURE_THRESHOLD
+        ):
+            backoff = min(
+                settings.CIRCUIT_BREAKER_BACKOFF * 2 ** state["opened"],
+                settings.CIRCUIT_BREAKER_MAX_BACKOFF,
+            )
+            state["state"] = OPEN
+            state["opened"] += 1
+            state["retry_at"] = time.time() + backoff
+            cache.delete(self.trial_cache_key)
+            logging.warning(
+                "Circuit for {} open - no requests for {:,.0f} seconds".format(
+                    self.name, backoff
+                )
+            )
+        self.set_state(state)
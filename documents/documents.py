@@ -1,6 +1,7 @@
 import datetime
 from math import ceil
 
+from django.conf import settings
 from django.core.paginator import EmptyPage, Page, PageNotAnInteger, Paginator
 from django.utils.translation import gettext_lazy as _
 from django_elasticsearch_dsl import Document, fields
@@ -8,12 +9,23 @@ from django_elasticsearch_dsl.registries import registry
 
 from documents.models import Document as DocumentModel
 
+# Version of the index mapping. Change this when the mapping changes, and then
+# rebuild the index with `python manage.py index_documents --rebuild`.
+MAPPING_VERSION = 2
+
 
 @registry.register_document
 class DocumentDocument(Document):
     attachment = fields.ObjectField(
         properties={
-            "content": fields.TextField(),
+            # positions and offsets are stored so that highlighting doesn't
+            # need to analyse the text again, and word pairs and prefixes
+            # are indexed to speed up phrase and prefix queries
+            "content": fields.TextField(
+                index_options="offsets",
+                index_phrases=True,
+                index_prefixes={"min_chars": 2, "max_chars": 5},
+            ),
             "content_length": fields.IntegerField(),
             "pages": fields.IntegerField(),
             "content_type": fields.KeywordField(),
@@ -21,7 +33,7 @@ class DocumentDocument(Document):
             "date": fields.DateField(),
         }
     )
-    charity_name = fields.TextField()
+    charity_name = fields.TextField(fields={"keyword": fields.KeywordField()})
     charity_org_id = fields.KeywordField()
     income = fields.IntegerField()
     expenditure = fields.IntegerField()
@@ -54,21 +66,20 @@ class DocumentDocument(Document):
         }
 
     def prepare_tags(self, instance):
+        # uses the tags prefetched by `documents.indexing` if they're there
         return list(
-            set(
-                list(instance.tags.values_list("name", flat=True))
-                + list(
-                    instance.financial_year.charity.tags.values_list("name", flat=True)
-                )
-            )
+            {tag.name for tag in instance.tags.all()}
+            | {tag.name for tag in instance.financial_year.charity.tags.all()}
         )
 
     def get_queryset(self):
         """
         Return the queryset that should be indexed by this doc type.
         """
-        return self.django.model._default_manager.filter(content__isnull=False).filter(
-            file__isnull=False
+        return (
+            self.django.model._default_manager.with_content()
+            .filter(content__isnull=False)
+            .filter(file__isnull=False)
         )
 
     def should_index_object(self, obj):
@@ -77,10 +88,10 @@ class DocumentDocument(Document):
         return True
 
     class Index:
+        # an alias for the current version of the index when it's been built
+        # with `index_documents --rebuild`
         name = "documents"
-        # See Elasticsearch Indices API reference for available settings
-        # settings = {'number_of_shards': 1,
-        #             'number_of_replicas': 0}
+        settings = settings.SEARCH_INDEX_SETTINGS
 
     class Django:
         model = DocumentModel  # The model associated with this Document
@@ -0,0 +1,73 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from django.conf import settings
+from django.db import connections
+
+from documents.fetch import fetch_documents_for_charity
+from documents.http import get_session
+
+
+class FetchEngine:
+    """
+    Fetch documents for a number of charities at the same time.
+
+    Each job is run by `fetch_documents_for_charity` in a pool of threads.
+    Requests to each regulator are spaced out by the rate limiters in
+    `documents.ratelimit` rather than by pausing after every download, so
+    several downloads can be in flight while staying within the limits. The
+    threads share the worker's session, and its pool of connections.
+    """
+
+    def __init__(self, max_workers=None, tags=None, fail_if_exists=True):
+        self.max_workers = max_workers or settings.FETCH_CONCURRENCY
+        self.tags = tags
+        self.fail_if_exists = fail_if_exists
+
+    def _fetch(self, org_id, financial_year_end):
+        try:
+            return fetch_documents_for_charity(
+                org_id,
+                financial_year_end,
+                session=get_session(),
+                tags=self.tags,
+                pause=None,
+                fail_if_exists=self.fail_if_exists,
+            )
+        finally:
+            # each thread gets its own database connection
+            connections.close_all()
+
+    def run(self, jobs):
+        """
+        Fetch documents for a list of `(org_id, financial_year_end)` jobs.
+
+        Yields `(job, documents, error)` for each job as it completes.
+        """
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {executor.submit(self._fetch, *job): job for job in jobs}
+            for future in as_completed(futures):
+                job = futures[future]
+                try:
+                    yield job, future.result(), None
+                except Exception as e:
+                    logging.error(
+                        "Could not fetch documents for {} {}: {}".format(*job, e)
+                    )
+                    yield job, [], e
+
+
+def fetch_documents_batch(jobs, max_workers=None, tags=None, fail_if_exists=True):
+    """
+    Task for fetching a batch of `(org_id, financial_year_end)` jobs at once.
+    """
+    engine = FetchEngine(
+        max_workers=max_workers, tags=tags, fail_if_exists=fail_if_exists
+    )
+    documents = []
+    for job, job_documents, error in engine.run(jobs):
+        documents.extend(document.id for document in job_documents)
+    logging.info(
+        "{:,.0f} documents fetched for {:,.0f} jobs".format(len(documents), len(jobs))
+    )
+    return documents
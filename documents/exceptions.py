@@ -1,10 +1,59 @@
+import datetime
+
+
 class CharityFetchError(Exception):
     pass
 
 
+class HostUnavailable(CharityFetchError):
+    def __init__(self, host, retry_at):
+        self.host = host
+        self.retry_at = retry_at
+        super().__init__(
+            "{} is unavailable until {:%Y-%m-%d %H:%M:%S}".format(
+                host, datetime.datetime.fromtimestamp(retry_at)
+            )
+        )
+
+
 class DocAlreadyExists(Exception):
     pass
 
 
 class DocumentUploadError(Exception):
     pass
+
+
+class OCRError(DocumentUploadError):
+    pass
+
+
+class OCRTimeout(OCRError):
+    pass
+
+
+class OCRSlotUnavailable(Exception):
+    """
+    All the OCR slots are busy, so OCR should be tried again later
+    """
+
+
+class OCRPending(OCRSlotUnavailable):
+    """
+    The text of a document has been extracted, but `pages` couldn't be
+    OCRed yet because all the OCR slots are busy
+    """
+
+    def __init__(self, pages, page_count, extractor, error):
+        self.pages = pages
+        self.page_count = page_count
+        self.extractor = extractor
+        super().__init__("{:,.0f} pages waiting for OCR: {}".format(len(pages), error))
+
+
+class OCRMemoryExceeded(OCRError):
+    pass
+
+
+class SearchIndexError(Exception):
+    pass
@@ -0,0 +1,105 @@
+"""
+Cache of the results of extracting text from PDFs and OCRing them, so that
+reprocessing a PDF that hasn't changed doesn't extract or OCR it again.
+
+Entries are keyed by the SHA-256 hash of the PDF plus the extractor and its
+version (for text) or the ocrmypdf version and options (for OCR), so a new
+version or different options never reuse an old result. They are kept in the
+"extraction_cache" storage, which can be on local disk or in object storage.
+"""
+
+import gzip
+import hashlib
+import json
+import logging
+import shutil
+import tempfile
+
+import ocrmypdf
+from django.conf import settings
+from django.core.files.base import File
+from django.core.files.storage import storages
+
+# size of the chunks copied when reading OCRed PDFs from the cache
+CHUNK_SIZE = 1024 * 1024
+
+
+def get_storage():
+    return storages["extraction_cache"]
+
+
+def text_cache_name(file_hash, extractor):
+    return "text/{}/{}/{}-{}.jsonl.gz".format(
+        file_hash[:2], file_hash, extractor.name, extractor.get_version()
+    )
+
+
+def ocr_cache_name(file_hash, options):
+    options_hash = hashlib.sha256(
+        json.dumps(
+            {"ocrmypdf": ocrmypdf.__version__, "options": options}, sort_keys=True
+        ).encode("utf-8")
+    ).hexdigest()
+    return "ocr/{}/{}/{}.pdf".format(file_hash[:2], file_hash, options_hash[:16])
+
+
+def save(name, source):
+    storage = get_storage()
+    if storage.exists(name):
+        return
+    source.seek(0)
+    storage.save(name, File(source))
+
+
+def load_text(file_hash, extractor, writer):
+    """
+    Write the cached text of a PDF to a `PageTextWriter`.
+
+    Returns whether the text was found, and the problem found by the quality
+    checks when the text was extracted.
+    """
+    name = text_cache_name(file_hash, extractor)
+    storage = get_storage()
+    if not storage.exists(name):
+        return False, None
+    with storage.open(name, "rb") as f, gzip.open(f, "rt", encoding="utf-8") as lines:
+        metadata = json.loads(next(lines))
+        for line in lines:
+            writer.write_page(json.loads(line))
+    logging.info("Using cached text from {}".format(extractor.name))
+    return True, metadata["problem"]
+
+
+def save_text(file_hash, extractor, writer, problem=None):
+    """
+    Cache the text of a PDF from a `PageTextWriter`, one line per page
+    """
+    with tempfile.SpooledTemporaryFile(
+        max_size=settings.TEXT_SPOOL_MAX_MEMORY
+    ) as spool:
+        with gzip.open(spool, "wt", encoding="utf-8") as lines:
+            lines.write(json.dumps({"pages": writer.pages, "problem": problem}) + "\n")
+            for page in range(writer.pages):
+                lines.write(json.dumps(writer.read_page(page)) + "\n")
+        save(text_cache_name(file_hash, extractor), spool)
+
+
+def load_ocr(file_hash, options):
+    """
+    Get the cached OCR version of a PDF as an open temporary file, or None
+    """
+    name = ocr_cache_name(file_hash, options)
+    storage = get_storage()
+    if not storage.exists(name):
+        return None
+    output = tempfile.TemporaryFile()
+    with storage.open(name, "rb") as f:
+        shutil.copyfileobj(f, output, CHUNK_SIZE)
+    output.seek(0)
+    logging.info("Using cached OCR")
+    return output
+
+
+def save_ocr(file_hash, options, ocr_file):
+    save(ocr_cache_name(file_hash, options), ocr_file)
+    ocr_file.seek(0)
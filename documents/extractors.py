@@ -0,0 +1,197 @@
+"""
+Backends for getting the text from PDFs.
+
+`settings.PDF_EXTRACTORS` lists the backends to try, in order. If a backend
+can't read a PDF, or the text from it fails the quality checks in
+`check_text_quality`, the next backend is used for that document.
+"""
+
+import threading
+import unicodedata
+
+import pdfplumber
+import pypdfium2
+from django.conf import settings
+
+# words longer than this usually mean the spaces between words were lost
+LONG_WORD_LENGTH = 30
+
+
+class PDFExtractor:
+    name = None
+
+    # whether long documents are split across the extraction process pool
+    parallel = True
+
+    def get_version(self):
+        raise NotImplementedError
+
+    def page_count(self, source):
+        raise NotImplementedError
+
+    def iter_pages(self, source, start=0, end=None, pages=None):
+        """
+        Yield the text of each page from `start` to `end`, or of each of
+        `pages` (numbered from 0) if given
+        """
+        raise NotImplementedError
+
+
+class PdfplumberExtractor(PDFExtractor):
+    """
+    Accurate but slow, as it works out the position of every character.
+    """
+
+    name = "pdfplumber"
+
+    def get_version(self):
+        return pdfplumber.__version__
+
+    def page_count(self, source):
+        with pdfplumber.open(source) as pdf:
+            return len(pdf.pages)
+
+    def iter_pages(self, source, start=0, end=None, pages=None):
+        with pdfplumber.open(source) as pdf:
+            if pages is None:
+                pages = range(len(pdf.pages))[start:end]
+            for i in pages:
+                page = pdf.pages[i]
+                text = page.extract_text() or ""
+                # release the objects cached while extracting the page
+                page.close()
+                yield text
+
+
+class PdfiumExtractor(PDFExtractor):
+    """
+    Uses the text extraction built into pdfium, which is much faster than
+    pdfplumber for PDFs that already contain text.
+    """
+
+    name = "pdfium"
+    parallel = False
+
+    # pdfium isn't thread-safe
+    lock = threading.Lock()
+
+    def get_version(self):
+        return pypdfium2.V_PYPDFIUM2
+
+    def clean_text(self, text):
+        # pdfium marks hyphens added at line breaks with \x02
+        return text.replace("\x02", "").replace("\r\n", "\n").strip()
+
+    def page_count(self, source):
+        with self.lock:
+            pdf = pypdfium2.PdfDocument(source)
+            try:
+                return len(pdf)
+            finally:
+                pdf.close()
+
+    def iter_pages(self, source, start=0, end=None, pages=None):
+        with self.lock:
+            pdf = pypdfium2.PdfDocument(source)
+            try:
+                if pages is None:
+                    pages = range(len(pdf))[start:end]
+                for i in pages:
+                    page = pdf[i]
+                    textpage = page.get_textpage()
+                    text = self.clean_text(textpage.get_text_bounded())
+                    textpage.close()
+                    page.close()
+                    yield text
+            finally:
+                pdf.close()
+
+
+def get_image_pages(source, pages):
+    """
+    Find which of `pages` (numbered from 0) have an image covering at least
+    `settings.OCR_MIN_IMAGE_AREA` of the page. Pages without text that don't
+    have one (blank pages, dividers, charts) have nothing to OCR.
+    """
+    image_pages = []
+    with PdfiumExtractor.lock:
+        pdf = pypdfium2.PdfDocument(source)
+        try:
+            for i in pages:
+                page = pdf[i]
+                width, height = page.get_size()
+                for obj in page.get_objects(filter=[pypdfium2.raw.FPDF_PAGEOBJ_IMAGE]):
+                    left, bottom, right, top = obj.get_pos()
+                    if (right - left) * (top - bottom) >= (
+                        width * height * settings.OCR_MIN_IMAGE_AREA
+                    ):
+                        image_pages.append(i)
+                        break
+                page.close()
+        finally:
+            pdf.close()
+    return image_pages
+
+
+EXTRACTORS = {
+    extractor.name: extractor
+    for extractor in (PdfiumExtractor(), PdfplumberExtractor())
+}
+
+
+def get_extractor(name):
+    return EXTRACTORS[name]
+
+
+class TextQuality:
+    """
+    Check whether extracted text looks garbled, a page at a time.
+
+    Documents with little or no text pass, as they are sent for OCR instead.
+    """
+
+    def __init__(self):
+        self.characters = 0
+        self.bad_characters = 0
+        self.words = 0
+        self.long_words = 0
+
+    def add(self, text):
+        self.characters += len(text)
+        # characters that can't be displayed, usually from fonts without a
+        # mapping to unicode
+        self.bad_characters += sum(
+            1
+            for c in text
+            if c == "\ufffd"
+            or (unicodedata.category(c) in ("Cc", "Co") and c not in "\n\t")
+        )
+        for word in text.split():
+            self.words += 1
+            if len(word) > LONG_WORD_LENGTH:
+                self.long_words += 1
+
+    def get_problem(self):
+        """
+        Returns a description of the problem, or None if the text looks fine.
+        """
+        if not self.characters:
+            return None
+        if (
+            self.bad_characters / self.characters
+            > settings.PDF_EXTRACT_MAX_BAD_CHARACTERS
+        ):
+            return "{:,.0f} unreadable characters".format(self.bad_characters)
+        if (
+            self.words
+            and self.long_words / self.words > settings.PDF_EXTRACT_MAX_LONG_WORDS
+        ):
+            return "{:,.0f} words without spaces".format(self.long_words)
+        return None
+
+
+def check_text_quality(texts):
+    quality = TextQuality()
+    for text in texts:
+        quality.add(text)
+    return quality.get_problem()
@@ -1,13 +1,25 @@
+import datetime
 import logging
+import random
+import tempfile
 import time
+from contextlib import contextmanager
 
-import requests_cache
 from django.conf import settings
-from django.core.files.base import ContentFile
+from django.core.cache import cache
+from django.core.files.base import File
+from django.db import transaction
 from django.utils import timezone
-from requests_html import HTMLSession
-
-from documents.exceptions import CharityFetchError, DocAlreadyExists
+from django_q.models import Schedule
+from django_q.tasks import schedule
+
+from documents.circuitbreaker import CircuitBreaker, is_host_failure
+from documents.exceptions import (
+    CharityFetchError,
+    DocAlreadyExists,
+    OCRPending,
+)
+from documents.http import get_session
 from documents.models import (
     Charity,
     CharityFinancialYear,
@@ -15,10 +27,280 @@ from documents.models import (
     DocumentStatus,
     Tag,
 )
-from documents.scrapers import get_charity_type
-from documents.utils import convert_file, do_document_ocr
+from documents.pipeline import (
+    EXTRACT,
+    INDEX,
+    OCR,
+    clear_document_content,
+    defer_stage,
+    document_file,
+    process_document,
+    queue_stage,
+)
+from documents.ratelimit import get_rate_limiter
+from documents.scrapers import Account, get_charity_type
+from documents.utils import get_file_hash, set_stored_file
+
+# size of the chunks read from the network when downloading files
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+@contextmanager
+def regulator_request(name):
+    """
+    Wrap requests to a regulator's website.
+
+    Waits until the regulator's rate limit allows another request, and
+    records whether the request succeeded in the regulator's circuit breaker.
+    Raises `HostUnavailable` if the circuit breaker is open.
+    """
+    circuit_breaker = CircuitBreaker(name)
+    circuit_breaker.before_request()
+    get_rate_limiter(name).acquire()
+    try:
+        yield
+    except Exception as e:
+        if is_host_failure(e):
+            circuit_breaker.record_failure()
+        else:
+            circuit_breaker.record_success()
+        raise
+    circuit_breaker.record_success()
+
+
+def defer_fetch(org_id, financial_years, error, tags=None, fail_if_exists=True):
+    """
+    Schedule another attempt at fetching documents once the regulator's
+    website should be available again.
+    """
+    retry_at = getattr(
+        error, "retry_at", time.time() + settings.CIRCUIT_BREAKER_BACKOFF
+    )
+    # spread out the retries so they don't all arrive at once
+    next_run = datetime.datetime.fromtimestamp(
+        retry_at + random.uniform(0, settings.CIRCUIT_BREAKER_BACKOFF),
+        tz=datetime.timezone.utc,
+    )
+    financial_years = list(financial_years)
+    schedule(
+        "documents.fetch.fetch_documents_for_charity",
+        org_id,
+        [fy.financial_year_end.isoformat() for fy in financial_years],
+        tags=[tag if isinstance(tag, str) else tag.slug for tag in tags or []],
+        fail_if_exists=fail_if_exists,
+        schedule_type=Schedule.ONCE,
+        next_run=next_run,
+    )
+    for financial_year in financial_years:
+        financial_year.status = DocumentStatus.PENDING
+        financial_year.status_notes = "Deferred until {:%Y-%m-%d %H:%M}: {}".format(
+            next_run, error
+        )
+        financial_year.last_document_fetch_started = timezone.now()
+        financial_year.save()
+    logging.warning(
+        "Fetch deferred for {} until {}: {}".format(org_id, next_run, error)
+    )
+
+
+def download_file(url, name, session):
+    """
+    Stream a file into a spooled temporary file.
+
+    Files smaller than `settings.DOWNLOAD_SPOOL_MAX_MEMORY` are kept in memory,
+    larger files are written to disk as they are downloaded. Files larger than
+    `settings.DOWNLOAD_MAX_SIZE` are rejected.
+    """
+    logging.info("Fetching {}".format(url))
+    spool = tempfile.SpooledTemporaryFile(max_size=settings.DOWNLOAD_SPOOL_MAX_MEMORY)
+    try:
+        with session.get(url, stream=True) as r:
+            r.raise_for_status()
+            for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                spool.write(chunk)
+                if spool.tell() > settings.DOWNLOAD_MAX_SIZE:
+                    raise CharityFetchError(
+                        "File is larger than {:,.0f} bytes".format(
+                            settings.DOWNLOAD_MAX_SIZE
+                        )
+                    )
+    except CharityFetchError:
+        spool.close()
+        raise
+    except Exception as e:
+        spool.close()
+        raise CharityFetchError(e) from e
+    spool.seek(0)
+    return File(spool, name=name)
+
+
+def list_accounts(org_id, session, refresh=False):
+    """
+    List the accounts available for a charity on the regulator's website.
+
+    The listing is cached for `settings.ACCOUNT_LISTING_CACHE_TIMEOUT` seconds,
+    so tasks for different financial years of the same charity share one
+    request. Use `refresh` to ignore any cached listing.
+
+    Returns the accounts and whether they came from the cache.
+    """
+    cache_key = "account-listing:{}".format(org_id)
+    if not refresh:
+        listing = cache.get(cache_key)
+        if listing is not None:
+            logging.info(
+                "Using account listing for {} fetched at {}".format(
+                    org_id, listing["fetched_at"]
+                )
+            )
+            return [Account(**account) for account in listing["accounts"]], True
+
+    scraper = get_charity_type(org_id)
+    if refresh and getattr(session, "http_cache", None):
+        session.http_cache.delete(scraper.get_charity_url(org_id))
+    with regulator_request(scraper.name):
+        accounts = list(scraper.list_accounts(org_id, session))
+    cache.set(
+        cache_key,
+        {
+            "accounts": [account._asdict() for account in accounts],
+            "fetched_at": timezone.now(),
+        },
+        settings.ACCOUNT_LISTING_CACHE_TIMEOUT,
+    )
+    return accounts, False
+
+
+def get_duplicate_document(file_hash):
+    """
+    Find a document that has already been processed from a PDF with the same hash
+    """
+    return (
+        Document.objects.with_content()
+        .filter(file_hash=file_hash, content__isnull=False)
+        .exclude(file="")
+        .first()
+    )
+
 
-requests_cache.install_cache("demo_cache")
+def copy_document_content(source, document):
+    """
+    Point a document at the stored files and extracted content of another
+    document, without uploading or extracting them again.
+    """
+    document.file = source.file.name
+    document.file_text = source.file_text.name
+    document.content = source.content
+    document.content_length = source.content_length
+    document.pages = source.pages
+    document.page_offsets = source.page_offsets
+    document.content_type = source.content_type
+    document.language = source.language
+    document.extractor = source.extractor
+    document.extractor_version = source.extractor_version
+    document.process_type = source.process_type
+
+
+def add_document_tags(document, tags=None):
+    if not tags:
+        return
+    tag_objects = []
+    for tag in tags:
+        if isinstance(tag, str):
+            tag, _ = Tag.objects.get_or_create(
+                slug=Tag._meta.get_field("slug").slugify(tag)
+            )
+        tag_objects.append(tag)
+    document.tags.add(*tag_objects)
+
+
+def save_document(
+    document,
+    financial_year,
+    tags=None,
+    save=True,
+    status=DocumentStatus.SUCCESS,
+    status_notes=None,
+):
+    """
+    Save a document and its tags, and mark its financial year as fetched (or
+    with another status), in a single transaction.
+    """
+    with transaction.atomic():
+        if save:
+            document.save()
+        add_document_tags(document, tags)
+        financial_year.status = status
+        financial_year.status_notes = status_notes
+        financial_year.last_document_fetch_started = timezone.now()
+        financial_year.save()
+
+
+def process_fetched_document(document, financial_year, tags=None, pdf_file=None):
+    """
+    Get the text from a fetched document's PDF, save the document and queue
+    it to be indexed. If the pipeline is enabled the document is saved
+    straight away and the text is got by the pipeline's stages instead.
+
+    `pdf_file` is the downloaded PDF - if it isn't given the stored copy is
+    used. If getting the text fails the document is still saved with its PDF
+    (so it doesn't need to be downloaded again to retry) and the financial
+    year is marked as failed. If OCR is busy the text that was extracted is
+    saved, and the pages that need OCR are OCRed later.
+    """
+    if settings.DOCUMENT_PIPELINE_ENABLED:
+        # the pipeline's stages mark the financial year as fetched or failed
+        save_document(
+            document,
+            financial_year,
+            tags,
+            save=pdf_file is not None,
+            status=DocumentStatus.PENDING,
+            status_notes="Waiting for text to be extracted",
+        )
+        return queue_stage(EXTRACT, document)
+
+    try:
+        if pdf_file is None:
+            with document_file(document) as f:
+                process_document(document, File(f, name=document.file.name))
+        else:
+            process_document(document, pdf_file)
+    except OCRPending as e:
+        # save the text that was extracted, and OCR the rest once OCR is free
+        save_document(
+            document,
+            financial_year,
+            tags,
+            status=(
+                DocumentStatus.SUCCESS
+                if document.content_length
+                else DocumentStatus.PENDING
+            ),
+            status_notes=str(e),
+        )
+        if document.content_length:
+            queue_stage(INDEX, document)
+        return defer_stage(
+            OCR,
+            document,
+            e,
+            pages=e.pages,
+            page_count=e.page_count,
+            extractor=e.extractor,
+        )
+    except Exception as e:
+        clear_document_content(document)
+        save_document(
+            document,
+            financial_year,
+            tags,
+            status=DocumentStatus.FAILED,
+            status_notes=str(e),
+        )
+        raise
+    save_document(document, financial_year, tags)
+    return queue_stage(INDEX, document)
 
 
 def get_document(financial_year, tags=None, fail_if_exists=True):
@@ -29,13 +311,7 @@ def get_document(financial_year, tags=None, fail_if_exists=True):
             "updated_at": timezone.now(),
         },
     )
-    if tags:
-        for tag in tags:
-            if isinstance(tag, str):
-                tag, _ = Tag.objects.get_or_create(
-                    slug=Tag._meta.get_field("slug").slugify(tag)
-                )
-            document.tags.add(tag)
+    add_document_tags(document, tags)
 
     if not created and document.file:
         if fail_if_exists:
@@ -61,11 +337,11 @@ def fetch_documents_for_charity(
     financial_year_end=None,
     session=None,
     tags=None,
-    pause=10,
+    pause=None,
     fail_if_exists=True,
 ):
     if session is None:
-        session = HTMLSession()
+        session = get_session()
 
     charity = Charity.objects.get(org_id=org_id)
     logging.info("Fetching documents for {}".format(charity.org_id))
@@ -74,6 +350,10 @@ def fetch_documents_for_charity(
         financial_years = charity.financial_years.order_by("-financial_year_end")
     elif financial_year_end == "latest":
         financial_years = charity.financial_years.order_by("-financial_year_end")[0:1]
+    elif isinstance(financial_year_end, (list, tuple)):
+        financial_years = charity.financial_years.filter(
+            financial_year_end__in=financial_year_end
+        )
     else:
         financial_years = charity.financial_years.filter(
             financial_year_end=financial_year_end
@@ -88,13 +368,33 @@ def fetch_documents_for_charity(
         )
     )
 
-    scraper = get_charity_type(charity.org_id)
-    all_accounts = [
-        account for account in scraper.list_accounts(charity.org_id, session)
-    ]
-    accounts = [
-        account for account in all_accounts if account.fyend in financial_years.keys()
-    ]
+    try:
+        all_accounts, from_cache = list_accounts(charity.org_id, session)
+        accounts = [
+            account
+            for account in all_accounts
+            if account.fyend in financial_years.keys()
+        ]
+        if not accounts and from_cache:
+            # the cached account listing may be out of date, so check again
+            logging.info("Accounts not found in cached listing - fetching again")
+            all_accounts, _ = list_accounts(charity.org_id, session, refresh=True)
+            accounts = [
+                account
+                for account in all_accounts
+                if account.fyend in financial_years.keys()
+            ]
+    except Exception as e:
+        if not is_host_failure(e):
+            raise
+        defer_fetch(
+            charity.org_id,
+            financial_years.values(),
+            e,
+            tags=tags,
+            fail_if_exists=fail_if_exists,
+        )
+        return []
     if not accounts:
         for financial_year in financial_years.values():
             financial_year.status = DocumentStatus.FAILED
@@ -113,7 +413,7 @@ def fetch_documents_for_charity(
     )
 
     documents = []
-    for account in accounts:
+    for index, account in enumerate(accounts):
         financial_year = financial_years[account.fyend]
         try:
             documents.append(
@@ -127,11 +427,17 @@ def fetch_documents_for_charity(
                 )
             )
 
-            financial_year.status = DocumentStatus.SUCCESS
-            financial_year.last_document_fetch_started = timezone.now()
-            financial_year.save()
-
         except Exception as e:
+            if is_host_failure(e):
+                # try this and the remaining accounts again later
+                defer_fetch(
+                    charity.org_id,
+                    [financial_years[a.fyend] for a in accounts[index:]],
+                    e,
+                    tags=tags,
+                    fail_if_exists=fail_if_exists,
+                )
+                break
             financial_year.status = DocumentStatus.FAILED
             financial_year.status_notes = str(e)
             financial_year.last_document_fetch_started = timezone.now()
@@ -143,109 +449,71 @@ def fetch_documents_for_charity(
 
 
 def fetch_account(
-    account, financial_year, session=None, tags=None, pause=10, fail_if_exists=True
+    account, financial_year, session=None, tags=None, pause=None, fail_if_exists=True
 ):
     if session is None:
-        session = HTMLSession()
+        session = get_session()
 
-    # get the document (fails after saving the tags if the document already exists)
-    document, created = Document.objects.get_or_create(
-        financial_year=financial_year,
-        defaults={
-            "created_at": timezone.now(),
-            "updated_at": timezone.now(),
-        },
-    )
+    # get the document - nothing is saved until the new document is ready
+    document = Document.objects.filter(financial_year=financial_year).first()
+    if document is None:
+        document = Document(financial_year=financial_year)
 
-    # add tags to the document
-    if tags:
-        for tag in tags:
-            if isinstance(tag, str):
-                tag, _ = Tag.objects.get_or_create(
-                    slug=Tag._meta.get_field("slug").slugify(tag)
-                )
-            document.tags.add(tag)
-
-    # if the document already exists, return it
-    if not created and document.file and fail_if_exists:
+    # if the document was saved before but its text couldn't be got, try
+    # again with the stored copy of the PDF
+    elif document.file and fail_if_exists and document.content_length is None:
         logging.info(
-            "Document already exists for {} {} - replacing with new document".format(
+            "Getting text again for {} {}".format(
                 financial_year.charity.org_id,
                 financial_year.financial_year_end,
             )
         )
+        process_fetched_document(document, financial_year, tags)
         return document
 
-    # if we're fetching the document then update the status
-    financial_year.status = DocumentStatus.PENDING
-    financial_year.last_document_fetch_started = timezone.now()
-    financial_year.save()
+    # if the document already exists, save the tags and return it
+    elif document.file and fail_if_exists:
+        save_document(document, financial_year, tags, save=False)
+        logging.info(
+            "Document already exists for {} {}".format(
+                financial_year.charity.org_id,
+                financial_year.financial_year_end,
+            )
+        )
+        return document
 
     # Get the PDF
-    logging.info("Fetching {}".format(account.url))
-    try:
-        r = session.get(account.url)
-        r.raise_for_status()
-    except Exception as e:
-        raise CharityFetchError(e)
+    regulator = get_charity_type(financial_year.charity.org_id).name
+    with regulator_request(regulator):
+        pdf_file = download_file(account.url, financial_year.document_filename, session)
 
-    # Pause to save the server
+    # Optional extra pause on top of the rate limit
     if pause:
         logging.info("Pausing for {} seconds".format(pause))
         time.sleep(pause)
-    pdf_file = ContentFile(r.content, name=financial_year.document_filename)
-
-    # Save the PDF to the database
-    logging.info("Saving PDF file {}".format(financial_year.document_filename))
-    document.file = pdf_file
-    document.save()
 
-    # Convert the PDF to text
-    logging.info(
-        "Getting text from PDF file {}".format(financial_year.document_filename)
-    )
-    filedata = convert_file(pdf_file)
-    document.content = filedata["content"]
-    document.file_text = ContentFile(
-        filedata["content"].encode("utf-8"),
-        name=financial_year.document_filename.replace(".pdf", ".txt"),
-    )
-    document.content_length = filedata["content_length"]
-    document.pages = filedata["pages"]
-    document.content_type = filedata["content_type"]
-    document.language = filedata["language"]
-    document.process_type = Document.DocumentProcessType.AS_SUPPLIED
-    document.save()
-    logging.info(
-        "PDF file fetched pages: {:,.0f} size: {:,.0f}".format(
-            document.pages, document.content_length
+    # Reuse an existing copy of the same PDF rather than processing it again
+    document.file_hash = get_file_hash(pdf_file)
+    duplicate = get_duplicate_document(document.file_hash)
+    if duplicate:
+        pdf_file.close()
+        copy_document_content(duplicate, document)
+        save_document(document, financial_year, tags)
+        queue_stage(INDEX, document)
+        logging.info(
+            "Document {} created for {} {} from document {}".format(
+                document.id, account.regno, account.fyend, duplicate.id
+            )
         )
-    )
+        return document
 
-    # if there's no content then try and OCR the PDF
-    if document.content_length < settings.MIN_DOC_LENGTH:
-        new_file = do_document_ocr(document.file)
-        if new_file:
-            new_file = ContentFile(new_file, name=financial_year.document_filename)
-            document.file = new_file
-            document.save()
-            filedata = convert_file(new_file)
-            document.content = filedata["content"]
-            document.file_text = ContentFile(
-                filedata["content"].encode("utf-8"),
-                name=financial_year.document_filename.replace("pdf", "txt"),
-            )
-            document.content_length = filedata["content_length"]
-            document.pages = filedata["pages"]
-            document.content_type = filedata["content_type"]
-            document.language = filedata["language"]
-            document.process_type = Document.DocumentProcessType.OCR
-            document.save()
-            logging.info(
-                "PDF file OCR pages: {:,.0f} size: {:,.0f}".format(
-                    document.pages, document.content_length
-                )
-            )
+    # Get the text from the PDF (OCRing it if needed) before saving, so that
+    # the document is saved and its files uploaded once. If the pipeline is
+    # enabled the PDF is saved and the later stages are queued instead.
+    with pdf_file:
+        set_stored_file(document, "file", pdf_file, "pdf", document.file_hash)
+        logging.info("Saving PDF file {}".format(financial_year.document_filename))
+        process_fetched_document(document, financial_year, tags, pdf_file)
 
     logging.info(
         "Document {} created for {} {}".format(
@@ -267,14 +535,20 @@ def document_from_file(org_id, financial_year_end, filepath, tags=None):
     document = get_document(financial_year, tags=tags)
 
     # Get the PDF
-    pdf_file = ContentFile(
-        open(filepath, "rb").read(),
+    pdf_file = File(
+        open(filepath, "rb"),
         name=f"{charity.org_id}-{financial_year.financial_year_end}.pdf",
     )
 
-    # Save the PDF to the database
-    document.file = pdf_file
-    document.save()
+    # Save the PDF to the database, reusing an existing copy of the same PDF
+    with pdf_file:
+        document.file_hash = get_file_hash(pdf_file)
+        duplicate = get_duplicate_document(document.file_hash)
+        if duplicate:
+            copy_document_content(duplicate, document)
+        else:
+            set_stored_file(document, "file", pdf_file, "pdf", document.file_hash)
+        document.save()
 
     print("Document created for {} {}".format(org_id, financial_year_end))
     return document
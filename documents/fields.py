@@ -0,0 +1,74 @@
+import functools
+
+import zstandard
+from django.conf import settings
+from django.db import models
+
+
+@functools.cache
+def get_dictionaries():
+    """
+    Compression dictionaries from `settings.CONTENT_COMPRESSION_DICTIONARIES`,
+    keyed by their ID. The first one is used for compressing new text.
+    """
+    dictionaries = {}
+    for path in settings.CONTENT_COMPRESSION_DICTIONARIES:
+        with open(path, "rb") as f:
+            dictionary = zstandard.ZstdCompressionDict(f.read())
+        dictionaries[dictionary.dict_id()] = dictionary
+    return dictionaries
+
+
+@functools.cache
+def get_compression_dictionary():
+    if not settings.CONTENT_COMPRESSION_DICTIONARIES:
+        return None
+    dictionary = next(iter(get_dictionaries().values()))
+    dictionary.precompute_compress(level=settings.CONTENT_COMPRESSION_LEVEL)
+    return dictionary
+
+
+def compress_text(text):
+    compressor = zstandard.ZstdCompressor(
+        level=settings.CONTENT_COMPRESSION_LEVEL,
+        dict_data=get_compression_dictionary(),
+    )
+    return compressor.compress(text.encode("utf-8"))
+
+
+def decompress_text(data):
+    # the ID of the dictionary used (if any) is stored with the compressed data
+    dict_id = zstandard.get_frame_parameters(data).dict_id
+    if dict_id:
+        decompressor = zstandard.ZstdDecompressor(dict_data=get_dictionaries()[dict_id])
+    else:
+        decompressor = zstandard.ZstdDecompressor()
+    return decompressor.decompress(data).decode("utf-8")
+
+
+class CompressedTextField(models.BinaryField):
+    """
+    Text stored in the database compressed with zstd.
+
+    The value is a string in Python, and is only compressed when it is saved,
+    so models can use it like a `TextField` (but it can't be searched in the
+    database).
+    """
+
+    def from_db_value(self, value, expression, connection):
+        if value is None:
+            return value
+        return decompress_text(bytes(value))
+
+    def to_python(self, value):
+        if isinstance(value, (bytes, memoryview)):
+            return decompress_text(bytes(value))
+        return value
+
+    def get_prep_value(self, value):
+        if isinstance(value, str):
+            return compress_text(value)
+        return super().get_prep_value(value)
+
+    def value_to_string(self, obj):
+        return self.value_from_object(obj)
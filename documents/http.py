@@ -0,0 +1,285 @@
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+from django.conf import settings
+from requests import Response
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+from requests_html import HTMLSession
+from urllib3.connection import HTTPConnection
+from urllib3.util.retry import Retry
+
+LISTING = "listing"
+DOCUMENT = "document"
+
+
+def get_url_class(headers):
+    """
+    Whether a response is an account listing page or a document
+    """
+    if "pdf" in headers.get("Content-Type", "").lower():
+        return DOCUMENT
+    return LISTING
+
+
+class HTTPCache:
+    """
+    Size-limited cache of HTTP responses, stored in an SQLite database.
+
+    Each response is stored with the time it expires. Expired responses are
+    kept so that they can be revalidated using their ETag or Last-Modified
+    headers. When the total size of the stored responses is larger than
+    `max_size` the least recently used responses are removed.
+    """
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        with self._connect() as conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS responses (
+                    url TEXT PRIMARY KEY,
+                    status_code INTEGER,
+                    headers TEXT,
+                    content BLOB,
+                    size INTEGER,
+                    expires_at REAL,
+                    accessed_at REAL
+                )
+                """
+            )
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def get(self, url):
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT status_code, headers, content, expires_at "
+                "FROM responses WHERE url = ?",
+                (url,),
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                "UPDATE responses SET accessed_at = ? WHERE url = ?",
+                (time.time(), url),
+            )
+        status_code, headers, content, expires_at = row
+        return {
+            "status_code": status_code,
+            "headers": json.loads(headers),
+            "content": content,
+            "expires_at": expires_at,
+        }
+
+    def set(self, url, response, expire_after):
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    url,
+                    response.status_code,
+                    json.dumps(dict(response.headers)),
+                    response.content,
+                    len(response.content),
+                    now + expire_after,
+                    now,
+                ),
+            )
+        self.evict()
+
+    def refresh(self, url, expire_after):
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE responses SET expires_at = ?, accessed_at = ? WHERE url = ?",
+                (time.time() + expire_after, time.time(), url),
+            )
+
+    def delete(self, url):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM responses WHERE url = ?", (url,))
+
+    def evict(self):
+        """
+        Remove the least recently used responses until the cache fits in `max_size`
+        """
+        with self._connect() as conn:
+            total_size = conn.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM responses"
+            ).fetchone()[0]
+            if total_size <= self.max_size:
+                return
+            rows = conn.execute(
+                "SELECT url, size FROM responses ORDER BY accessed_at"
+            ).fetchall()
+            to_delete = []
+            for url, size in rows:
+                if total_size <= self.max_size:
+                    break
+                to_delete.append((url,))
+                total_size -= size
+            conn.executemany("DELETE FROM responses WHERE url = ?", to_delete)
+        logging.debug(
+            "Removed {:,.0f} responses from HTTP cache".format(len(to_delete))
+        )
+
+
+class PooledAdapter(HTTPAdapter):
+    """
+    Transport adapter with a pool of kept-alive connections to each host.
+
+    Requests that don't give a timeout use `settings.HTTP_TIMEOUT`, and
+    connection errors and some server errors are retried (see
+    `settings.HTTP_RETRIES`). Responses with an error status are returned
+    rather than raised once the retries run out, so `raise_for_status` (and
+    the circuit breakers) still see them.
+    """
+
+    def __init__(self, timeout=None, **kwargs):
+        self.timeout = timeout
+        kwargs.setdefault("pool_connections", settings.HTTP_POOL_CONNECTIONS)
+        kwargs.setdefault("pool_maxsize", settings.HTTP_POOL_MAXSIZE)
+        kwargs.setdefault(
+            "max_retries",
+            Retry(
+                total=settings.HTTP_RETRIES,
+                backoff_factor=settings.HTTP_RETRY_BACKOFF,
+                status_forcelist=settings.HTTP_RETRY_STATUS_CODES,
+                allowed_methods=["HEAD", "GET"],
+                raise_on_status=False,
+                # a long Retry-After would hold up the fetch - backing off
+                # is left to the circuit breakers
+                respect_retry_after_header=False,
+            ),
+        )
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        # TCP keepalive stops idle connections in the pool being dropped
+        kwargs["socket_options"] = HTTPConnection.default_socket_options + [
+            (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),
+        ]
+        super().init_poolmanager(*args, **kwargs)
+
+    def send(self, request, timeout=None, **kwargs):
+        if timeout is None:
+            timeout = self.timeout
+        return super().send(request, timeout=timeout, **kwargs)
+
+
+class CachingAdapter(PooledAdapter):
+    """
+    Transport adapter that serves GET requests from an `HTTPCache`.
+
+    How long responses are cached for depends on whether they are account
+    listing pages or documents (see `settings.HTTP_CACHE_EXPIRE_AFTER`).
+    Streamed requests are never cached.
+    """
+
+    def __init__(self, cache, expire_after, **kwargs):
+        self.cache = cache
+        self.expire_after = expire_after
+        super().__init__(**kwargs)
+
+    def _cached_response(self, request, cached):
+        response = Response()
+        response.status_code = cached["status_code"]
+        response.headers = CaseInsensitiveDict(cached["headers"])
+        response.encoding = get_encoding_from_headers(response.headers)
+        response._content = cached["content"]
+        response._content_consumed = True
+        response.url = request.url
+        response.request = request
+        response.reason = "OK"
+        response.connection = self
+        response.from_cache = True
+        return response
+
+    def send(self, request, stream=False, **kwargs):
+        if request.method != "GET" or stream:
+            return super().send(request, stream=stream, **kwargs)
+
+        cached = self.cache.get(request.url)
+        if cached:
+            if cached["expires_at"] > time.time():
+                return self._cached_response(request, cached)
+
+            # ask the server whether the stale response is still valid
+            headers = CaseInsensitiveDict(cached["headers"])
+            if headers.get("ETag"):
+                request.headers["If-None-Match"] = headers["ETag"]
+            if headers.get("Last-Modified"):
+                request.headers["If-Modified-Since"] = headers["Last-Modified"]
+
+        response = super().send(request, stream=stream, **kwargs)
+        if cached and response.status_code == 304:
+            expire_after = self.expire_after.get(
+                get_url_class(CaseInsensitiveDict(cached["headers"])), 0
+            )
+            self.cache.refresh(request.url, expire_after)
+            return self._cached_response(request, cached)
+
+        response.from_cache = False
+        if response.status_code == 200:
+            expire_after = self.expire_after.get(get_url_class(response.headers), 0)
+            if expire_after:
+                self.cache.set(request.url, response, expire_after)
+            elif cached:
+                self.cache.delete(request.url)
+        return response
+
+
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+
+def new_session():
+    """
+    Create a session for requests to the regulators' websites.
+
+    If `settings.HTTP_CACHE_ENABLED` is set then responses are cached, but only
+    for requests made through this session.
+    """
+    session = HTMLSession()
+    session.http_cache = None
+    if settings.HTTP_CACHE_ENABLED:
+        session.http_cache = HTTPCache(
+            settings.HTTP_CACHE_PATH, settings.HTTP_CACHE_MAX_SIZE
+        )
+        adapter = CachingAdapter(
+            session.http_cache,
+            settings.HTTP_CACHE_EXPIRE_AFTER,
+            timeout=settings.HTTP_TIMEOUT,
+        )
+    else:
+        adapter = PooledAdapter(timeout=settings.HTTP_TIMEOUT)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def get_session():
+    """
+    Get the session shared by all the tasks (and threads) in this process.
+
+    The session lasts as long as the worker, so connections to the
+    regulators' websites are reused between tasks. A process forked from
+    one that already has a session gets a new one rather than sharing its
+    connections.
+    """
+    global _session, _session_pid
+    with _session_lock:
+        if _session is None or _session_pid != os.getpid():
+            _session = new_session()
+            _session_pid = os.getpid()
+        return _session
@@ -0,0 +1,488 @@
+"""
+Bulk indexing of documents in Elasticsearch.
+
+The financial year, charity and tags needed by `DocumentDocument.prepare` are
+loaded in bulk alongside the documents, which are streamed from the database
+in batches and sent to Elasticsearch in parallel bulk requests.
+"""
+
+import datetime
+import logging
+import re
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import F, Q
+from django.utils import timezone
+from django_q.models import Schedule
+from django_q.tasks import async_task, schedule
+from elasticsearch import ApiError, TransportError
+from elasticsearch.helpers import parallel_bulk
+
+from documents.circuitbreaker import FAILURE_STATUS_CODES, CircuitBreaker
+from documents.documents import MAPPING_VERSION, DocumentDocument
+from documents.exceptions import HostUnavailable, SearchIndexError
+from documents.models import Document, IndexCheckpoint, IndexQueueItem
+
+# documents that `DocumentDocument.should_index_object` leaves out
+NOT_INDEXABLE = Q(content__isnull=True) | Q(file__isnull=True) | Q(file="")
+
+# cache keys used to make sure only one flush of the indexing queue is
+# waiting or running at a time
+FLUSH_SCHEDULED_KEY = "index-queue:flush-scheduled"
+FLUSH_QUEUED_KEY = "index-queue:flush-queued"
+FLUSH_RUNNING_KEY = "index-queue:flush-running"
+
+
+def get_indexing_queryset(documents=None):
+    """
+    Documents to index, with everything needed to prepare them loaded in bulk
+    """
+    if documents is None:
+        documents = DocumentDocument().get_queryset()
+    return (
+        documents.with_content()
+        .select_related("financial_year__charity")
+        .prefetch_related("tags", "financial_year__charity__tags")
+    )
+
+
+def index_documents(
+    documents=None,
+    batch_size=None,
+    chunk_size=None,
+    thread_count=None,
+    index=None,
+):
+    """
+    Add documents to the search index.
+
+    `documents` is a queryset of documents to index (all the documents that
+    should be in the index by default). They are read from the database
+    `batch_size` at a time, and sent to Elasticsearch in requests of
+    `chunk_size` documents using `thread_count` threads. If `index` is given
+    the documents are added to that index rather than the default one.
+
+    Returns the number of documents indexed and a list of the bulk results
+    for the documents that failed.
+    """
+    batch_size = batch_size or settings.SEARCH_INDEX_BATCH_SIZE
+    doc_type = DocumentDocument()
+    objects = (
+        get_indexing_queryset(documents).order_by("id").iterator(chunk_size=batch_size)
+    )
+    actions = doc_type.get_actions(objects, "index")
+    if index:
+        actions = (dict(action, _index=index) for action in actions)
+
+    return send_actions(actions, chunk_size=chunk_size, thread_count=thread_count)
+
+
+def delete_documents(document_ids, index=None):
+    """
+    Remove documents from the search index.
+
+    Returns the number of documents deleted (including any that weren't in
+    the index) and a list of the bulk results for the documents that failed.
+    """
+    index = index or DocumentDocument._index._name
+    actions = (
+        {"_op_type": "delete", "_index": index, "_id": document_id}
+        for document_id in document_ids
+    )
+    return send_actions(actions)
+
+
+def send_actions(actions, chunk_size=None, thread_count=None):
+    done = 0
+    failed = []
+    started = time.monotonic()
+    for ok, info in parallel_bulk(
+        DocumentDocument._get_connection(),
+        actions,
+        thread_count=thread_count or settings.SEARCH_INDEX_THREADS,
+        chunk_size=chunk_size or settings.SEARCH_INDEX_CHUNK_SIZE,
+        max_chunk_bytes=settings.SEARCH_INDEX_MAX_CHUNK_BYTES,
+        raise_on_error=False,
+    ):
+        # the result is keyed by the type of action
+        action, result = next(iter(info.items()))
+        # deleting a document that isn't in the index is fine
+        if ok or (action == "delete" and result.get("status") == 404):
+            done += 1
+        else:
+            failed.append(result)
+            logging.warning("Document not updated in index: {}".format(info))
+        if (done + len(failed)) % 1000 == 0:
+            logging.info(
+                "{:,.0f} documents updated in index ({:,.0f} per second)".format(
+                    done, done / (time.monotonic() - started)
+                )
+            )
+    return done, failed
+
+
+def changed_since(since):
+    """
+    Filter for documents that have changed (or whose financial year or charity
+    has changed) since `since`. Tag changes update `updated_at` on the
+    documents or charities tagged (see `documents.signals`).
+    """
+    return (
+        Q(updated_at__gt=since)
+        | Q(financial_year__updated_at__gt=since)
+        | Q(financial_year__charity__updated_at__gt=since)
+    )
+
+
+def index_changed_documents(since=None, **kwargs):
+    """
+    Update the search index with the documents that have changed since the
+    last time this was run (or since `since`, if given).
+
+    Documents that have changed but no longer have content or a file are
+    removed from the index. The checkpoint is only moved on if every
+    document was updated, so failures are tried again the next time.
+
+    Returns the number of documents indexed, deleted and failed.
+    """
+    name = DocumentDocument._index._name
+    checkpoint = IndexCheckpoint.objects.filter(name=name).first()
+    if since is None and checkpoint:
+        since = checkpoint.indexed_until
+    # anything changed while this is running will be picked up next time
+    started = timezone.now()
+
+    if since is None:
+        indexable = DocumentDocument().get_queryset()
+        to_delete = Document.objects.none()
+    else:
+        changed = changed_since(since)
+        indexable = DocumentDocument().get_queryset().filter(changed)
+        to_delete = Document.objects.filter(changed).filter(NOT_INDEXABLE)
+
+    indexed, index_failed = index_documents(indexable, **kwargs)
+    deleted, delete_failed = delete_documents(
+        to_delete.values_list("id", flat=True).iterator()
+    )
+    failed = len(index_failed) + len(delete_failed)
+
+    if not failed:
+        IndexCheckpoint.objects.update_or_create(
+            name=name, defaults={"indexed_until": started}
+        )
+    return indexed, deleted, failed
+
+
+def create_versioned_index():
+    """
+    Create a new, empty version of the search index to be loaded in bulk,
+    with no replicas and refresh turned off.
+
+    Returns the name of the index.
+    """
+    alias = DocumentDocument._index._name
+    name = "{}-v{}-{:%Y%m%d%H%M%S}".format(alias, MAPPING_VERSION, timezone.now())
+    index = DocumentDocument._index.clone(name=name)
+    index.settings(number_of_replicas=0, refresh_interval="-1")
+    index.create()
+    return name
+
+
+def finish_versioned_index(name):
+    """
+    Give a newly loaded index its normal replicas and refresh interval.
+    """
+    es = DocumentDocument._get_connection()
+    es.indices.put_settings(
+        index=name,
+        settings={
+            "index": {
+                "number_of_replicas": settings.SEARCH_INDEX_SETTINGS[
+                    "number_of_replicas"
+                ],
+                "refresh_interval": settings.SEARCH_INDEX_SETTINGS["refresh_interval"],
+            }
+        },
+    )
+    es.indices.refresh(index=name)
+    # wait for the primary shards - the replicas are copied in the background
+    es.cluster.health(index=name, wait_for_status="yellow", timeout="10m")
+
+
+def get_index_version():
+    """
+    Mapping version of the index that searches are using, or None if the
+    index wasn't built with a versioned mapping.
+    """
+    es = DocumentDocument._get_connection()
+    alias = DocumentDocument._index._name
+    if not es.indices.exists_alias(name=alias):
+        return None
+    for name in es.indices.get_alias(name=alias):
+        match = re.match(r"{}-v(\d+)-".format(re.escape(alias)), name)
+        if match:
+            return int(match.group(1))
+    return None
+
+
+def swap_index_alias(name, delete_old=True):
+    """
+    Point the search index alias at a new version of the index, in one step
+    so that searches don't see a missing or half-built index.
+
+    An index created before aliases were used (with the same name as the
+    alias) is removed at the same time. Returns the names of the indexes
+    the alias was taken from, which are deleted if `delete_old` is set.
+    """
+    es = DocumentDocument._get_connection()
+    alias = DocumentDocument._index._name
+    actions = [{"add": {"index": name, "alias": alias}}]
+    old_indexes = []
+    if es.indices.exists_alias(name=alias):
+        old_indexes = list(es.indices.get_alias(name=alias).keys())
+        actions += [
+            {"remove": {"index": old_index, "alias": alias}}
+            for old_index in old_indexes
+        ]
+    elif es.indices.exists(index=alias):
+        actions.append({"remove_index": {"index": alias}})
+    es.indices.update_aliases(actions=actions)
+    logging.info("Search index alias {} moved to {}".format(alias, name))
+
+    if delete_old:
+        for old_index in old_indexes:
+            es.indices.delete(index=old_index)
+            logging.info("Search index {} deleted".format(old_index))
+    return old_indexes
+
+
+def rebuild_index(delete_old=True, **kwargs):
+    """
+    Build a new version of the search index and switch searches over to it
+    once it is loaded, without taking the current index down.
+
+    If more than `settings.SEARCH_INDEX_REBUILD_MAX_FAILURES` documents fail
+    the new index is deleted and searches carry on using the old one.
+    Otherwise the documents that failed are added to the indexing queue once
+    the index has been switched over. Documents that change while the index
+    is being built are indexed again at the same time. Keyword arguments are
+    passed to `index_documents`.
+
+    Returns the name of the new index and the number of documents indexed
+    and failed.
+    """
+    started = timezone.now()
+    name = create_versioned_index()
+    try:
+        indexed, failed = index_documents(index=name, **kwargs)
+        if len(failed) > settings.SEARCH_INDEX_REBUILD_MAX_FAILURES:
+            raise SearchIndexError(
+                "{:,.0f} documents could not be indexed".format(len(failed))
+            )
+        finish_versioned_index(name)
+    except Exception:
+        DocumentDocument._get_connection().indices.delete(
+            index=name, ignore_unavailable=True
+        )
+        raise
+    swap_index_alias(name, delete_old=delete_old)
+
+    failed_ids = [int(r["_id"]) for r in failed if r.get("_id") is not None]
+    if failed_ids:
+        logging.warning(
+            "Documents queued to be indexed again: {}".format(
+                ", ".join(str(document_id) for document_id in failed_ids)
+            )
+        )
+        enqueue_documents(failed_ids)
+    index_changed_documents(since=started, **kwargs)
+    return name, indexed, len(failed)
+
+
+def is_index_failure(exception):
+    """
+    Whether an exception means Elasticsearch is unavailable or overloaded
+    """
+    if isinstance(exception, TransportError):
+        return True
+    if isinstance(exception, ApiError):
+        return exception.status_code in FAILURE_STATUS_CODES
+    return False
+
+
+def get_flush_cluster():
+    if settings.DOCUMENT_PIPELINE_ENABLED:
+        return settings.DOCUMENT_PIPELINE_CLUSTERS["index"]
+    return None
+
+
+def schedule_flush(next_run):
+    """
+    Flush the indexing queue at `next_run` (a timestamp), unless a flush is
+    already scheduled before then.
+    """
+    timeout = max(next_run - time.time(), 1)
+    if not cache.add(FLUSH_SCHEDULED_KEY, True, timeout):
+        return
+    schedule(
+        "documents.indexing.flush_index_queue",
+        schedule_type=Schedule.ONCE,
+        next_run=datetime.datetime.fromtimestamp(next_run, tz=datetime.timezone.utc),
+        cluster=get_flush_cluster(),
+    )
+
+
+def enqueue_documents(document_ids):
+    """
+    Add documents to the indexing queue.
+
+    The queue is flushed once `settings.INDEX_QUEUE_BATCH_SIZE` documents
+    are waiting, and no more than `settings.INDEX_QUEUE_FLUSH_INTERVAL`
+    seconds after a document is added.
+    """
+    now = timezone.now()
+    IndexQueueItem.objects.bulk_create(
+        [
+            IndexQueueItem(document_id=document_id, queued_at=now)
+            for document_id in document_ids
+        ],
+        # a document that's already queued is moved to the back of the queue,
+        # so changes made while it is being indexed aren't lost
+        update_conflicts=True,
+        update_fields=["queued_at"],
+        unique_fields=["document"],
+    )
+    if IndexQueueItem.objects.count() >= settings.INDEX_QUEUE_BATCH_SIZE:
+        if cache.add(FLUSH_QUEUED_KEY, True, settings.INDEX_QUEUE_FLUSH_INTERVAL):
+            async_task(
+                "documents.indexing.flush_index_queue", cluster=get_flush_cluster()
+            )
+    else:
+        schedule_flush(time.time() + settings.INDEX_QUEUE_FLUSH_INTERVAL)
+
+
+def index_queued_documents(document_ids):
+    """
+    Index or remove a batch of documents from the queue.
+
+    Returns the bulk results for the documents that failed.
+    """
+    indexable = DocumentDocument().get_queryset().filter(id__in=document_ids)
+    _, index_failed = index_documents(indexable)
+    _, delete_failed = delete_documents(
+        Document.objects.filter(id__in=document_ids)
+        .filter(NOT_INDEXABLE)
+        .values_list("id", flat=True)
+    )
+    return index_failed + delete_failed
+
+
+def flush_index_queue():
+    """
+    Task for sending the documents in the indexing queue to Elasticsearch in
+    batches of `settings.INDEX_QUEUE_BATCH_SIZE`.
+
+    If Elasticsearch is unavailable (tracked with a circuit breaker) or slow
+    the documents are left in the queue and the flush tries again later.
+    Documents that fail `settings.DOCUMENT_PIPELINE_MAX_ATTEMPTS` times are
+    dropped from the queue (the incremental index will pick them up again if
+    they change). Failed documents go to the back of the queue and aren't
+    tried again until a later flush, so their attempts are spread out.
+    """
+    if not cache.add(FLUSH_RUNNING_KEY, True, settings.INDEX_QUEUE_FLUSH_TIMEOUT):
+        logging.info("Indexing queue is already being flushed")
+        return
+    cache.delete(FLUSH_QUEUED_KEY)
+    circuit_breaker = CircuitBreaker("elasticsearch")
+    indexed = 0
+    # documents that failed in this flush, which are left for the next one
+    retry_later = set()
+    try:
+        for _ in range(settings.INDEX_QUEUE_MAX_BATCHES):
+            flush_started = timezone.now()
+            document_ids = list(
+                IndexQueueItem.objects.exclude(document_id__in=retry_later)
+                .order_by("queued_at")
+                .values_list("document_id", flat=True)[
+                    : settings.INDEX_QUEUE_BATCH_SIZE
+                ]
+            )
+            if not document_ids:
+                if retry_later:
+                    schedule_flush(time.time() + settings.INDEX_QUEUE_FLUSH_INTERVAL)
+                return indexed
+            try:
+                circuit_breaker.before_request()
+            except HostUnavailable as e:
+                logging.warning("Indexing queue not flushed: {}".format(e))
+                schedule_flush(e.retry_at)
+                return indexed
+
+            started = time.monotonic()
+            batch_failed = False
+            try:
+                failed = index_queued_documents(document_ids)
+            except Exception as e:
+                if is_index_failure(e):
+                    circuit_breaker.record_failure()
+                    logging.warning("Indexing queue not flushed: {}".format(e))
+                    schedule_flush(time.time() + settings.INDEX_QUEUE_FLUSH_INTERVAL)
+                    return indexed
+                # the batch is tried again in a later flush, until the documents
+                # in it have used up their attempts
+                logging.error("Indexing queue batch failed: {}".format(e))
+                failed = [{"_id": document_id} for document_id in document_ids]
+                batch_failed = True
+
+            # documents rejected because the cluster is overloaded count
+            # against the cluster rather than the documents
+            rejected = [r for r in failed if r.get("status") in FAILURE_STATUS_CODES]
+            if rejected:
+                circuit_breaker.record_failure()
+            else:
+                circuit_breaker.record_success()
+            failed_ids = {int(r["_id"]) for r in failed if r.get("_id") is not None}
+            rejected_ids = {int(r["_id"]) for r in rejected if r.get("_id") is not None}
+            IndexQueueItem.objects.filter(
+                document_id__in=set(document_ids) - failed_ids,
+                queued_at__lte=flush_started,
+            ).delete()
+            # failed documents go to the back of the queue
+            IndexQueueItem.objects.filter(
+                document_id__in=failed_ids - rejected_ids
+            ).update(attempts=F("attempts") + 1, queued_at=timezone.now())
+            retry_later |= failed_ids
+            for item in IndexQueueItem.objects.filter(
+                attempts__gte=settings.DOCUMENT_PIPELINE_MAX_ATTEMPTS
+            ):
+                logging.error(
+                    "Document {} could not be indexed after {} attempts".format(
+                        item.document_id, item.attempts
+                    )
+                )
+                item.delete()
+            indexed += len(document_ids) - len(failed_ids)
+
+            seconds = time.monotonic() - started
+            logging.info(
+                "{:,.0f} queued documents indexed in {:,.1f} seconds".format(
+                    len(document_ids) - len(failed_ids), seconds
+                )
+            )
+            if batch_failed:
+                schedule_flush(time.time() + settings.INDEX_QUEUE_FLUSH_INTERVAL)
+                return indexed
+            if rejected or seconds > settings.INDEX_QUEUE_SLOW_BATCH:
+                # give the cluster time to catch up
+                logging.warning("Elasticsearch is slow - pausing the indexing queue")
+                schedule_flush(time.time() + settings.INDEX_QUEUE_FLUSH_INTERVAL)
+                return indexed
+
+    finally:
+        cache.delete(FLUSH_RUNNING_KEY)
+
+    # there's still more in the queue
+    async_task("documents.indexing.flush_index_queue", cluster=get_flush_cluster())
+    return indexed
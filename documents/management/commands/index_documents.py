@@ -0,0 +1,138 @@
+import datetime
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from documents.documents import MAPPING_VERSION, DocumentDocument
+from documents.indexing import (
+    get_index_version,
+    index_changed_documents,
+    index_documents,
+    rebuild_index,
+)
+from documents.models import Regulators
+
+
+class Command(BaseCommand):
+    help = "Add documents to the search index using parallel bulk requests"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--tag", "-t", action="append", help="Only documents with this tag"
+        )
+        parser.add_argument(
+            "--regulator",
+            "-r",
+            choices=Regulators.values,
+            action="append",
+            help="Only documents from charities registered with this regulator",
+        )
+        parser.add_argument(
+            "--year-from", type=int, help="Earliest financial year end (year)"
+        )
+        parser.add_argument(
+            "--year-to", type=int, help="Latest financial year end (year)"
+        )
+        parser.add_argument(
+            "--changed",
+            action="store_true",
+            help=(
+                "Only documents changed since the last time this was run, "
+                "removing any that shouldn't be in the index any more"
+            ),
+        )
+        parser.add_argument(
+            "--rebuild",
+            action="store_true",
+            help=(
+                "Build a new version of the index with all the documents, and "
+                "switch searches over to it once it's ready"
+            ),
+        )
+        parser.add_argument(
+            "--keep-old",
+            action="store_true",
+            help="With --rebuild, don't delete the previous version of the index",
+        )
+        parser.add_argument(
+            "--since",
+            type=datetime.datetime.fromisoformat,
+            help="With --changed, documents changed since this date and time",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            help="Number of documents to read from the database at a time",
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            help="Number of documents to send in each bulk request",
+        )
+        parser.add_argument(
+            "--threads",
+            type=int,
+            help="Number of bulk requests to send at the same time",
+        )
+
+    def get_documents(self, options):
+        documents = DocumentDocument().get_queryset()
+        if options["tag"]:
+            documents = documents.filter(tags__slug__in=options["tag"]).distinct()
+        if options["regulator"]:
+            documents = documents.filter(
+                financial_year__charity__source__in=options["regulator"]
+            )
+        if options["year_from"]:
+            documents = documents.filter(
+                financial_year__financial_year_end__year__gte=options["year_from"]
+            )
+        if options["year_to"]:
+            documents = documents.filter(
+                financial_year__financial_year_end__year__lte=options["year_to"]
+            )
+        return documents
+
+    def handle(self, *args, **options):
+        kwargs = {
+            "batch_size": options["batch_size"],
+            "chunk_size": options["chunk_size"],
+            "thread_count": options["threads"],
+        }
+        if not options["rebuild"] and get_index_version() != MAPPING_VERSION:
+            self.stderr.write(
+                self.style.WARNING(
+                    f"The search index doesn't use mapping version "
+                    f"{MAPPING_VERSION} - rebuild it with --rebuild"
+                )
+            )
+
+        started = time.monotonic()
+        filtered = any(options[f] for f in ("tag", "regulator", "year_from", "year_to"))
+        if options["rebuild"]:
+            if filtered or options["changed"] or options["since"]:
+                raise CommandError("Only the whole index can be rebuilt")
+            name, indexed, failed = rebuild_index(
+                delete_old=not options["keep_old"], **kwargs
+            )
+            self.stdout.write(f"Searches now use index {name}")
+        elif options["changed"]:
+            if filtered:
+                raise CommandError("Filters can't be used with --changed")
+            since = options["since"]
+            if since and timezone.is_naive(since):
+                since = timezone.make_aware(since)
+            indexed, deleted, failed = index_changed_documents(since, **kwargs)
+            self.stdout.write(f"{deleted:,.0f} documents removed from the index")
+        else:
+            if options["since"]:
+                raise CommandError("--since can only be used with --changed")
+            indexed, failed = index_documents(self.get_documents(options), **kwargs)
+            failed = len(failed)
+        seconds = max(time.monotonic() - started, 0.001)
+        self.stdout.write(
+            f"{indexed:,.0f} documents indexed ({failed:,.0f} failed) in "
+            f"{seconds:,.0f} seconds: {indexed / seconds:,.1f} documents/second"
+        )
+        self.stdout.write(self.style.SUCCESS("Indexing finished"))
@@ -1,10 +1,12 @@
 from datetime import date as Date
 
-from django.core.management.base import BaseCommand
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
 from django.db.models import F
 from django.utils import timezone
 from django_q.tasks import async_task
 
+from documents.engine import fetch_documents_batch
 from documents.fetch import fetch_documents_for_charity
 from documents.models import (
     CharityFinancialYear,
@@ -29,8 +31,35 @@ class Command(BaseCommand):
             "--pause",
             "-p",
             type=int,
-            default=10,
-            help="Seconds to pause after document is fetched",
+            default=0,
+            help=(
+                "Seconds to pause after document is fetched "
+                "(requests are already rate limited per regulator, and this "
+                "can't be used with --batch-size)"
+            ),
+        )
+        parser.add_argument(
+            "--batch-size",
+            "-b",
+            type=int,
+            default=1,
+            help=(
+                "Number of documents to fetch concurrently in each task "
+                "(needs DOCUMENT_PIPELINE to be enabled)"
+            ),
+        )
+        parser.add_argument(
+            "--concurrency",
+            "-c",
+            type=int,
+            default=None,
+            help="Number of downloads in flight in each batch task",
+        )
+        parser.add_argument(
+            "--group-by-charity",
+            "-g",
+            action="store_true",
+            help="Fetch all the selected financial years for a charity in one task",
         )
         parser.add_argument(
             "--earliest",
@@ -41,38 +70,85 @@ class Command(BaseCommand):
         )
 
     def handle(self, *args, **options):
+        if options["batch_size"] > 1:
+            # the text is extracted (and OCRed) in the task that fetches the
+            # document unless the pipeline is enabled, which for a whole batch
+            # would take longer than the task timeout
+            if not settings.DOCUMENT_PIPELINE_ENABLED:
+                raise CommandError(
+                    "Fetching in batches needs DOCUMENT_PIPELINE to be enabled"
+                )
+            if options["pause"]:
+                raise CommandError("--pause can't be used with --batch-size")
+
         n = min(options["number"], 10_000)
 
         task_group = FetchGroup.objects.create()
 
-        documents = CharityFinancialYear.objects.filter(
-            documents__isnull=True,
-            status__isnull=True,
-            income__gt=25000,
-            charity__source=Regulators.CCEW,
-            document_submitted__isnull=False,
-            charity__date_removed__isnull=True,
-            financial_year_end__gt=options["earliest"],
-        ).order_by(
-            F("financial_year_end__year").asc(nulls_last=True),
-            F("income").desc(nulls_last=True),
-        )[:n]
+        documents = (
+            CharityFinancialYear.objects.select_related("charity")
+            .filter(
+                documents__isnull=True,
+                status__isnull=True,
+                income__gt=25000,
+                charity__source=Regulators.CCEW,
+                document_submitted__isnull=False,
+                charity__date_removed__isnull=True,
+                financial_year_end__gt=options["earliest"],
+            )
+            .order_by(
+                F("financial_year_end__year").asc(nulls_last=True),
+                F("income").desc(nulls_last=True),
+            )[:n]
+        )
+
+        # each job is a list of financial years for the same charity
+        if options["group_by_charity"]:
+            jobs = {}
+            for record in documents:
+                jobs.setdefault(record.charity_id, []).append(record)
+            jobs = list(jobs.values())
+        else:
+            jobs = [[record] for record in documents]
 
-        for record in documents:
+        if options["batch_size"] > 1:
+            for i in range(0, len(jobs), options["batch_size"]):
+                batch = jobs[i : i + options["batch_size"]]
+                task_id = async_task(
+                    fetch_documents_batch,
+                    [self.get_job_args(records) for records in batch],
+                    group=task_group.id,
+                    max_workers=options["concurrency"],
+                )
+                for records in batch:
+                    for record in records:
+                        self.add_record_to_group(record, task_id, task_group)
+            return
+
+        for records in jobs:
             task_id = async_task(
                 fetch_documents_for_charity,
-                record.charity.org_id,
-                record.financial_year_end,
+                *self.get_job_args(records),
                 group=task_group.id,
                 pause=options["pause"],
             )
-            record.task_id = task_id
-            record.status = DocumentStatus.PENDING
-            record.last_document_fetch_started = timezone.now()
-            record.task_groups.add(task_group)
-            record.save()
-            self.stdout.write(
-                self.style.SUCCESS(
-                    f"Document {record} added to queue (task id: {task_id})"
-                )
-            )
+            for record in records:
+                self.add_record_to_group(record, task_id, task_group)
+
+    def get_job_args(self, records):
+        if len(records) == 1:
+            return (records[0].charity_id, records[0].financial_year_end)
+        return (
+            records[0].charity_id,
+            [record.financial_year_end for record in records],
+        )
+
+    def add_record_to_group(self, record, task_id, task_group):
+        record.task_id = task_id
+        record.status = DocumentStatus.PENDING
+        record.last_document_fetch_started = timezone.now()
+        record.task_groups.add(task_group)
+        record.save()
+        self.stdout.write(
+            self.style.SUCCESS(f"Document {record} added to queue (task id: {task_id})")
+        )
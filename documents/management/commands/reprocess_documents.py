@@ -0,0 +1,224 @@
+import multiprocessing
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from documents.extractors import get_extractor
+from documents.models import Document, Regulators
+from documents.reprocess import init_worker, reprocess_document
+
+
+class Command(BaseCommand):
+    help = "Extract the text from existing documents again"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--tag", "-t", action="append", help="Only documents with this tag"
+        )
+        parser.add_argument(
+            "--regulator",
+            "-r",
+            choices=Regulators.values,
+            action="append",
+            help="Only documents from charities registered with this regulator",
+        )
+        parser.add_argument(
+            "--year-from", type=int, help="Earliest financial year end (year)"
+        )
+        parser.add_argument(
+            "--year-to", type=int, help="Latest financial year end (year)"
+        )
+        parser.add_argument(
+            "--process-type",
+            choices=Document.DocumentProcessType.values,
+            action="append",
+            help="Only documents with this process type",
+        )
+        parser.add_argument(
+            "--extractor", action="append", help="Only documents from this extractor"
+        )
+        parser.add_argument(
+            "--extractor-version",
+            action="append",
+            help="Only documents from this extractor version",
+        )
+        parser.add_argument(
+            "--outdated",
+            action="store_true",
+            help=(
+                "Only documents not extracted by the current version of the "
+                "first of PDF_EXTRACTORS"
+            ),
+        )
+        parser.add_argument(
+            "--limit", "-n", type=int, help="Maximum number of documents"
+        )
+        parser.add_argument(
+            "--processes",
+            "-p",
+            type=int,
+            default=os.cpu_count(),
+            help="Number of documents to process at the same time",
+        )
+        parser.add_argument(
+            "--max-read-rate",
+            type=float,
+            default=None,
+            help="Maximum MB per second read from storage (across all processes)",
+        )
+        parser.add_argument(
+            "--checkpoint",
+            "-c",
+            help=(
+                "File recording the documents that have been processed, so "
+                "that the command can be stopped and started again"
+            ),
+        )
+        parser.add_argument(
+            "--retry-failed",
+            action="store_true",
+            help="Process documents that failed in the checkpoint file again",
+        )
+        parser.add_argument(
+            "--no-index",
+            action="store_true",
+            help="Don't update the search index",
+        )
+        parser.add_argument(
+            "--log-every",
+            type=int,
+            default=100,
+            help="Report progress after this many documents",
+        )
+
+    def get_documents(self, options):
+        documents = Document.objects.filter(file__isnull=False).exclude(file="")
+        if options["tag"]:
+            documents = documents.filter(tags__slug__in=options["tag"])
+        if options["regulator"]:
+            documents = documents.filter(
+                financial_year__charity__source__in=options["regulator"]
+            )
+        if options["year_from"]:
+            documents = documents.filter(
+                financial_year__financial_year_end__year__gte=options["year_from"]
+            )
+        if options["year_to"]:
+            documents = documents.filter(
+                financial_year__financial_year_end__year__lte=options["year_to"]
+            )
+        if options["process_type"]:
+            documents = documents.filter(process_type__in=options["process_type"])
+        if options["extractor"]:
+            documents = documents.filter(extractor__in=options["extractor"])
+        if options["extractor_version"]:
+            documents = documents.filter(
+                extractor_version__in=options["extractor_version"]
+            )
+        if options["outdated"]:
+            extractor = get_extractor(settings.PDF_EXTRACTORS[0])
+            documents = documents.exclude(
+                extractor=extractor.name,
+                extractor_version=extractor.get_version(),
+            )
+        document_ids = documents.distinct().order_by("id").values_list("id", flat=True)
+        if options["limit"]:
+            document_ids = document_ids[: options["limit"]]
+        return list(document_ids)
+
+    def read_checkpoint(self, path, retry_failed=False):
+        done = set()
+        if not path or not os.path.exists(path):
+            return done
+        with open(path) as f:
+            for line in f:
+                document_id, status = line.split("\t")[:2]
+                if retry_failed and status.strip() != "ok":
+                    continue
+                done.add(int(document_id))
+        return done
+
+    def handle(self, *args, **options):
+        done = self.read_checkpoint(options["checkpoint"], options["retry_failed"])
+        document_ids = [i for i in self.get_documents(options) if i not in done]
+        self.stdout.write(
+            f"{len(document_ids):,.0f} documents to reprocess "
+            f"({len(done):,.0f} already done)"
+        )
+        if not document_ids:
+            return
+
+        read_rate = None
+        if options["max_read_rate"]:
+            read_rate = options["max_read_rate"] * 1024 * 1024 / options["processes"]
+
+        # the processes open their own database connections
+        connections.close_all()
+
+        checkpoint = open(options["checkpoint"], "a") if options["checkpoint"] else None
+        stats = {"documents": 0, "failed": 0, "pages": 0, "bytes": 0}
+        started = time.monotonic()
+        try:
+            with ProcessPoolExecutor(
+                max_workers=options["processes"],
+                mp_context=multiprocessing.get_context("fork"),
+                initializer=init_worker,
+                initargs=(read_rate,),
+            ) as executor:
+                # only keep a few documents queued for each process
+                remaining = iter(document_ids)
+                pending = set()
+                while True:
+                    while len(pending) < options["processes"] * 2:
+                        document_id = next(remaining, None)
+                        if document_id is None:
+                            break
+                        pending.add(
+                            executor.submit(
+                                reprocess_document,
+                                document_id,
+                                index=not options["no_index"],
+                            )
+                        )
+                    if not pending:
+                        break
+                    finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        document_id, pages, bytes_read, error = future.result()
+                        stats["documents"] += 1
+                        stats["pages"] += pages or 0
+                        stats["bytes"] += bytes_read
+                        if error:
+                            stats["failed"] += 1
+                            self.stderr.write(f"Document {document_id} failed: {error}")
+                        if checkpoint:
+                            checkpoint.write(
+                                "{}\t{}\t{}\n".format(
+                                    document_id,
+                                    "failed" if error else "ok",
+                                    (error or "").replace("\n", " "),
+                                )
+                            )
+                            checkpoint.flush()
+                        if stats["documents"] % options["log_every"] == 0:
+                            self.report(stats, started, len(document_ids))
+        finally:
+            if checkpoint:
+                checkpoint.close()
+
+        self.report(stats, started, len(document_ids))
+        self.stdout.write(self.style.SUCCESS("Reprocessing finished"))
+
+    def report(self, stats, started, total):
+        seconds = max(time.monotonic() - started, 0.001)
+        self.stdout.write(
+            f"{stats['documents']:,.0f} / {total:,.0f} documents "
+            f"({stats['failed']:,.0f} failed) in {seconds:,.0f} seconds: "
+            f"{stats['documents'] / seconds * 3600:,.0f} documents/hour, "
+            f"{stats['pages'] / seconds:,.1f} pages/second, "
+            f"{stats['bytes'] / seconds / (1024 * 1024):,.2f} MB/second read"
+        )
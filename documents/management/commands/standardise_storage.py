@@ -16,6 +16,10 @@ FILENAME_REGEX = re.compile(
 FILENAME_FORMAT = (
     "accounts/{filetype}/{org_id_prefix}/Ends{org_id_end}/{org_id}-{date}.{filetype}"
 )
+# files stored under the hash of their contents (see `set_stored_file`)
+HASHED_FILENAME_REGEX = re.compile(
+    r"^accounts/(pdf|txt)/sha256/[0-9a-f]{2}/[0-9a-f]{64}\."
+)
 PDF = "pdf"
 TXT = "txt"
 FILETYPES = [PDF, TXT]
@@ -31,6 +35,10 @@ def get_orgid_and_date(filename):
         return None, None, None
 
 
+def is_hashed_filename(filename):
+    return bool(filename and HASHED_FILENAME_REGEX.match(str(filename)))
+
+
 def get_new_filename(org_id, date, filetype="pdf"):
     if filetype not in FILETYPES:
         raise ValueError("Filetype must be one of {}".format(FILETYPES))
@@ -45,6 +53,12 @@ def get_new_filename(org_id, date, filetype="pdf"):
 
 
 class Command(BaseCommand):
+    help = (
+        "Link the files named by charity and date in storage to documents. "
+        "Documents whose files are stored under the hash of their contents "
+        "are left as they are."
+    )
+
     def handle(self, *args, **options):
         # connect to s3
 
@@ -123,7 +137,9 @@ class Command(BaseCommand):
                             )
                             results["pdf_documents_created"] += 1
                             # print("created document for", original_filename)
-                        elif doc.file != new_filename:
+                        elif doc.file != new_filename and not is_hashed_filename(
+                            doc.file
+                        ):
                             doc.file = new_filename
                             doc.save()
                             results["pdf_documents_updated"] += 1
@@ -142,7 +158,9 @@ class Command(BaseCommand):
                             )
                             results["txt_documents_created"] += 1
                             # print("created document for", original_filename)
-                        elif doc.file_text != new_filename:
+                        elif doc.file_text != new_filename and not (
+                            is_hashed_filename(doc.file_text)
+                        ):
                             doc.file_text = new_filename
                             doc.save()
                             results["txt_documents_updated"] += 1
@@ -0,0 +1,55 @@
+import zstandard
+from django.core.management.base import BaseCommand
+
+from documents.models import Document
+
+
+class Command(BaseCommand):
+    help = (
+        "Train a zstd dictionary on a sample of document content, for use "
+        "in CONTENT_COMPRESSION_DICTIONARIES"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("output", help="File to write the dictionary to")
+        parser.add_argument(
+            "--documents",
+            "-n",
+            type=int,
+            default=1000,
+            help="Number of documents to sample",
+        )
+        parser.add_argument(
+            "--size",
+            type=int,
+            default=112640,
+            help="Size of the dictionary in bytes",
+        )
+
+    def handle(self, *args, **options):
+        # train on the text of individual pages, as zstd works best with
+        # lots of small samples
+        samples = []
+        documents = (
+            Document.objects.with_content()
+            .filter(content__isnull=False)
+            .order_by("?")
+            .only("id", "content", "pages", "page_offsets")[: options["documents"]]
+        )
+        for document in documents.iterator(chunk_size=100):
+            for offsets in document.get_page_offsets():
+                if offsets:
+                    samples.append(
+                        document.content[offsets[0] : offsets[1]].encode("utf-8")
+                    )
+
+        dictionary = zstandard.train_dictionary(options["size"], samples)
+        with open(options["output"], "wb") as f:
+            f.write(dictionary.as_bytes())
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Dictionary {dictionary.dict_id()} trained on {len(samples):,.0f} "
+                f"pages written to {options['output']}"
+            )
+        )
@@ -19,6 +19,15 @@ UPDATE_SQL = {
             date_removed = excluded.date_removed,
             created_at = documents_charity.created_at,
             updated_at = excluded.updated_at
+        WHERE (
+            documents_charity.name,
+            documents_charity.date_registered,
+            documents_charity.date_removed
+        ) IS DISTINCT FROM (
+            excluded.name,
+            excluded.date_registered,
+            excluded.date_removed
+        )
     """,
     "Insert CCEW financial records": """
         insert into documents_charityfinancialyear (
@@ -46,7 +55,19 @@ UPDATE_SQL = {
         SET document_due = excluded.document_due,
             document_submitted = excluded.document_submitted,
             income = excluded.income,
-            expenditure = excluded.expenditure
+            expenditure = excluded.expenditure,
+            updated_at = excluded.updated_at
+        WHERE (
+            documents_charityfinancialyear.document_due,
+            documents_charityfinancialyear.document_submitted,
+            documents_charityfinancialyear.income,
+            documents_charityfinancialyear.expenditure
+        ) IS DISTINCT FROM (
+            excluded.document_due,
+            excluded.document_submitted,
+            excluded.income,
+            excluded.expenditure
+        )
     """,
     "Insert updated CCNI records": """
         insert into documents_charity
@@ -64,6 +85,15 @@ UPDATE_SQL = {
             date_removed = excluded.date_removed,
             created_at = documents_charity.created_at,
             updated_at = excluded.updated_at
+        WHERE (
+            documents_charity.name,
+            documents_charity.date_registered,
+            documents_charity.date_removed
+        ) IS DISTINCT FROM (
+            excluded.name,
+            excluded.date_registered,
+            excluded.date_removed
+        )
     """,
     "Insert CCNI financial records": """
         insert into documents_charityfinancialyear (
@@ -78,7 +108,15 @@ UPDATE_SQL = {
         where total_income <> 0 or total_spending <> 0
         ON CONFLICT(charity_id, financial_year_end) DO UPDATE
         SET income = excluded.income,
-            expenditure = excluded.expenditure
+            expenditure = excluded.expenditure,
+            updated_at = excluded.updated_at
+        WHERE (
+            documents_charityfinancialyear.income,
+            documents_charityfinancialyear.expenditure
+        ) IS DISTINCT FROM (
+            excluded.income,
+            excluded.expenditure
+        )
     """,
     "Insert updated OSCR records": """
         insert into documents_charity 
@@ -96,6 +134,15 @@ UPDATE_SQL = {
             date_removed = excluded.date_removed,
             created_at = documents_charity.created_at,
             updated_at = excluded.updated_at
+        WHERE (
+            documents_charity.name,
+            documents_charity.date_registered,
+            documents_charity.date_removed
+        ) IS DISTINCT FROM (
+            excluded.name,
+            excluded.date_registered,
+            excluded.date_removed
+        )
     """,
     "Insert OSCR financial records": """
         insert into documents_charityfinancialyear (
@@ -118,7 +165,17 @@ UPDATE_SQL = {
         ON CONFLICT(charity_id, financial_year_end) DO UPDATE
         SET income = excluded.income,
             expenditure = excluded.expenditure,
-            document_submitted = excluded.document_submitted
+            document_submitted = excluded.document_submitted,
+            updated_at = excluded.updated_at
+        WHERE (
+            documents_charityfinancialyear.income,
+            documents_charityfinancialyear.expenditure,
+            documents_charityfinancialyear.document_submitted
+        ) IS DISTINCT FROM (
+            excluded.income,
+            excluded.expenditure,
+            excluded.document_submitted
+        )
     """,
 }
 
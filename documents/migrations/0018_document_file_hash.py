@@ -0,0 +1,23 @@
+# Generated by Django 5.1.6 on 2026-10-18 09:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("documents", "0017_alter_charity_source_and_more"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="document",
+            name="file_hash",
+            field=models.CharField(
+                blank=True,
+                db_index=True,
+                help_text="SHA-256 hash of the PDF file as it was supplied",
+                max_length=64,
+                null=True,
+            ),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.1.6 on 2026-10-18 10:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("documents", "0018_document_file_hash"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="document",
+            name="extractor",
+            field=models.CharField(
+                blank=True,
+                help_text="Backend used to get the text from the PDF",
+                max_length=50,
+                null=True,
+            ),
+        ),
+        migrations.AddField(
+            model_name="document",
+            name="extractor_version",
+            field=models.CharField(blank=True, max_length=50, null=True),
+        ),
+    ]
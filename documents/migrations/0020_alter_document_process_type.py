@@ -0,0 +1,27 @@
+# Generated by Django 5.1.6 on 2026-10-18 10:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("documents", "0019_document_extractor"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="document",
+            name="process_type",
+            field=models.CharField(
+                blank=True,
+                choices=[
+                    ("AS", "As supplied"),
+                    ("OCR", "OCR"),
+                    ("POC", "OCR on some pages"),
+                ],
+                default=None,
+                max_length=3,
+                null=True,
+            ),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.1.6 on 2026-10-18 11:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("documents", "0020_alter_document_process_type"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="document",
+            name="page_offsets",
+            field=models.JSONField(
+                blank=True,
+                help_text="Start and end of the text of each page in the content, or null for pages without text",
+                null=True,
+            ),
+        ),
+    ]
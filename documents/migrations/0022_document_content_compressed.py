@@ -0,0 +1,19 @@
+# Generated by Django 5.1.6 on 2026-10-18 11:52
+
+from django.db import migrations
+
+import documents.fields
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("documents", "0021_document_page_offsets"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="document",
+            name="content_compressed",
+            field=documents.fields.CompressedTextField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,53 @@
+from django.db import migrations
+
+BATCH_SIZE = 100
+
+
+def migrate_data_forward(apps, schema_editor):
+    Document = apps.get_model("documents", "Document")
+    documents = (
+        Document.objects.filter(content__isnull=False)
+        .only("id", "content")
+        .iterator(chunk_size=BATCH_SIZE)
+    )
+    batch = []
+    for document in documents:
+        document.content_compressed = document.content
+        batch.append(document)
+        if len(batch) >= BATCH_SIZE:
+            Document.objects.bulk_update(batch, ["content_compressed"])
+            batch = []
+    if batch:
+        Document.objects.bulk_update(batch, ["content_compressed"])
+
+
+def migrate_data_backward(apps, schema_editor):
+    Document = apps.get_model("documents", "Document")
+    documents = (
+        Document.objects.filter(content_compressed__isnull=False)
+        .only("id", "content_compressed")
+        .iterator(chunk_size=BATCH_SIZE)
+    )
+    batch = []
+    for document in documents:
+        document.content = document.content_compressed
+        batch.append(document)
+        if len(batch) >= BATCH_SIZE:
+            Document.objects.bulk_update(batch, ["content"])
+            batch = []
+    if batch:
+        Document.objects.bulk_update(batch, ["content"])
+
+
+class Migration(migrations.Migration):
+    # compressing every document takes a while, so don't do it all in one
+    # transaction
+    atomic = False
+
+    dependencies = [
+        ("documents", "0022_document_content_compressed"),
+    ]
+
+    operations = [
+        migrations.RunPython(migrate_data_forward, migrate_data_backward),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.1.6 on 2026-10-18 11:55
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("documents", "0023_compress_document_content"),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name="document",
+            name="content",
+        ),
+        migrations.RenameField(
+            model_name="document",
+            old_name="content_compressed",
+            new_name="content",
+        ),
+    ]
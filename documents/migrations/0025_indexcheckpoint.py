@@ -0,0 +1,38 @@
+# Generated by Django 5.1.6 on 2026-10-18 15:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("documents", "0024_replace_document_content"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="IndexCheckpoint",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("name", models.CharField(max_length=100, unique=True)),
+                (
+                    "indexed_until",
+                    models.DateTimeField(
+                        help_text="Documents changed before this time are in the search index"
+                    ),
+                ),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                "verbose_name": "index checkpoint",
+                "verbose_name_plural": "index checkpoints",
+            },
+        ),
+    ]
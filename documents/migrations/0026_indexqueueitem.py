@@ -0,0 +1,41 @@
+# Generated by Django 5.1.6 on 2026-10-18 15:40
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("documents", "0025_indexcheckpoint"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="IndexQueueItem",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("queued_at", models.DateTimeField(db_index=True)),
+                ("attempts", models.IntegerField(default=0)),
+                (
+                    "document",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="index_queue_item",
+                        to="documents.document",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "index queue item",
+                "verbose_name_plural": "index queue items",
+            },
+        ),
+    ]
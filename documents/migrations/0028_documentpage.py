@@ -0,0 +1,50 @@
+# Generated by Django 5.1.6 on 2026-10-18 19:10
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+import documents.fields
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("documents", "0027_charity_updated_at_index_and_more"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="DocumentPage",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "page",
+                    models.IntegerField(help_text="Page number, starting from 0"),
+                ),
+                (
+                    "content",
+                    documents.fields.CompressedTextField(blank=True, null=True),
+                ),
+                (
+                    "document",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="page_texts",
+                        to="documents.document",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "document page",
+                "verbose_name_plural": "document pages",
+                "unique_together": {("document", "page")},
+            },
+        ),
+    ]
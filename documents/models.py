@@ -1,13 +1,38 @@
+import re
 import uuid
 
 from autoslug import AutoSlugField
 from charity_django.utils.text import to_titlecase
-from django.db import models
+from django.db import models, transaction
 from django.urls import reverse
 from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 from django_q.tasks import Task, count_group, fetch_group
 
+from documents.fields import CompressedTextField
+
+
+PAGE_MARKER_REGEX = re.compile(r"<span id='page-(\d+)'></span>\n")
+
+
+def parse_page_offsets(content, pages=None):
+    """
+    Work out the start and end of the text of each page from the page markers
+    in a document's content.
+    """
+    markers = list(PAGE_MARKER_REGEX.finditer(content))
+    if pages is None:
+        pages = int(markers[-1].group(1)) + 1 if markers else 0
+    offsets = [None] * pages
+    for i, marker in enumerate(markers):
+        page = int(marker.group(1))
+        if page >= pages:
+            continue
+        # pages are separated by a blank line
+        end = markers[i + 1].start() - 2 if i + 1 < len(markers) else len(content)
+        offsets[page] = [marker.end(), end]
+    return offsets
+
 
 class Regulators(models.TextChoices):
     CCEW = "CCEW", _("Charity Commission for England and Wales")
@@ -43,7 +68,7 @@ class Charity(models.Model):
     date_registered = models.DateField(null=True, blank=True)
     date_removed = models.DateField(null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
-    updated_at = models.DateTimeField(auto_now=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
 
     tags = models.ManyToManyField(Tag, blank=True, related_name="charities")
 
@@ -110,7 +135,10 @@ class FetchGroup(models.Model):
                             break
                         yield task, fy
                         continue
-                    except CharityFinancialYear.DoesNotExist:
+                    except (
+                        CharityFinancialYear.DoesNotExist,
+                        CharityFinancialYear.MultipleObjectsReturned,
+                    ):
                         pass
                 count += 1
                 if limit and count > limit:
@@ -133,7 +161,7 @@ class CharityFinancialYear(models.Model):
     expenditure = models.BigIntegerField(blank=True, null=True)
     last_document_fetch_started = models.DateTimeField(blank=True, null=True)
     created_at = models.DateTimeField(auto_now_add=True)
-    updated_at = models.DateTimeField(auto_now=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
     status = models.CharField(
         max_length=15,
         choices=DocumentStatus.choices,
@@ -182,6 +210,21 @@ class CharityFinancialYear(models.Model):
         )
 
 
+class DocumentQuerySet(models.QuerySet):
+    def with_content(self):
+        """
+        Also load the text of the documents, which isn't loaded by default
+        """
+        return self.defer(None)
+
+
+class DocumentManager(models.Manager.from_queryset(DocumentQuerySet)):
+    def get_queryset(self):
+        # the content can be megabytes for each document, so it's only loaded
+        # when it's used or asked for with `with_content()`
+        return super().get_queryset().defer("content")
+
+
 class Document(models.Model):
     class DocumentTypes(models.TextChoices):
         PDF = "application/pdf", _("PDF")
@@ -192,11 +235,12 @@ class Document(models.Model):
     class DocumentProcessType(models.TextChoices):
         AS_SUPPLIED = "AS", _("As supplied")
         OCR = "OCR", _("OCR")
+        PARTIAL_OCR = "POC", _("OCR on some pages")
 
     financial_year = models.ForeignKey(
         CharityFinancialYear, on_delete=models.CASCADE, related_name="documents"
     )
-    content = models.TextField(blank=True, null=True)
+    content = CompressedTextField(blank=True, null=True)
     content_length = models.IntegerField(blank=True, null=True)
     content_type = models.CharField(
         max_length=50,
@@ -213,8 +257,28 @@ class Document(models.Model):
         null=True,
     )
     pages = models.IntegerField(blank=True, null=True)
+    page_offsets = models.JSONField(
+        blank=True,
+        null=True,
+        help_text="Start and end of the text of each page in the content, "
+        "or null for pages without text",
+    )
     file = models.FileField(upload_to="accounts/pdf", blank=True, null=True)
     file_text = models.FileField(upload_to="accounts/txt", blank=True, null=True)
+    file_hash = models.CharField(
+        max_length=64,
+        blank=True,
+        null=True,
+        db_index=True,
+        help_text="SHA-256 hash of the PDF file as it was supplied",
+    )
+    extractor = models.CharField(
+        max_length=50,
+        blank=True,
+        null=True,
+        help_text="Backend used to get the text from the PDF",
+    )
+    extractor_version = models.CharField(max_length=50, blank=True, null=True)
     process_type = models.CharField(
         max_length=3,
         choices=DocumentProcessType.choices,
@@ -226,10 +290,149 @@ class Document(models.Model):
     tags = models.ManyToManyField(Tag, blank=True, related_name="documents")
 
     created_at = models.DateTimeField(auto_now_add=True)
-    updated_at = models.DateTimeField(auto_now=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+
+    objects = DocumentManager()
 
     def __str__(self):
         return self.financial_year.__str__()
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        document = super().from_db(db, field_names, values)
+        # used to tell whether the content has changed when it's saved
+        document._saved_content = document.__dict__.get("content")
+        return document
+
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get("update_fields")
+        content_changed = (
+            "content" not in self.get_deferred_fields()
+            and (update_fields is None or "content" in update_fields)
+            and self.content != getattr(self, "_saved_content", None)
+        )
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            if content_changed:
+                self.save_pages()
+        self._saved_content = self.content
+
+    def save_pages(self):
+        """
+        Store the text of each page separately (see `DocumentPage`), so that
+        one page can be shown without loading the whole content.
+        """
+        self.page_texts.all().delete()
+        if not self.content:
+            return
+        DocumentPage.objects.bulk_create(
+            [
+                DocumentPage(
+                    document=self,
+                    page=page,
+                    content=self.content[offsets[0] : offsets[1]],
+                )
+                for page, offsets in enumerate(self.get_page_offsets())
+                if offsets
+            ],
+            batch_size=100,
+        )
+
     def get_absolute_url(self):
         return reverse("doc.doc_get", kwargs={"id": self.id})
+
+    def get_page_offsets(self):
+        """
+        Start and end of the text of each page in the content.
+
+        Documents processed before `page_offsets` was added have them worked
+        out from the page markers in the content.
+        """
+        if self.page_offsets is not None:
+            return self.page_offsets
+        if not self.content:
+            return []
+        return parse_page_offsets(self.content, self.pages)
+
+    def get_page(self, page):
+        """
+        Get the text of one page (numbered from 0).
+
+        The page is loaded on its own from `DocumentPage` unless the content
+        has already been loaded. Documents saved before pages were stored
+        separately fall back to the page's part of the content.
+        """
+        if "content" in self.get_deferred_fields() and self.page_offsets:
+            if page < 0 or page >= len(self.page_offsets):
+                raise IndexError("Page {} not found".format(page))
+            if self.page_offsets[page] is None:
+                return ""
+            text = (
+                self.page_texts.filter(page=page)
+                .values_list("content", flat=True)
+                .first()
+            )
+            if text is not None:
+                return text
+
+        offsets = self.get_page_offsets()
+        if page < 0 or page >= len(offsets):
+            raise IndexError("Page {} not found".format(page))
+        if offsets[page] is None:
+            return ""
+        start, end = offsets[page]
+        return self.content[start:end]
+
+
+class DocumentPage(models.Model):
+    """
+    The text of one page of a document, which is also part of its content.
+    Pages without text aren't stored.
+    """
+
+    document = models.ForeignKey(
+        Document, on_delete=models.CASCADE, related_name="page_texts"
+    )
+    page = models.IntegerField(help_text="Page number, starting from 0")
+    content = CompressedTextField(blank=True, null=True)
+
+    class Meta:
+        verbose_name = _("document page")
+        verbose_name_plural = _("document pages")
+        unique_together = (
+            "document",
+            "page",
+        )
+
+    def __str__(self):
+        return "{} [page {}]".format(self.document_id, self.page)
+
+
+class IndexCheckpoint(models.Model):
+    name = models.CharField(max_length=100, unique=True)
+    indexed_until = models.DateTimeField(
+        help_text="Documents changed before this time are in the search index"
+    )
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = _("index checkpoint")
+        verbose_name_plural = _("index checkpoints")
+
+    def __str__(self):
+        return "{} [{}]".format(self.name, self.indexed_until)
+
+
+class IndexQueueItem(models.Model):
+    document = models.OneToOneField(
+        Document, on_delete=models.CASCADE, related_name="index_queue_item"
+    )
+    queued_at = models.DateTimeField(db_index=True)
+    attempts = models.IntegerField(default=0)
+
+    class Meta:
+        verbose_name = _("index queue item")
+        verbose_name_plural = _("index queue items")
+
+    def __str__(self):
+        return "{} [{}]".format(self.document_id, self.queued_at)
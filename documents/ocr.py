@@ -0,0 +1,197 @@
+"""
+Run OCR in a separate process, with limits on how long it can take and how
+much memory it can use.
+
+Only `settings.OCR_SLOTS` OCR jobs run at the same time on a server, however
+many workers there are. Each job runs the ocrmypdf command line in its own
+process (and ocrmypdf runs tesseract and ghostscript in their own processes),
+which is killed if it runs for longer than `settings.OCR_TIMEOUT` seconds or
+the processes use more than `settings.OCR_MAX_MEMORY` bytes between them. The
+OCRed PDF is written to a temporary file rather than held in memory.
+"""
+
+import fcntl
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+
+import ocrmypdf
+import psutil
+from django.conf import settings
+
+from documents.exceptions import (
+    OCRError,
+    OCRMemoryExceeded,
+    OCRSlotUnavailable,
+    OCRTimeout,
+)
+
+# how often (seconds) to check on the OCR process and to look for a free slot
+POLL_INTERVAL = 0.5
+
+# size of the chunks copied when writing the PDF to disk
+CHUNK_SIZE = 1024 * 1024
+
+
+@contextmanager
+def ocr_slot():
+    """
+    Wait for one of the OCR slots to be free, and hold it.
+
+    The slots are lock files shared by all the processes on the server. If
+    none is free after `settings.OCR_SLOT_TIMEOUT` seconds `OCRSlotUnavailable`
+    is raised, so that the OCR can be tried again later.
+    """
+    os.makedirs(settings.OCR_LOCK_DIR, exist_ok=True)
+    started = time.monotonic()
+    while True:
+        for slot in range(settings.OCR_SLOTS):
+            lock_file = open(
+                os.path.join(settings.OCR_LOCK_DIR, "ocr-slot-{}.lock".format(slot)),
+                "w",
+            )
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                lock_file.close()
+                continue
+            try:
+                yield slot
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+                lock_file.close()
+            return
+        if time.monotonic() - started > settings.OCR_SLOT_TIMEOUT:
+            raise OCRSlotUnavailable(
+                "No OCR slot free after {:,.0f} seconds".format(
+                    settings.OCR_SLOT_TIMEOUT
+                )
+            )
+        time.sleep(POLL_INTERVAL)
+
+
+def get_ocrmypdf_args(options):
+    """
+    Turn keyword arguments for `ocrmypdf.ocr` into command line arguments
+    """
+    args = []
+    for key, value in options.items():
+        arg = "--" + key.replace("_", "-")
+        if value is True:
+            args.append(arg)
+        elif value is False or value is None:
+            continue
+        else:
+            args.extend([arg, str(value)])
+    return args
+
+
+def get_memory_usage(process):
+    """
+    Resident memory used by a process and all its children
+    """
+    try:
+        processes = [process] + process.children(recursive=True)
+    except psutil.NoSuchProcess:
+        return 0
+    memory = 0
+    for p in processes:
+        try:
+            memory += p.memory_info().rss
+        except psutil.NoSuchProcess:
+            continue
+    return memory
+
+
+def kill_process_tree(process):
+    try:
+        processes = process.children(recursive=True) + [process]
+    except psutil.NoSuchProcess:
+        return
+    for p in processes:
+        try:
+            p.kill()
+        except psutil.NoSuchProcess:
+            continue
+    psutil.wait_procs(processes, timeout=10)
+
+
+def run_ocrmypdf(input_path, output_path, options):
+    """
+    Run ocrmypdf in a new process, killing it if it goes over the time or
+    memory limits. Returns the exit code and the end of the error output.
+    """
+    with tempfile.TemporaryFile() as stderr:
+        process = subprocess.Popen(
+            [sys.executable, "-m", "ocrmypdf"]
+            + get_ocrmypdf_args(options)
+            + [input_path, output_path],
+            stdout=subprocess.DEVNULL,
+            stderr=stderr,
+        )
+        ps_process = psutil.Process(process.pid)
+        started = time.monotonic()
+        try:
+            while process.poll() is None:
+                if time.monotonic() - started > settings.OCR_TIMEOUT:
+                    raise OCRTimeout(
+                        "OCR took longer than {:,.0f} seconds".format(
+                            settings.OCR_TIMEOUT
+                        )
+                    )
+                memory = get_memory_usage(ps_process)
+                if memory > settings.OCR_MAX_MEMORY:
+                    raise OCRMemoryExceeded(
+                        "OCR used more than {:,.0f}MB of memory".format(
+                            settings.OCR_MAX_MEMORY / (1024 * 1024)
+                        )
+                    )
+                time.sleep(POLL_INTERVAL)
+        except OCRError:
+            kill_process_tree(ps_process)
+            process.wait()
+            raise
+
+        stderr.seek(0)
+        error_output = stderr.read().decode("utf-8", errors="replace")
+    return process.returncode, error_output[-1000:]
+
+
+def ocr_file(source, options):
+    """
+    OCR a PDF file in a separate process.
+
+    Returns the OCRed PDF as an open temporary file, or None if the PDF has
+    already been OCRed.
+    """
+    with tempfile.TemporaryDirectory(prefix="ocr-") as tmpdir:
+        input_path = os.path.join(tmpdir, "input.pdf")
+        output_path = os.path.join(tmpdir, "output.pdf")
+        source.seek(0)
+        with open(input_path, "wb") as f:
+            for chunk in iter(lambda: source.read(CHUNK_SIZE), b""):
+                f.write(chunk)
+
+        with ocr_slot() as slot:
+            logging.info("OCRing PDF (slot {})".format(slot))
+            started = time.monotonic()
+            returncode, error_output = run_ocrmypdf(input_path, output_path, options)
+
+        if returncode == ocrmypdf.ExitCode.already_done_ocr:
+            logging.info("PDF already OCR'd")
+            return None
+        if returncode == ocrmypdf.ExitCode.encrypted_pdf:
+            logging.info("PDF is encrypted")
+            raise ocrmypdf.exceptions.EncryptedPdfError()
+        if returncode != ocrmypdf.ExitCode.ok:
+            raise OCRError(
+                "OCR failed with exit code {}: {}".format(returncode, error_output)
+            )
+        logging.info("PDF OCRed in {:,.0f} seconds".format(time.monotonic() - started))
+
+        # the file can still be read once the directory has been removed
+        return open(output_path, "rb")
@@ -0,0 +1,364 @@
+"""
+Stages for processing a document once its PDF has been downloaded:
+
+    download (`documents.fetch.fetch_account`) -> extract -> ocr -> index
+
+If `settings.DOCUMENT_PIPELINE_ENABLED` is set each stage is queued as a
+separate task on its own cluster (see `ALT_CLUSTERS` in `Q_CLUSTER`), so
+that downloads don't wait behind OCR and a failed stage can be retried
+without repeating the earlier stages. Each stage saves the document once.
+
+Otherwise the text is extracted (and the PDF OCRed) by `process_document`
+in the download task before anything is saved, so the document is saved
+once with its final PDF and text.
+
+Either way the document is then added to the indexing queue, which sends
+documents to Elasticsearch in batches (see `documents.indexing`).
+"""
+
+import datetime
+import logging
+import random
+import tempfile
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.files.base import File
+from django.utils import timezone
+from django_q.models import Schedule
+from django_q.tasks import async_task, schedule
+
+from documents.exceptions import OCRPending, OCRSlotUnavailable
+from documents.extractors import get_extractor
+from documents.indexing import enqueue_documents
+from documents.models import CharityFinancialYear, Document, DocumentStatus
+from documents.utils import (
+    build_content,
+    do_document_ocr,
+    PageTextWriter,
+    extract_text,
+    get_ocr_pages,
+    set_stored_file,
+    write_text,
+)
+
+EXTRACT = "extract"
+OCR = "ocr"
+INDEX = "index"
+
+AS_SUPPLIED = Document.DocumentProcessType.AS_SUPPLIED
+PARTIAL_OCR = Document.DocumentProcessType.PARTIAL_OCR
+OCR_ALL = Document.DocumentProcessType.OCR
+
+
+@contextmanager
+def document_file(document, rate_limiter=None):
+    """
+    Open a document's PDF from storage.
+
+    If a `rate_limiter` is given it is used to limit how fast (in bytes per
+    second) the file is read.
+    """
+    spool = tempfile.SpooledTemporaryFile(max_size=settings.DOWNLOAD_SPOOL_MAX_MEMORY)
+    try:
+        with document.file.open("rb") as f:
+            for chunk in f.chunks():
+                if rate_limiter:
+                    rate_limiter.acquire(len(chunk))
+                spool.write(chunk)
+        spool.seek(0)
+        yield spool
+    finally:
+        spool.close()
+
+
+def set_financial_year_status(document, status, notes=None):
+    CharityFinancialYear.objects.filter(id=document.financial_year_id).update(
+        status=status, status_notes=notes, updated_at=timezone.now()
+    )
+
+
+def set_document_content(document, filedata, process_type):
+    document.content = filedata["content"]
+    # the text is uploaded from the file it was written to while extracting
+    set_stored_file(document, "file_text", filedata["file_text"], "txt")
+    document.content_length = filedata["content_length"]
+    document.pages = filedata["pages"]
+    document.page_offsets = filedata["page_offsets"]
+    document.content_type = filedata["content_type"]
+    document.language = filedata["language"]
+    document.extractor = filedata["extractor"]
+    document.extractor_version = filedata["extractor_version"]
+    document.process_type = process_type
+
+
+def clear_document_content(document):
+    """
+    Remove a document's text, for when getting the text from its PDF failed.
+    """
+    document.content = None
+    document.file_text = None
+    document.content_length = None
+    document.pages = None
+    document.page_offsets = None
+    document.extractor = None
+    document.extractor_version = None
+    document.process_type = None
+
+
+def ocr_sparse_pages(document, pdf_file, writer, extractor, pages=None):
+    """
+    OCR the pages of a PDF that have little or no text, and merge the OCR
+    text back in with the text of the other pages.
+
+    `writer` is the `PageTextWriter` the text of the PDF was written to, and
+    `pages` the pages to OCR (chosen with `get_ocr_pages` if not given).
+    Returns the content of the PDF, the process type, and the new version of
+    the PDF. The PDF is only replaced if at least
+    `settings.OCR_REPLACE_FILE_RATIO` of its pages were OCRed, otherwise (or
+    if no pages were OCRed) None is returned instead.
+    """
+    if pages is None:
+        pages = get_ocr_pages(pdf_file, writer)
+    if not pages:
+        return build_content(writer, extractor), AS_SUPPLIED, None
+
+    logging.info("OCRing {:,.0f} of {:,.0f} pages".format(len(pages), writer.pages))
+    pdf_file.seek(0)
+    new_file = do_document_ocr(pdf_file, pages)
+    if not new_file:
+        return build_content(writer, extractor), AS_SUPPLIED, None
+    new_file = File(new_file, name=document.financial_year.document_filename)
+
+    ocr_texts, extractor = extract_text(new_file, pages)
+    ocr_writer = writer.replace_pages(dict(zip(pages, ocr_texts)))
+    writer.close()
+    process_type = PARTIAL_OCR if len(pages) < ocr_writer.pages else OCR_ALL
+    if len(pages) < ocr_writer.pages * settings.OCR_REPLACE_FILE_RATIO:
+        # keep the PDF as it was supplied - the OCR text is in the content
+        new_file.close()
+        new_file = None
+    return build_content(ocr_writer, extractor), process_type, new_file
+
+
+def process_document(document, pdf_file):
+    """
+    Get the text from a PDF (using OCR for any pages without enough text) and
+    set the document's content, and its file if it was OCRed.
+
+    Nothing is saved, so that the document can be saved once with the final
+    version of the PDF and its text.
+
+    If all the OCR slots are busy the text that was extracted (if any) is set
+    and `OCRPending` is raised, so that just the OCR can be done later.
+    """
+    logging.info(
+        "Getting text from PDF file {}".format(
+            document.financial_year.document_filename
+        )
+    )
+    pdf_file.seek(0)
+    writer, extractor = write_text(pdf_file.file)
+    pages = get_ocr_pages(pdf_file.file, writer)
+    try:
+        filedata, process_type, new_file = ocr_sparse_pages(
+            document, pdf_file.file, writer, extractor, pages
+        )
+    except OCRSlotUnavailable as e:
+        if writer.content_length:
+            set_document_content(
+                document, build_content(writer, extractor), AS_SUPPLIED
+            )
+        else:
+            writer.close()
+            clear_document_content(document)
+        raise OCRPending(pages, writer.pages, extractor.name, e) from e
+    if new_file:
+        set_stored_file(document, "file", new_file, "pdf")
+    set_document_content(document, filedata, process_type)
+    logging.info(
+        "PDF file fetched pages: {:,.0f} size: {:,.0f} ({})".format(
+            document.pages, document.content_length, process_type
+        )
+    )
+    return document
+
+
+def extract_document(document):
+    """
+    Get the text from a document's PDF, then pass it on to OCR if any pages
+    don't have enough text, or to be indexed.
+    """
+    logging.info(
+        "Getting text from PDF file {}".format(
+            document.financial_year.document_filename
+        )
+    )
+    with document_file(document) as pdf_file:
+        writer, extractor = write_text(pdf_file)
+        ocr_pages = get_ocr_pages(pdf_file, writer)
+    page_count = writer.pages
+    if ocr_pages and not writer.content_length:
+        # nothing to save until the pages have been OCRed
+        writer.close()
+    else:
+        # the text is saved (and indexed) now, so the OCR stage only needs to
+        # get the text of the pages it OCRs
+        with writer.file:
+            set_document_content(
+                document, build_content(writer, extractor), AS_SUPPLIED
+            )
+            document.save()
+        set_financial_year_status(document, DocumentStatus.SUCCESS)
+        logging.info(
+            "PDF file fetched pages: {:,.0f} size: {:,.0f}".format(
+                document.pages, document.content_length
+            )
+        )
+        queue_stage(INDEX, document)
+    if ocr_pages:
+        return queue_stage(
+            OCR,
+            document,
+            pages=ocr_pages,
+            page_count=page_count,
+            extractor=extractor.name,
+        )
+
+
+def ocr_document(document, pages=None, page_count=None, extractor=None):
+    """
+    OCR the pages of a document's PDF that don't have enough text, and
+    replace the text (and the PDF, if enough pages were OCRed) with the OCR
+    version.
+
+    `pages` are the pages to OCR, found by the extract stage, which also
+    saved the text of the other pages (if there was any) so that it doesn't
+    need to be extracted again. `page_count` is the number of pages in the
+    PDF and `extractor` the name of the extractor used.
+    """
+    with document_file(document) as pdf_file:
+        if pages is None:
+            writer, extractor = write_text(pdf_file)
+        else:
+            writer = PageTextWriter.from_content(
+                document.content or "",
+                document.get_page_offsets() or [None] * page_count,
+            )
+            extractor = get_extractor(extractor)
+        filedata, process_type, new_file = ocr_sparse_pages(
+            document, pdf_file, writer, extractor, pages
+        )
+    if new_file:
+        set_stored_file(document, "file", new_file, "pdf")
+    with filedata["file_text"]:
+        set_document_content(document, filedata, process_type)
+        document.save()
+    set_financial_year_status(document, DocumentStatus.SUCCESS)
+    logging.info(
+        "PDF file OCR pages: {:,.0f} size: {:,.0f} ({})".format(
+            document.pages, document.content_length, process_type
+        )
+    )
+    return queue_stage(INDEX, document)
+
+
+STAGES = {
+    EXTRACT: extract_document,
+    OCR: ocr_document,
+}
+
+
+def queue_stage(stage, document, attempt=1, **kwargs):
+    """
+    Start a stage for a document, passing any keyword arguments on to it.
+
+    Documents to index are added to the indexing queue rather than run as a
+    stage. Otherwise, when the pipeline is enabled the stage is queued on the
+    stage's cluster, or if not it is run straight away.
+    """
+    if stage == INDEX:
+        # documents are indexed in batches
+        return enqueue_documents([document.id])
+
+    if settings.DOCUMENT_PIPELINE_ENABLED:
+        return async_task(
+            run_stage,
+            stage,
+            document.id,
+            attempt=attempt,
+            cluster=settings.DOCUMENT_PIPELINE_CLUSTERS[stage],
+            **kwargs,
+        )
+    return STAGES[stage](document, **kwargs)
+
+
+def defer_stage(stage, document, error, attempt=1, **kwargs):
+    """
+    Run a stage for a document again later, for when it couldn't run now
+    because all the OCR slots were busy (this doesn't count as an attempt).
+    """
+    next_run = timezone.now() + datetime.timedelta(
+        seconds=settings.OCR_RETRY_DELAY * random.uniform(1, 2)
+    )
+    schedule(
+        "documents.pipeline.run_stage",
+        stage,
+        document.id,
+        attempt=attempt,
+        schedule_type=Schedule.ONCE,
+        next_run=next_run,
+        cluster=(
+            settings.DOCUMENT_PIPELINE_CLUSTERS[stage]
+            if settings.DOCUMENT_PIPELINE_ENABLED
+            else None
+        ),
+        **kwargs,
+    )
+    logging.info(
+        "Stage {} for document {} deferred until {:%Y-%m-%d %H:%M}: {}".format(
+            stage, document.id, next_run, error
+        )
+    )
+
+
+def run_stage(stage, document_id, attempt=1, **kwargs):
+    """
+    Task for running a stage of the pipeline.
+
+    If the stage fails it is queued again, up to
+    `settings.DOCUMENT_PIPELINE_MAX_ATTEMPTS` times. If extracting or OCRing
+    the document fails every time its financial year is marked as failed. If
+    the OCR slots are all busy the stage is run again later.
+    """
+    documents = Document.objects.select_related("financial_year__charity")
+    if stage == OCR:
+        documents = documents.with_content()
+    document = documents.get(id=document_id)
+    try:
+        return STAGES[stage](document, **kwargs)
+    except OCRSlotUnavailable as e:
+        defer_stage(stage, document, e, attempt, **kwargs)
+    except Exception as e:
+        if attempt < settings.DOCUMENT_PIPELINE_MAX_ATTEMPTS:
+            logging.warning(
+                "Stage {} failed for document {} (attempt {}): {}".format(
+                    stage, document_id, attempt, e
+                )
+            )
+            queue_stage(stage, document, attempt=attempt + 1, **kwargs)
+        elif stage == OCR and document.content_length:
+            # the text of the pages that didn't need OCR was saved and indexed
+            set_financial_year_status(
+                document,
+                DocumentStatus.SUCCESS,
+                "Pages could not be OCRed: {}".format(e),
+            )
+        else:
+            # the document has no text, so the fetch needs trying again
+            set_financial_year_status(
+                document,
+                DocumentStatus.FAILED,
+                "Stage {} failed after {} attempts: {}".format(stage, attempt, e),
+            )
+        raise
@@ -0,0 +1,102 @@
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket rate limiter.
+
+    Tokens are added at `rate` per second, up to a maximum of `capacity`.
+    Callers take tokens with `acquire`, which blocks until the tokens they
+    asked for are available. Requests beyond the available tokens reserve
+    their place in the queue, so waiting callers are served in order.
+    """
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.updated_at) * self.rate
+            )
+            self.updated_at = now
+            self.tokens -= tokens
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            logging.debug("Rate limited - waiting {:.1f} seconds".format(wait))
+            time.sleep(wait)
+        return wait
+
+
+class SharedTokenBucket:
+    """
+    Token bucket rate limiter shared between processes through the cache.
+
+    Works like `TokenBucket`, but the state is kept in the cache (as the
+    time the next request is allowed, so only one value needs updating) so
+    that every worker process draws from the same bucket. Updates are
+    serialised with a short-lived lock in the cache - if the lock can't be
+    taken the request goes ahead rather than holding up the fetch.
+    """
+
+    def __init__(self, name, rate, capacity=1):
+        self.name = name
+        self.rate = rate
+        self.capacity = capacity
+        self.cache_key = "rate-limit:{}".format(name)
+        self.lock_key = "rate-limit-lock:{}".format(name)
+
+    def _lock(self):
+        deadline = time.monotonic() + settings.FETCH_RATE_LIMIT_LOCK_TIMEOUT
+        while time.monotonic() < deadline:
+            if cache.add(self.lock_key, True, settings.FETCH_RATE_LIMIT_LOCK_TIMEOUT):
+                return True
+            time.sleep(0.01)
+        logging.warning("Could not lock rate limiter for {}".format(self.name))
+        return False
+
+    def acquire(self, tokens=1):
+        interval = tokens / self.rate
+        locked = self._lock()
+        try:
+            now = time.time()
+            next_allowed = max(cache.get(self.cache_key, now), now) + interval
+            wait = max(next_allowed - self.capacity / self.rate - now, 0)
+            cache.set(self.cache_key, next_allowed, int(next_allowed - now) + 60)
+        finally:
+            if locked:
+                cache.delete(self.lock_key)
+        if wait:
+            logging.debug("Rate limited - waiting {:.1f} seconds".format(wait))
+            time.sleep(wait)
+        return wait
+
+
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(name):
+    """
+    Get the rate limiter for a regulator (eg "ccew").
+
+    Limiters are shared by every thread and worker process (through the
+    cache), using the limits set in `settings.FETCH_RATE_LIMITS`.
+    """
+    with _rate_limiters_lock:
+        if name not in _rate_limiters:
+            limits = settings.FETCH_RATE_LIMITS.get(
+                name, settings.FETCH_RATE_LIMITS["default"]
+            )
+            _rate_limiters[name] = SharedTokenBucket(name, **limits)
+        return _rate_limiters[name]
@@ -0,0 +1,58 @@
+import logging
+import time
+
+from django.conf import settings
+from django.core.files.base import File
+
+from documents.models import Document
+from documents.pipeline import INDEX, document_file, process_document, queue_stage
+from documents.ratelimit import TokenBucket
+
+# limits reads from storage in each reprocessing process (see `init_worker`)
+_read_rate_limiter = None
+
+
+def init_worker(read_rate=None):
+    """
+    Set up a process for reprocessing documents.
+
+    `read_rate` is the number of bytes per second the process can read from
+    storage (None for no limit).
+    """
+    global _read_rate_limiter
+    # documents are already being processed in parallel, so the pages of
+    # each document don't need to be
+    settings.PDF_EXTRACT_WORKERS = 1
+    if read_rate:
+        # allow a burst of a few seconds' reading
+        _read_rate_limiter = TokenBucket(read_rate, capacity=read_rate * 5)
+
+
+def reprocess_document(document_id, index=True):
+    """
+    Extract the text from a document's PDF again (and OCR any pages without
+    enough text), saving the document once with the new content.
+
+    Returns `(document_id, pages, bytes_read, error)`, so that one failed
+    document doesn't stop the rest.
+    """
+    try:
+        document = Document.objects.select_related("financial_year__charity").get(
+            id=document_id
+        )
+        started = time.monotonic()
+        with document_file(document, _read_rate_limiter) as pdf_file:
+            bytes_read = pdf_file.seek(0, 2)
+            process_document(document, File(pdf_file, name=document.file.name))
+            document.save()
+        logging.info(
+            "Document {} reprocessed in {:,.1f} seconds".format(
+                document.id, time.monotonic() - started
+            )
+        )
+        if index:
+            queue_stage(INDEX, document)
+        return document_id, document.pages, bytes_read, None
+    except Exception as e:
+        logging.error("Could not reprocess document {}: {}".format(document_id, e))
+        return document_id, 0, 0, str(e)
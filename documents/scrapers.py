@@ -4,9 +4,9 @@ from collections import namedtuple
 
 import dateutil.parser
 from charity_django.ccew.models import Charity as CCEWCharity
-from requests_html import HTMLSession
 
 from documents.exceptions import CharityFetchError
+from documents.http import get_session
 
 Account = namedtuple("Account", ["url", "fyend", "regno", "size"], defaults=[None])
 
@@ -27,10 +27,12 @@ class CCEW:
             raise CharityFetchError("Charity {} not found".format(regno))
         return self.url_base.format(org_details.organisation_number)
 
-    def list_accounts(self, regno: str, session=HTMLSession()) -> list:
+    def list_accounts(self, regno: str, session=None) -> list:
         """
         List accounts for a charity
         """
+        if session is None:
+            session = get_session()
         url = self.get_charity_url(regno)
         logging.debug("Fetching account list: {}".format(url))
 
@@ -71,14 +73,17 @@ class CCNI:
     def get_charity_url(self, regno):
         return self.url_base.format(self._get_regno(regno))
 
-    def list_accounts(self, regno: str, session=HTMLSession()) -> list:
+    def list_accounts(self, regno: str, session=None) -> list:
         """
         List accounts for a charity
         """
+        if session is None:
+            session = get_session()
         url = self.get_charity_url(regno)
         logging.debug("Fetching account list: {}".format(url))
 
         r = session.get(url)
+        r.raise_for_status()
         accounts = []
         for link in r.html.find("article#documents a"):
             if not link.attrs["href"].endswith("_CA.pdf"):
@@ -106,14 +111,17 @@ class OSCR:
     def get_charity_url(self, regno):
         return self.url_base.format(self._get_regno(regno))
 
-    def list_accounts(self, regno: str, session=HTMLSession()) -> list:
+    def list_accounts(self, regno: str, session=None) -> list:
         """
         List accounts for a charity
         """
+        if session is None:
+            session = get_session()
         url = self.get_charity_url(regno)
         logging.debug("Fetching account list: {}".format(url))
 
         r = session.get(url)
+        r.raise_for_status()
         accounts = []
         for tr in r.html.find(".history table tr"):
             cells = tr.find("td")
@@ -0,0 +1,46 @@
+"""
+Keep `updated_at` up to date when tags change, so that the documents affected
+are picked up by incremental indexing (see `documents.indexing`).
+"""
+
+from django.db.models.signals import m2m_changed, post_save, pre_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from documents.models import Charity, Document, Tag
+
+
+def touch(queryset):
+    queryset.update(updated_at=timezone.now())
+
+
+def touch_tagged(model):
+    def handler(sender, instance, action, reverse, pk_set, **kwargs):
+        if action not in ("post_add", "post_remove", "pre_clear"):
+            return
+        if pk_set is not None and not pk_set:
+            # nothing was added or removed
+            return
+        if not reverse:
+            touch(model.objects.filter(pk=instance.pk))
+        elif pk_set is None:
+            touch(model.objects.filter(tags=instance))
+        else:
+            touch(model.objects.filter(pk__in=pk_set))
+
+    return handler
+
+
+touch_tagged_documents = touch_tagged(Document)
+touch_tagged_charities = touch_tagged(Charity)
+m2m_changed.connect(touch_tagged_documents, sender=Document.tags.through)
+m2m_changed.connect(touch_tagged_charities, sender=Charity.tags.through)
+
+
+@receiver(post_save, sender=Tag)
+@receiver(pre_delete, sender=Tag)
+def touch_tag(sender, instance, created=False, **kwargs):
+    if created:
+        return
+    touch(Document.objects.filter(tags=instance))
+    touch(Charity.objects.filter(tags=instance))
@@ -0,0 +1,84 @@
+from unittest import mock
+
+import requests
+from django.core.cache import cache
+from django.test import SimpleTestCase, override_settings
+
+from documents.circuitbreaker import CLOSED, OPEN, CircuitBreaker, is_host_failure
+from documents.exceptions import HostUnavailable
+
+LOCMEM_CACHE = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+
+
+class IsHostFailureTestCase(SimpleTestCase):
+    def get_http_error(self, status_code):
+        response = requests.Response()
+        response.status_code = status_code
+        return requests.exceptions.HTTPError(response=response)
+
+    def test_host_failures(self):
+        self.assertTrue(is_host_failure(requests.exceptions.ConnectTimeout()))
+        self.assertTrue(is_host_failure(self.get_http_error(503)))
+        self.assertFalse(is_host_failure(self.get_http_error(404)))
+        self.assertFalse(is_host_failure(ValueError()))
+
+    def test_cause(self):
+        try:
+            try:
+                raise self.get_http_error(429)
+            except Exception as e:
+                raise ValueError("Could not fetch") from e
+        except ValueError as e:
+            self.assertTrue(is_host_failure(e))
+
+
+@override_settings(
+    CACHES=LOCMEM_CACHE,
+    CIRCUIT_BREAKER_FAILURE_THRESHOLD=2,
+    CIRCUIT_BREAKER_BACKOFF=60,
+    CIRCUIT_BREAKER_MAX_BACKOFF=120,
+)
+class CircuitBreakerTestCase(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        self.breaker = CircuitBreaker("test")
+
+    def open_circuit(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+
+    def test_opens_after_failures(self):
+        self.breaker.record_failure()
+        self.breaker.before_request()
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.get_state()["state"], OPEN)
+        with self.assertRaises(HostUnavailable):
+            self.breaker.before_request()
+
+    def test_success_resets_failures(self):
+        self.breaker.record_failure()
+        self.breaker.record_success()
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.get_state()["state"], CLOSED)
+
+    @mock.patch("documents.circuitbreaker.time.time")
+    def test_half_open(self, time):
+        time.return_value = 1000
+        self.open_circuit()
+        time.return_value = 1061
+        self.breaker.before_request()
+        # only one trial request is allowed
+        with self.assertRaises(HostUnavailable):
+            CircuitBreaker("test").before_request()
+        self.breaker.record_success()
+        self.assertEqual(self.breaker.get_state()["state"], CLOSED)
+
+    @mock.patch("documents.circuitbreaker.time.time")
+    def test_backoff_doubles(self, time):
+        time.return_value = 1000
+        self.open_circuit()
+        self.assertEqual(self.breaker.get_state()["retry_at"], 1060)
+        time.return_value = 1061
+        self.breaker.before_request()
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.get_state()["retry_at"], 1181)
@@ -0,0 +1,37 @@
+from django.core.management import CommandError, call_command
+from django.test import SimpleTestCase, override_settings
+
+from documents.management.commands.standardise_storage import (
+    get_new_filename,
+    get_orgid_and_date,
+    is_hashed_filename,
+)
+
+
+class QueueLatestDocumentsTestCase(SimpleTestCase):
+    @override_settings(DOCUMENT_PIPELINE_ENABLED=False)
+    def test_batches_need_pipeline(self):
+        with self.assertRaisesMessage(CommandError, "DOCUMENT_PIPELINE"):
+            call_command("queue_latest_documents", batch_size=2)
+
+    @override_settings(DOCUMENT_PIPELINE_ENABLED=True)
+    def test_batches_without_pause(self):
+        with self.assertRaisesMessage(CommandError, "--pause"):
+            call_command("queue_latest_documents", batch_size=2, pause=15)
+
+
+class StandardiseStorageTestCase(SimpleTestCase):
+    def test_filenames(self):
+        filename = "accounts/pdf/GB-CHC/Ends67/GB-CHC-1234567-2020-03-31.pdf"
+        self.assertEqual(
+            get_orgid_and_date(filename), ("GB-CHC-1234567", "2020-03-31", "pdf")
+        )
+        self.assertEqual(get_new_filename("GB-CHC-1234567", "2020-03-31"), filename)
+        self.assertFalse(is_hashed_filename(filename))
+
+    def test_hashed_filenames(self):
+        filename = "accounts/txt/sha256/ab/{}.txt".format("ab" + "0" * 62)
+        self.assertTrue(is_hashed_filename(filename))
+        # hashed files aren't linked to documents by their name
+        self.assertEqual(get_orgid_and_date(filename), (None, None, None))
+        self.assertFalse(is_hashed_filename(None))
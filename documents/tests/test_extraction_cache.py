@@ -0,0 +1,92 @@
+import io
+import shutil
+import tempfile
+from unittest import mock
+
+from django.test import SimpleTestCase, override_settings
+
+from documents.utils import do_document_ocr, write_text
+
+
+class FakeExtractor:
+    name = "fake"
+    parallel = False
+
+    def __init__(self, pages, version="1.0"):
+        self.pages = pages
+        self.version = version
+        self.calls = 0
+
+    def get_version(self):
+        return self.version
+
+    def iter_pages(self, source, start=0, end=None, pages=None):
+        self.calls += 1
+        yield from self.pages
+
+
+class ExtractionCacheTestCase(SimpleTestCase):
+    def setUp(self):
+        cache_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_root)
+        cache_settings = override_settings(
+            EXTRACTION_CACHE_ENABLED=True,
+            PDF_EXTRACTORS=["fake"],
+            OCRMYPDF_OPTIONS={"language": "eng"},
+            STORAGES={
+                "extraction_cache": {
+                    "BACKEND": "django.core.files.storage.FileSystemStorage",
+                    "OPTIONS": {"location": cache_root},
+                },
+            },
+        )
+        cache_settings.enable()
+        self.addCleanup(cache_settings.disable)
+
+    def use_extractor(self, extractor):
+        patcher = mock.patch("documents.utils.get_extractor", return_value=extractor)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def write_text(self, pdf=b"%PDF-1.4 report"):
+        writer, _ = write_text(io.BytesIO(pdf))
+        self.addCleanup(writer.close)
+        return writer
+
+    def test_text_cached(self):
+        extractor = FakeExtractor(["Trustees' report", "", "Accounts"])
+        self.use_extractor(extractor)
+        writer = self.write_text()
+        cached = self.write_text()
+        self.assertEqual(extractor.calls, 1)
+        self.assertEqual(cached.get_content(), writer.get_content())
+        self.assertEqual(cached.page_offsets, writer.page_offsets)
+
+    def test_text_not_cached_for_other_pdfs(self):
+        extractor = FakeExtractor(["Trustees' report"])
+        self.use_extractor(extractor)
+        self.write_text(b"%PDF-1.4 report")
+        self.write_text(b"%PDF-1.4 another report")
+        self.assertEqual(extractor.calls, 2)
+
+    def test_text_not_cached_for_new_versions(self):
+        self.use_extractor(FakeExtractor(["Old text"]))
+        self.write_text()
+        extractor = FakeExtractor(["New text"], version="2.0")
+        self.use_extractor(extractor)
+        self.assertIn("New text", self.write_text().get_content())
+        self.assertEqual(extractor.calls, 1)
+
+    @mock.patch("documents.utils.ocr_file")
+    def test_ocr_cached(self, ocr_file):
+        ocr_file.side_effect = lambda *args: io.BytesIO(b"%PDF-1.4 OCR")
+        first = do_document_ocr(io.BytesIO(b"%PDF-1.4 scan"), [0])
+        cached = do_document_ocr(io.BytesIO(b"%PDF-1.4 scan"), [0])
+        self.addCleanup(cached.close)
+        self.assertEqual(first.read(), b"%PDF-1.4 OCR")
+        self.assertEqual(cached.read(), b"%PDF-1.4 OCR")
+        ocr_file.assert_called_once()
+
+        # OCRing different pages isn't the same result
+        do_document_ocr(io.BytesIO(b"%PDF-1.4 scan"), [1])
+        self.assertEqual(ocr_file.call_count, 2)
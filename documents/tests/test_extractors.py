@@ -0,0 +1,21 @@
+from django.test import SimpleTestCase, override_settings
+
+from documents.extractors import check_text_quality
+
+
+@override_settings(PDF_EXTRACT_MAX_BAD_CHARACTERS=0.01, PDF_EXTRACT_MAX_LONG_WORDS=0.05)
+class TextQualityTestCase(SimpleTestCase):
+    def test_good_text(self):
+        self.assertIsNone(check_text_quality(["Trustees' annual report", "Page 2"]))
+
+    def test_no_text(self):
+        # documents without text are sent for OCR instead
+        self.assertIsNone(check_text_quality(["", ""]))
+
+    def test_unreadable_characters(self):
+        problem = check_text_quality(["Report ���\x01"])
+        self.assertEqual(problem, "4 unreadable characters")
+
+    def test_missing_spaces(self):
+        problem = check_text_quality(["Thetrusteespresenttheirannualreportforthe year"])
+        self.assertEqual(problem, "1 words without spaces")
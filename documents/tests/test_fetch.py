@@ -0,0 +1,62 @@
+from unittest import mock
+
+from django.test import SimpleTestCase, override_settings
+
+from documents.exceptions import CharityFetchError
+from documents.fetch import download_file
+
+# scenarios to test:
+# - fetch document for financial year
+# - document does/doesn't exist in cc website
+# - document does/doesn't download successfully
+# - document does/doesn't already have text content extracted
+# - document does/doesn't convert successfully (PDF should still be saved)
+# - document does/doesn't save successfully
+
+
+# scenario 1:
+# - PDF exists and already has text content extracted
+# - PDF should be saved successfully
+# - status should be set to SUCCESS
+
+
+# scenario 2:
+# - PDF exists and does not have text content extracted
+# - PDF should be saved successfully
+# - ocr should be run successfully
+# - status should be set to SUCCESS
+
+
+def get_session(chunks):
+    """
+    A session whose responses stream `chunks`
+    """
+    session = mock.MagicMock()
+    response = session.get.return_value.__enter__.return_value
+    response.iter_content.return_value = iter(chunks)
+    return session
+
+
+@override_settings(DOWNLOAD_SPOOL_MAX_MEMORY=10, DOWNLOAD_MAX_SIZE=25)
+class DownloadFileTestCase(SimpleTestCase):
+    def test_download(self):
+        session = get_session([b"%PDF-1.4 ", b"some ", b"bytes"])
+        f = download_file("https://example.com/a.pdf", "a.pdf", session)
+        self.addCleanup(f.close)
+        self.assertEqual(f.name, "a.pdf")
+        self.assertEqual(f.read(), b"%PDF-1.4 some bytes")
+        # larger than DOWNLOAD_SPOOL_MAX_MEMORY, so written to disk
+        self.assertTrue(f.file._rolled)
+        session.get.assert_called_once_with("https://example.com/a.pdf", stream=True)
+
+    def test_too_large(self):
+        session = get_session([b"0123456789"] * 3)
+        with self.assertRaisesMessage(CharityFetchError, "larger than 25 bytes"):
+            download_file("https://example.com/a.pdf", "a.pdf", session)
+
+    def test_http_error(self):
+        session = get_session([])
+        response = session.get.return_value.__enter__.return_value
+        response.raise_for_status.side_effect = ValueError("404 Not Found")
+        with self.assertRaisesMessage(CharityFetchError, "404 Not Found"):
+            download_file("https://example.com/a.pdf", "a.pdf", session)
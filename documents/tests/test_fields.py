@@ -0,0 +1,67 @@
+import os
+import tempfile
+
+import zstandard
+from django.test import SimpleTestCase, override_settings
+
+from documents.fields import (
+    CompressedTextField,
+    compress_text,
+    decompress_text,
+    get_compression_dictionary,
+    get_dictionaries,
+)
+
+
+class CompressedTextTestCase(SimpleTestCase):
+    text = "Trustees' report for the year ended 31 March 2020 " * 20
+
+    @override_settings(CONTENT_COMPRESSION_DICTIONARIES=[])
+    def test_round_trip(self):
+        data = compress_text(self.text)
+        self.assertLess(len(data), len(self.text))
+        self.assertEqual(decompress_text(data), self.text)
+
+    @override_settings(CONTENT_COMPRESSION_DICTIONARIES=[])
+    def test_field(self):
+        field = CompressedTextField()
+        data = field.get_prep_value(self.text)
+        self.assertIsInstance(data, bytes)
+        self.assertEqual(field.from_db_value(data, None, None), self.text)
+        self.assertEqual(field.to_python(memoryview(data)), self.text)
+        self.assertEqual(field.to_python(self.text), self.text)
+        self.assertIsNone(field.from_db_value(None, None, None))
+
+
+class CompressionDictionaryTestCase(SimpleTestCase):
+    text = "Trustees' report for the year ended 31 March 2020 " * 20
+
+    def setUp(self):
+        samples = [
+            "Charity {} trustees' report and accounts for the year ended {}".format(
+                i, 2000 + i % 20
+            ).encode("utf-8")
+            for i in range(1000)
+        ]
+        dictionary = zstandard.train_dictionary(1024, samples)
+        fd, path = tempfile.mkstemp()
+        with os.fdopen(fd, "wb") as f:
+            f.write(dictionary.as_bytes())
+        self.addCleanup(os.unlink, path)
+        self.path = path
+        self.addCleanup(get_dictionaries.cache_clear)
+        self.addCleanup(get_compression_dictionary.cache_clear)
+        get_dictionaries.cache_clear()
+        get_compression_dictionary.cache_clear()
+
+    def test_dictionary(self):
+        with override_settings(CONTENT_COMPRESSION_DICTIONARIES=[]):
+            old_data = compress_text(self.text)
+        # the dictionaries are only loaded once
+        get_compression_dictionary.cache_clear()
+        with override_settings(CONTENT_COMPRESSION_DICTIONARIES=[self.path]):
+            data = compress_text(self.text)
+            self.assertTrue(zstandard.get_frame_parameters(data).dict_id)
+            self.assertEqual(decompress_text(data), self.text)
+            # text compressed before the dictionary was added can still be read
+            self.assertEqual(decompress_text(old_data), self.text)
@@ -0,0 +1,93 @@
+import os
+import tempfile
+from unittest import mock
+
+import requests
+from django.test import SimpleTestCase, override_settings
+from requests import Response
+
+from documents.http import CachingAdapter, HTTPCache, PooledAdapter
+
+URL = "https://example.com/charity/accounts"
+
+
+def get_response(status_code=200, content=b"<html></html>", **headers):
+    response = Response()
+    response.status_code = status_code
+    response._content = content
+    response.headers.update({"Content-Type": "text/html", **headers})
+    return response
+
+
+@override_settings(HTTP_RETRIES=0)
+class CachingAdapterTestCase(SimpleTestCase):
+    def setUp(self):
+        fd, path = tempfile.mkstemp(suffix=".sqlite")
+        os.close(fd)
+        self.addCleanup(os.unlink, path)
+        self.cache = HTTPCache(path, max_size=1000)
+        self.adapter = CachingAdapter(self.cache, {"listing": 60, "document": 0})
+        send = mock.patch.object(PooledAdapter, "send")
+        self.send = send.start()
+        self.addCleanup(send.stop)
+        now = mock.patch("documents.http.time.time", return_value=1000)
+        self.time = now.start()
+        self.addCleanup(now.stop)
+
+    def get(self, url=URL, **kwargs):
+        request = requests.Request("GET", url).prepare()
+        return self.adapter.send(request, **kwargs), request
+
+    def test_cached(self):
+        self.send.return_value = get_response(content=b"listing")
+        response, _ = self.get()
+        self.assertFalse(response.from_cache)
+        response, _ = self.get()
+        self.assertTrue(response.from_cache)
+        self.assertEqual(response.content, b"listing")
+        self.send.assert_called_once()
+
+    def test_documents_not_cached(self):
+        self.send.return_value = get_response(
+            content=b"%PDF", **{"Content-Type": "application/pdf"}
+        )
+        self.get()
+        self.get()
+        self.assertEqual(self.send.call_count, 2)
+        self.assertIsNone(self.cache.get(URL))
+
+    def test_streamed_not_cached(self):
+        self.send.return_value = get_response()
+        self.get(stream=True)
+        self.assertIsNone(self.cache.get(URL))
+
+    def test_expired_revalidated(self):
+        self.send.return_value = get_response(content=b"listing", ETag='"v1"')
+        self.get()
+        self.time.return_value = 1061
+        self.send.return_value = get_response(304, b"")
+        response, request = self.get()
+        self.assertEqual(request.headers["If-None-Match"], '"v1"')
+        self.assertTrue(response.from_cache)
+        self.assertEqual(response.content, b"listing")
+        # revalidating starts the expiry again
+        self.assertEqual(self.cache.get(URL)["expires_at"], 1121)
+
+    def test_expired_replaced(self):
+        self.send.return_value = get_response(content=b"old", ETag='"v1"')
+        self.get()
+        self.time.return_value = 1061
+        self.send.return_value = get_response(content=b"new", ETag='"v2"')
+        response, _ = self.get()
+        self.assertFalse(response.from_cache)
+        self.assertEqual(self.cache.get(URL)["content"], b"new")
+
+    def test_eviction(self):
+        for i in range(3):
+            self.time.return_value = 1000 + i
+            self.send.return_value = get_response(content=b"x" * 400)
+            self.get("{}/{}".format(URL, i))
+        # the least recently used response is removed to keep under max_size
+        self.assertIsNone(self.cache.get(URL + "/0"))
+        self.assertIsNotNone(self.cache.get(URL + "/1"))
+        self.assertIsNotNone(self.cache.get(URL + "/2"))
@@ -0,0 +1,321 @@
+import datetime
+from unittest import mock
+
+from django.core.cache import cache
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+
+from documents.exceptions import SearchIndexError
+from documents.indexing import (
+    flush_index_queue,
+    index_changed_documents,
+    rebuild_index,
+    swap_index_alias,
+)
+from documents.models import (
+    Charity,
+    CharityFinancialYear,
+    Document,
+    IndexCheckpoint,
+    IndexQueueItem,
+    Tag,
+)
+
+LOCMEM_CACHE = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+LONG_AGO = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+class IndexingTestCase(TestCase):
+    def setUp(self):
+        self.charity = Charity.objects.create(
+            org_id="GB-CHC-1234567", name="Test charity"
+        )
+        self.documents = [
+            self.create_document(year, content)
+            for year, content in [
+                (2018, "Trustees' report"),
+                (2019, "Trustees' report"),
+                (2020, None),
+                (2021, "Trustees' report"),
+            ]
+        ]
+        # nothing has changed since the checkpoint
+        for model in (Charity, CharityFinancialYear, Document):
+            model.objects.update(updated_at=LONG_AGO)
+
+    def create_document(self, year, content):
+        financial_year = CharityFinancialYear.objects.create(
+            charity=self.charity, financial_year_end=datetime.date(year, 3, 31)
+        )
+        return Document.objects.create(
+            financial_year=financial_year,
+            content=content,
+            file="accounts/pdf/{}.pdf".format(year),
+        )
+
+    def patch(self, target, **kwargs):
+        patcher = mock.patch(target, **kwargs)
+        self.addCleanup(patcher.stop)
+        return patcher.start()
+
+
+class IndexChangedDocumentsTestCase(IndexingTestCase):
+    def setUp(self):
+        super().setUp()
+        self.index_documents = self.patch(
+            "documents.indexing.index_documents", return_value=(0, [])
+        )
+        self.delete_documents = self.patch(
+            "documents.indexing.delete_documents", return_value=(0, [])
+        )
+        self.checkpoint = IndexCheckpoint.objects.create(
+            name="documents", indexed_until=LONG_AGO + datetime.timedelta(days=1)
+        )
+
+    def get_indexed(self):
+        return sorted(d.id for d in self.index_documents.call_args[0][0])
+
+    def get_deleted(self):
+        return sorted(self.delete_documents.call_args[0][0])
+
+    def test_nothing_changed(self):
+        index_changed_documents()
+        self.assertEqual(self.get_indexed(), [])
+        self.assertEqual(self.get_deleted(), [])
+
+    def test_changed(self):
+        started = timezone.now()
+        Document.objects.filter(id=self.documents[0].id).update(
+            updated_at=timezone.now()
+        )
+        CharityFinancialYear.objects.filter(
+            id=self.documents[1].financial_year_id
+        ).update(updated_at=timezone.now())
+        Document.objects.filter(id=self.documents[2].id).update(
+            updated_at=timezone.now()
+        )
+        index_changed_documents()
+
+        self.assertEqual(
+            self.get_indexed(), [self.documents[0].id, self.documents[1].id]
+        )
+        # changed documents without content are removed from the index
+        self.assertEqual(self.get_deleted(), [self.documents[2].id])
+        self.checkpoint.refresh_from_db()
+        self.assertGreaterEqual(self.checkpoint.indexed_until, started)
+
+    def test_charity_changed(self):
+        Charity.objects.update(updated_at=timezone.now())
+        index_changed_documents()
+        self.assertEqual(
+            self.get_indexed(),
+            [self.documents[0].id, self.documents[1].id, self.documents[3].id],
+        )
+
+    def test_tagged(self):
+        tag = Tag.objects.create(name="Sport")
+        self.documents[3].tags.add(tag)
+        index_changed_documents()
+        self.assertEqual(self.get_indexed(), [self.documents[3].id])
+
+    def test_since(self):
+        index_changed_documents(since=LONG_AGO - datetime.timedelta(days=1))
+        self.assertEqual(len(self.get_indexed()), 3)
+
+    def test_failures_retried(self):
+        Document.objects.filter(id=self.documents[0].id).update(
+            updated_at=timezone.now()
+        )
+        self.index_documents.return_value = (0, [{"_id": self.documents[0].id}])
+        self.assertEqual(index_changed_documents(), (0, 0, 1))
+        # the checkpoint isn't moved on, so the document is tried again
+        self.checkpoint.refresh_from_db()
+        self.assertEqual(
+            self.checkpoint.indexed_until, LONG_AGO + datetime.timedelta(days=1)
+        )
+
+    def test_no_checkpoint(self):
+        self.checkpoint.delete()
+        index_changed_documents()
+        self.assertEqual(len(self.get_indexed()), 3)
+        self.assertTrue(IndexCheckpoint.objects.filter(name="documents").exists())
+
+
+@override_settings(
+    CACHES=LOCMEM_CACHE,
+    INDEX_QUEUE_BATCH_SIZE=2,
+    INDEX_QUEUE_MAX_BATCHES=5,
+    DOCUMENT_PIPELINE_MAX_ATTEMPTS=3,
+)
+class FlushIndexQueueTestCase(IndexingTestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.async_task = self.patch("documents.indexing.async_task")
+        self.schedule_flush = self.patch("documents.indexing.schedule_flush")
+        self.index_queued_documents = self.patch(
+            "documents.indexing.index_queued_documents"
+        )
+        for document in self.documents:
+            IndexQueueItem.objects.create(
+                document=document,
+                queued_at=datetime.datetime(
+                    document.financial_year.financial_year_end.year,
+                    1,
+                    1,
+                    tzinfo=datetime.timezone.utc,
+                ),
+            )
+
+    def test_failed_not_retried_in_same_flush(self):
+        failed_id = self.documents[0].id
+        self.index_queued_documents.side_effect = lambda ids: [
+            {"_id": str(document_id), "status": 400}
+            for document_id in ids
+            if document_id == failed_id
+        ]
+        self.assertEqual(flush_index_queue(), 3)
+        sent = [
+            i for call in self.index_queued_documents.call_args_list for i in call[0][0]
+        ]
+        self.assertEqual(sent.count(failed_id), 1)
+        item = IndexQueueItem.objects.get()
+        self.assertEqual(item.document_id, failed_id)
+        self.assertEqual(item.attempts, 1)
+        self.schedule_flush.assert_called_once()
+
+    def test_batch_error_stops_flush(self):
+        self.index_queued_documents.side_effect = ValueError("Bad document")
+        self.assertEqual(flush_index_queue(), 0)
+        self.index_queued_documents.assert_called_once()
+        self.assertEqual(
+            sorted(IndexQueueItem.objects.values_list("attempts", flat=True)),
+            [0, 0, 1, 1],
+        )
+        self.schedule_flush.assert_called_once()
+
+    def test_dropped_after_max_attempts(self):
+        IndexQueueItem.objects.filter(document=self.documents[0]).update(attempts=2)
+        self.index_queued_documents.side_effect = ValueError("Bad document")
+        flush_index_queue()
+        self.assertFalse(
+            IndexQueueItem.objects.filter(document=self.documents[0]).exists()
+        )
+
+    def test_already_running(self):
+        cache.add("index-queue:flush-running", True)
+        self.assertIsNone(flush_index_queue())
+        self.index_queued_documents.assert_not_called()
+
+
+class SwapIndexAliasTestCase(SimpleTestCase):
+    def setUp(self):
+        patcher = mock.patch("documents.indexing.DocumentDocument._get_connection")
+        self.addCleanup(patcher.stop)
+        self.es = patcher.start().return_value
+
+    def test_alias_moved(self):
+        self.es.indices.exists_alias.return_value = True
+        self.es.indices.get_alias.return_value = {"documents-v1-20200101000000": {}}
+        old = swap_index_alias("documents-v2-20210101000000")
+        self.assertEqual(old, ["documents-v1-20200101000000"])
+        # searches are switched over in one step
+        self.es.indices.update_aliases.assert_called_once_with(
+            actions=[
+                {
+                    "add": {
+                        "index": "documents-v2-20210101000000",
+                        "alias": "documents",
+                    }
+                },
+                {
+                    "remove": {
+                        "index": "documents-v1-20200101000000",
+                        "alias": "documents",
+                    }
+                },
+            ]
+        )
+        self.es.indices.delete.assert_called_once_with(
+            index="documents-v1-20200101000000"
+        )
+
+    def test_keep_old(self):
+        self.es.indices.exists_alias.return_value = True
+        self.es.indices.get_alias.return_value = {"documents-v1-20200101000000": {}}
+        swap_index_alias("documents-v2-20210101000000", delete_old=False)
+        self.es.indices.delete.assert_not_called()
+
+    def test_unversioned_index_replaced(self):
+        self.es.indices.exists_alias.return_value = False
+        self.es.indices.exists.return_value = True
+        self.assertEqual(swap_index_alias("documents-v2-20210101000000"), [])
+        self.es.indices.update_aliases.assert_called_once_with(
+            actions=[
+                {
+                    "add": {
+                        "index": "documents-v2-20210101000000",
+                        "alias": "documents",
+                    }
+                },
+                {"remove_index": {"index": "documents"}},
+            ]
+        )
+
+
+@override_settings(SEARCH_INDEX_REBUILD_MAX_FAILURES=2)
+class RebuildIndexTestCase(SimpleTestCase):
+    def setUp(self):
+        self.es = self.patch(
+            "documents.indexing.DocumentDocument._get_connection"
+        ).return_value
+        self.patch(
+            "documents.indexing.create_versioned_index",
+            return_value="documents-v2-20210101000000",
+        )
+        self.index_documents = self.patch("documents.indexing.index_documents")
+        self.finish_versioned_index = self.patch(
+            "documents.indexing.finish_versioned_index"
+        )
+        self.swap_index_alias = self.patch("documents.indexing.swap_index_alias")
+        self.enqueue_documents = self.patch("documents.indexing.enqueue_documents")
+        self.index_changed_documents = self.patch(
+            "documents.indexing.index_changed_documents"
+        )
+
+    def patch(self, target, **kwargs):
+        patcher = mock.patch(target, **kwargs)
+        self.addCleanup(patcher.stop)
+        return patcher.start()
+
+    def test_rebuilt(self):
+        self.index_documents.return_value = (10, [])
+        self.assertEqual(rebuild_index(), ("documents-v2-20210101000000", 10, 0))
+        self.swap_index_alias.assert_called_once_with(
+            "documents-v2-20210101000000", delete_old=True
+        )
+        self.enqueue_documents.assert_not_called()
+        # documents changed during the rebuild are indexed again
+        self.index_changed_documents.assert_called_once()
+
+    def test_failures_queued(self):
+        self.index_documents.return_value = (8, [{"_id": "3"}, {"_id": "5"}])
+        self.assertEqual(rebuild_index(), ("documents-v2-20210101000000", 8, 2))
+        self.swap_index_alias.assert_called_once()
+        self.enqueue_documents.assert_called_once_with([3, 5])
+
+    def test_too_many_failures(self):
+        self.index_documents.return_value = (
+            7,
+            [{"_id": "3"}, {"_id": "5"}, {"_id": "6"}],
+        )
+        with self.assertRaisesMessage(
+            SearchIndexError, "3 documents could not be indexed"
+        ):
+            rebuild_index()
+        # searches carry on using the old index
+        self.es.indices.delete.assert_called_once_with(
+            index="documents-v2-20210101000000", ignore_unavailable=True
+        )
+        self.swap_index_alias.assert_not_called()
+        self.enqueue_documents.assert_not_called()
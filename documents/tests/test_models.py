@@ -0,0 +1,70 @@
+import datetime
+
+from django.test import TestCase, override_settings
+
+from documents.models import Charity, CharityFinancialYear, Document, DocumentPage
+from documents.utils import PageTextWriter
+
+
+@override_settings(CONTENT_COMPRESSION_DICTIONARIES=[])
+class DocumentPageTestCase(TestCase):
+    pages = ["Trustees' report", "", "Statement of financial activities"]
+
+    def setUp(self):
+        charity = Charity.objects.create(org_id="GB-CHC-1234567", name="Test charity")
+        financial_year = CharityFinancialYear.objects.create(
+            charity=charity, financial_year_end=datetime.date(2020, 3, 31)
+        )
+        writer = PageTextWriter()
+        for text in self.pages:
+            writer.write_page(text)
+        self.addCleanup(writer.close)
+        self.document = Document.objects.create(
+            financial_year=financial_year,
+            content=writer.get_content(),
+            content_length=writer.content_length,
+            pages=writer.pages,
+            page_offsets=writer.page_offsets,
+        )
+
+    def test_pages_stored(self):
+        self.assertEqual(
+            list(
+                DocumentPage.objects.filter(document=self.document)
+                .order_by("page")
+                .values_list("page", "content")
+            ),
+            [(0, self.pages[0]), (2, self.pages[2])],
+        )
+
+    def test_get_page(self):
+        document = Document.objects.get(id=self.document.id)
+        # only the page is loaded, not the whole content
+        with self.assertNumQueries(1):
+            self.assertEqual(document.get_page(2), self.pages[2])
+        with self.assertNumQueries(0):
+            self.assertEqual(document.get_page(1), "")
+        with self.assertRaises(IndexError):
+            document.get_page(3)
+
+    def test_get_page_from_content(self):
+        # documents saved before pages were stored separately
+        DocumentPage.objects.all().delete()
+        document = Document.objects.get(id=self.document.id)
+        self.assertEqual(document.get_page(0), self.pages[0])
+        document = Document.objects.with_content().get(id=self.document.id)
+        with self.assertNumQueries(0):
+            self.assertEqual(document.get_page(2), self.pages[2])
+
+    def test_pages_follow_content(self):
+        document = Document.objects.with_content().get(id=self.document.id)
+        document.content = None
+        document.page_offsets = None
+        document.save()
+        self.assertFalse(DocumentPage.objects.filter(document=document).exists())
+
+    def test_unchanged_content_not_saved_again(self):
+        document = Document.objects.with_content().get(id=self.document.id)
+        DocumentPage.objects.all().delete()
+        document.save()
+        self.assertFalse(DocumentPage.objects.exists())
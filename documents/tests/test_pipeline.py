@@ -0,0 +1,318 @@
+import datetime
+import io
+import shutil
+import tempfile
+from unittest import mock
+
+from django.core.files.base import ContentFile
+from django.test import TestCase, override_settings
+from django_q.models import Schedule
+
+from documents.exceptions import DocumentUploadError, OCRSlotUnavailable
+from documents.fetch import process_fetched_document
+from documents.models import Charity, CharityFinancialYear, Document, DocumentStatus
+from documents.pipeline import (
+    EXTRACT,
+    INDEX,
+    OCR,
+    STAGES,
+    defer_stage,
+    extract_document,
+    ocr_document,
+    queue_stage,
+    run_stage,
+)
+from documents.utils import PageTextWriter
+
+
+class FakeExtractor:
+    name = "fake"
+
+    def get_version(self):
+        return "1.0"
+
+
+class PipelineTestCase(TestCase):
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        storages = override_settings(
+            STORAGES={
+                "default": {
+                    "BACKEND": "django.core.files.storage.FileSystemStorage",
+                    "OPTIONS": {"location": media_root},
+                },
+            }
+        )
+        storages.enable()
+        self.addCleanup(storages.disable)
+
+        charity = Charity.objects.create(org_id="GB-CHC-1234567", name="Test charity")
+        self.financial_year = CharityFinancialYear.objects.create(
+            charity=charity,
+            financial_year_end=datetime.date(2020, 3, 31),
+            status=DocumentStatus.PENDING,
+        )
+        self.document = Document.objects.create(
+            financial_year=self.financial_year,
+            file=ContentFile(b"%PDF-1.4", name="test.pdf"),
+        )
+
+    def patch(self, target, **kwargs):
+        patcher = mock.patch(target, **kwargs)
+        self.addCleanup(patcher.stop)
+        return patcher.start()
+
+    def use_text(self, pages):
+        writer = PageTextWriter()
+        for text in pages:
+            writer.write_page(text)
+        self.addCleanup(writer.close)
+        self.patch(
+            "documents.pipeline.write_text", return_value=(writer, FakeExtractor())
+        )
+        return writer
+
+    def reload(self):
+        self.financial_year.refresh_from_db()
+        return Document.objects.with_content().get(id=self.document.id)
+
+
+@override_settings(DOCUMENT_PIPELINE_ENABLED=False, OCR_RETRY_DELAY=300)
+class OCRDeferralTestCase(PipelineTestCase):
+    def setUp(self):
+        super().setUp()
+        self.patch("documents.pipeline.get_ocr_pages", return_value=[1])
+        self.patch(
+            "documents.pipeline.do_document_ocr",
+            side_effect=OCRSlotUnavailable("No OCR slot free"),
+        )
+        self.defer_stage = self.patch("documents.fetch.defer_stage")
+        self.queue_stage = self.patch("documents.fetch.queue_stage")
+
+    def test_text_kept_when_ocr_busy(self):
+        self.use_text(["Trustees' report", ""])
+        process_fetched_document(self.document, self.financial_year)
+
+        document = self.reload()
+        self.assertIn("Trustees' report", document.content)
+        self.assertEqual(document.pages, 2)
+        self.assertEqual(self.financial_year.status, DocumentStatus.SUCCESS)
+        self.queue_stage.assert_called_once_with(INDEX, self.document)
+        # only the OCR is done later, not the extraction
+        self.defer_stage.assert_called_once_with(
+            OCR,
+            self.document,
+            mock.ANY,
+            pages=[1],
+            page_count=2,
+            extractor="fake",
+        )
+
+    def test_no_text_when_ocr_busy(self):
+        self.use_text(["", ""])
+        process_fetched_document(self.document, self.financial_year)
+
+        document = self.reload()
+        self.assertIsNone(document.content)
+        self.assertTrue(document.file)
+        self.assertEqual(self.financial_year.status, DocumentStatus.PENDING)
+        self.queue_stage.assert_not_called()
+        self.defer_stage.assert_called_once()
+
+    def test_run_stage_deferred(self):
+        defer_stage = self.patch("documents.pipeline.defer_stage")
+        ocr = mock.Mock(side_effect=OCRSlotUnavailable("No OCR slot free"))
+        with mock.patch.dict(STAGES, {OCR: ocr}):
+            run_stage(OCR, self.document.id, attempt=2, pages=[1])
+        # waiting for a slot doesn't use up an attempt
+        defer_stage.assert_called_once_with(
+            OCR, mock.ANY, ocr.side_effect, 2, pages=[1]
+        )
+        self.financial_year.refresh_from_db()
+        self.assertEqual(self.financial_year.status, DocumentStatus.PENDING)
+
+    def test_defer_stage(self):
+        schedule = self.patch("documents.pipeline.schedule")
+        before = datetime.datetime.now(datetime.timezone.utc)
+        defer_stage(OCR, self.document, "No OCR slot free", pages=[1])
+        args, kwargs = schedule.call_args
+        self.assertEqual(args, ("documents.pipeline.run_stage", OCR, self.document.id))
+        self.assertEqual(kwargs["pages"], [1])
+        self.assertEqual(kwargs["attempt"], 1)
+        self.assertEqual(kwargs["schedule_type"], Schedule.ONCE)
+        self.assertIsNone(kwargs["cluster"])
+        delay = (kwargs["next_run"] - before).total_seconds()
+        self.assertGreaterEqual(delay, 300)
+        self.assertLessEqual(delay, 601)
+
+
+@override_settings(OCR_REPLACE_FILE_RATIO=0.5)
+class PipelineStagesTestCase(PipelineTestCase):
+    def setUp(self):
+        super().setUp()
+        self.queue_stage = self.patch("documents.pipeline.queue_stage")
+
+    def test_extract(self):
+        self.use_text(["Trustees' report", "Accounts"])
+        self.patch("documents.pipeline.get_ocr_pages", return_value=[])
+        extract_document(self.document)
+
+        document = self.reload()
+        self.assertIn("Accounts", document.content)
+        self.assertEqual(
+            document.process_type, Document.DocumentProcessType.AS_SUPPLIED
+        )
+        self.assertEqual(self.financial_year.status, DocumentStatus.SUCCESS)
+        self.queue_stage.assert_called_once_with(INDEX, self.document)
+
+    def test_extract_then_ocr(self):
+        self.use_text(["Trustees' report", ""])
+        self.patch("documents.pipeline.get_ocr_pages", return_value=[1])
+        extract_document(self.document)
+
+        # the text there is is saved and indexed while the OCR is waiting
+        self.assertIn("Trustees' report", self.reload().content)
+        self.queue_stage.assert_has_calls(
+            [
+                mock.call(INDEX, self.document),
+                mock.call(
+                    OCR, self.document, pages=[1], page_count=2, extractor="fake"
+                ),
+            ]
+        )
+
+    def test_extract_no_text(self):
+        self.use_text(["", ""])
+        self.patch("documents.pipeline.get_ocr_pages", return_value=[0, 1])
+        extract_document(self.document)
+
+        self.assertIsNone(self.reload().content)
+        self.assertEqual(self.financial_year.status, DocumentStatus.PENDING)
+        self.queue_stage.assert_called_once_with(
+            OCR, self.document, pages=[0, 1], page_count=2, extractor="fake"
+        )
+
+    def test_ocr(self):
+        writer = self.use_text(["Trustees' report", ""])
+        self.patch("documents.pipeline.get_ocr_pages", return_value=[1])
+        extract_document(self.document)
+        self.queue_stage.reset_mock()
+
+        self.patch(
+            "documents.pipeline.do_document_ocr",
+            return_value=io.BytesIO(b"%PDF-1.4 OCR"),
+        )
+        self.patch(
+            "documents.pipeline.extract_text",
+            return_value=(["Statement of financial activities"], FakeExtractor()),
+        )
+        self.patch("documents.pipeline.get_extractor", return_value=FakeExtractor())
+        document = self.reload()
+        ocr_document(document, pages=[1], page_count=writer.pages, extractor="fake")
+
+        document = self.reload()
+        self.assertIn("Trustees' report", document.content)
+        self.assertIn("Statement of financial activities", document.content)
+        self.assertEqual(
+            document.process_type, Document.DocumentProcessType.PARTIAL_OCR
+        )
+        # half of the pages were OCRed, so the OCRed PDF replaces the original
+        with document.file.open("rb") as f:
+            self.assertEqual(f.read(), b"%PDF-1.4 OCR")
+        self.assertEqual(self.financial_year.status, DocumentStatus.SUCCESS)
+        self.queue_stage.assert_called_once_with(INDEX, document)
+
+
+class QueueStageTestCase(PipelineTestCase):
+    @override_settings(DOCUMENT_PIPELINE_ENABLED=True)
+    def test_index_queued(self):
+        enqueue_documents = self.patch("documents.pipeline.enqueue_documents")
+        async_task = self.patch("documents.pipeline.async_task")
+        queue_stage(INDEX, self.document)
+        # documents are indexed in batches rather than by a stage
+        enqueue_documents.assert_called_once_with([self.document.id])
+        async_task.assert_not_called()
+        self.assertNotIn(INDEX, STAGES)
+
+
+@override_settings(DOCUMENT_PIPELINE_MAX_ATTEMPTS=3)
+class RunStageTestCase(PipelineTestCase):
+    def setUp(self):
+        super().setUp()
+        self.queue_stage = self.patch("documents.pipeline.queue_stage")
+
+    def run_failing_stage(self, stage, attempt):
+        failing = mock.Mock(side_effect=ValueError("Broken PDF"))
+        with mock.patch.dict(STAGES, {stage: failing}):
+            with self.assertRaisesMessage(ValueError, "Broken PDF"):
+                run_stage(stage, self.document.id, attempt=attempt, pages=[1])
+        self.financial_year.refresh_from_db()
+
+    def test_retried(self):
+        self.run_failing_stage(EXTRACT, 1)
+        self.queue_stage.assert_called_once_with(
+            EXTRACT, mock.ANY, attempt=2, pages=[1]
+        )
+        self.assertEqual(self.financial_year.status, DocumentStatus.PENDING)
+
+    def test_failed_after_last_attempt(self):
+        self.run_failing_stage(EXTRACT, 3)
+        self.queue_stage.assert_not_called()
+        self.assertEqual(self.financial_year.status, DocumentStatus.FAILED)
+        self.assertEqual(
+            self.financial_year.status_notes,
+            "Stage extract failed after 3 attempts: Broken PDF",
+        )
+
+    def test_ocr_failed_with_text(self):
+        Document.objects.filter(id=self.document.id).update(
+            content="Trustees' report", content_length=16
+        )
+        self.run_failing_stage(OCR, 3)
+        # the text that didn't need OCR is kept
+        self.assertEqual(self.financial_year.status, DocumentStatus.SUCCESS)
+        self.assertEqual(
+            self.financial_year.status_notes, "Pages could not be OCRed: Broken PDF"
+        )
+
+
+class ProcessFetchedDocumentTestCase(PipelineTestCase):
+    def setUp(self):
+        super().setUp()
+        self.queue_stage = self.patch("documents.fetch.queue_stage")
+        self.patch("documents.pipeline.get_ocr_pages", return_value=[])
+
+    @override_settings(DOCUMENT_PIPELINE_ENABLED=False)
+    def test_saved_once_with_text(self):
+        self.use_text(["Trustees' report", "Accounts"])
+        process_fetched_document(self.document, self.financial_year, tags=["x"])
+        document = self.reload()
+        self.assertIn("Accounts", document.content)
+        self.assertEqual(list(document.tags.values_list("slug", flat=True)), ["x"])
+        self.assertEqual(self.financial_year.status, DocumentStatus.SUCCESS)
+        self.queue_stage.assert_called_once_with(INDEX, self.document)
+
+    @override_settings(DOCUMENT_PIPELINE_ENABLED=False)
+    def test_pdf_kept_when_text_fails(self):
+        self.patch(
+            "documents.pipeline.write_text",
+            side_effect=DocumentUploadError("No content found in PDF"),
+        )
+        with self.assertRaises(DocumentUploadError):
+            process_fetched_document(self.document, self.financial_year)
+        document = self.reload()
+        # the PDF doesn't need downloading again to retry
+        self.assertTrue(document.file)
+        self.assertIsNone(document.content)
+        self.assertEqual(self.financial_year.status, DocumentStatus.FAILED)
+        self.assertEqual(self.financial_year.status_notes, "No content found in PDF")
+        self.queue_stage.assert_not_called()
+
+    @override_settings(DOCUMENT_PIPELINE_ENABLED=True)
+    def test_pipeline_pending(self):
+        process_fetched_document(self.document, self.financial_year)
+        # the pipeline's stages mark the financial year as fetched
+        self.financial_year.refresh_from_db()
+        self.assertEqual(self.financial_year.status, DocumentStatus.PENDING)
+        self.queue_stage.assert_called_once_with(EXTRACT, self.document)
@@ -0,0 +1,38 @@
+from unittest import mock
+
+from django.core.cache import cache
+from django.test import SimpleTestCase, override_settings
+
+from documents.ratelimit import SharedTokenBucket, TokenBucket
+
+LOCMEM_CACHE = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+
+
+@mock.patch("documents.ratelimit.time.sleep")
+class TokenBucketTestCase(SimpleTestCase):
+    def test_burst(self, sleep):
+        bucket = TokenBucket(rate=10, capacity=2)
+        waits = [bucket.acquire() for _ in range(3)]
+        self.assertEqual(waits[:2], [0, 0])
+        self.assertAlmostEqual(waits[2], 0.1, places=2)
+        sleep.assert_called_once()
+
+
+@override_settings(CACHES=LOCMEM_CACHE, FETCH_RATE_LIMIT_LOCK_TIMEOUT=1)
+@mock.patch("documents.ratelimit.time.sleep")
+class SharedTokenBucketTestCase(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_burst(self, sleep):
+        bucket = SharedTokenBucket("test", rate=10, capacity=2)
+        waits = [bucket.acquire() for _ in range(4)]
+        self.assertEqual(waits[:2], [0, 0])
+        self.assertAlmostEqual(waits[2], 0.1, places=2)
+        self.assertAlmostEqual(waits[3], 0.2, places=2)
+
+    def test_shared(self, sleep):
+        # separate instances with the same name draw from the same bucket
+        SharedTokenBucket("test", rate=10).acquire()
+        self.assertGreater(SharedTokenBucket("test", rate=10).acquire(), 0)
+        self.assertEqual(SharedTokenBucket("other", rate=10).acquire(), 0)
@@ -0,0 +1,72 @@
+import os
+import tempfile
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from documents import reprocess
+from documents.management.commands.reprocess_documents import Command
+from documents.models import Document
+from documents.pipeline import INDEX
+from documents.reprocess import reprocess_document
+from documents.tests.test_pipeline import PipelineTestCase
+
+
+class ReprocessDocumentTestCase(PipelineTestCase):
+    def setUp(self):
+        super().setUp()
+        self.queue_stage = self.patch("documents.reprocess.queue_stage")
+        self.patch("documents.pipeline.get_ocr_pages", return_value=[])
+
+    def test_reprocess(self):
+        self.use_text(["Trustees' report", "Accounts"])
+        result = reprocess_document(self.document.id)
+        self.assertEqual(result, (self.document.id, 2, len(b"%PDF-1.4"), None))
+        document = self.reload()
+        self.assertIn("Accounts", document.content)
+        self.assertEqual(document.extractor, "fake")
+        self.queue_stage.assert_called_once_with(INDEX, document)
+
+    def test_no_index(self):
+        self.use_text(["Trustees' report"])
+        reprocess_document(self.document.id, index=False)
+        self.queue_stage.assert_not_called()
+
+    def test_failure_returned(self):
+        self.patch("documents.pipeline.write_text", side_effect=ValueError("Broken"))
+        # one failed document doesn't stop the others
+        result = reprocess_document(self.document.id)
+        self.assertEqual(result, (self.document.id, 0, 0, "Broken"))
+        self.assertIsNone(
+            Document.objects.with_content().get(id=self.document.id).content
+        )
+
+
+class ReprocessCheckpointTestCase(SimpleTestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        with os.fdopen(fd, "w") as f:
+            f.write("1\tok\t\n2\tfailed\tBroken PDF\n3\tok\t\n")
+        self.addCleanup(os.unlink, self.path)
+
+    def test_read_checkpoint(self):
+        self.assertEqual(Command().read_checkpoint(self.path), {1, 2, 3})
+
+    def test_retry_failed(self):
+        self.assertEqual(
+            Command().read_checkpoint(self.path, retry_failed=True), {1, 3}
+        )
+
+    def test_no_checkpoint(self):
+        self.assertEqual(Command().read_checkpoint(None), set())
+        self.assertEqual(Command().read_checkpoint(self.path + ".missing"), set())
+
+
+@mock.patch("documents.reprocess.settings")
+class InitWorkerTestCase(SimpleTestCase):
+    def test_read_rate(self, settings):
+        reprocess.init_worker(read_rate=1000)
+        self.addCleanup(setattr, reprocess, "_read_rate_limiter", None)
+        self.assertEqual(reprocess._read_rate_limiter.rate, 1000)
+        self.assertEqual(reprocess._read_rate_limiter.capacity, 5000)
+        self.assertEqual(settings.PDF_EXTRACT_WORKERS, 1)
@@ -0,0 +1,247 @@
+import io
+import shutil
+import tempfile
+from unittest import mock
+
+from django.test import SimpleTestCase, override_settings
+
+from documents.models import Document, parse_page_offsets
+from documents.utils import (
+    PageTextWriter,
+    build_content,
+    extract_text,
+    get_ocr_pages,
+    set_stored_file,
+    write_text,
+)
+
+
+class FakeExtractor:
+    parallel = False
+
+    def __init__(self, name="fake", pages=None, error=None):
+        self.name = name
+        self.pages = pages or []
+        self.error = error
+
+    def get_version(self):
+        return "1.0"
+
+    def iter_pages(self, source, start=0, end=None, pages=None):
+        if self.error:
+            raise self.error
+        if pages is None:
+            pages = range(len(self.pages))[start:end]
+        for page in pages:
+            yield self.pages[page]
+
+
+class PageTextWriterTestCase(SimpleTestCase):
+    pages = ["First page", "", "Página tres – ünïcode", "Last page"]
+
+    def get_writer(self, pages=None):
+        writer = PageTextWriter()
+        for text in self.pages if pages is None else pages:
+            writer.write_page(text)
+        self.addCleanup(writer.close)
+        return writer
+
+    def test_page_offsets(self):
+        writer = self.get_writer()
+        content = writer.get_content()
+        self.assertEqual(writer.pages, 4)
+        self.assertIsNone(writer.page_offsets[1])
+        for text, offsets in zip(self.pages, writer.page_offsets):
+            if text:
+                self.assertEqual(content[offsets[0] : offsets[1]], text)
+        self.assertEqual(writer.content_length, len(content))
+
+    def test_file_offsets(self):
+        # offsets in the file are in bytes, so differ from the page offsets
+        # once there are multi-byte characters
+        writer = self.get_writer()
+        for page, text in enumerate(self.pages):
+            self.assertEqual(writer.read_page(page), text)
+        self.assertNotEqual(writer.file_offsets[3], tuple(writer.page_offsets[3]))
+
+    def test_parse_page_offsets(self):
+        writer = self.get_writer()
+        content = build_content(writer, FakeExtractor())["content"]
+        self.assertEqual(parse_page_offsets(content), writer.page_offsets)
+
+    def test_from_content(self):
+        writer = self.get_writer()
+        copy = PageTextWriter.from_content(writer.get_content(), writer.page_offsets)
+        self.addCleanup(copy.close)
+        self.assertEqual(copy.get_content(), writer.get_content())
+        self.assertEqual(copy.page_offsets, writer.page_offsets)
+        self.assertEqual(copy.file_offsets, writer.file_offsets)
+
+    def test_replace_pages(self):
+        writer = self.get_writer()
+        new_writer = writer.replace_pages({1: "OCR text"})
+        self.addCleanup(new_writer.close)
+        self.assertEqual(new_writer.read_page(1), "OCR text")
+        self.assertEqual(new_writer.read_page(3), "Last page")
+
+    @override_settings(MIN_PAGE_LENGTH=5)
+    def test_sparse_pages(self):
+        writer = self.get_writer(["Some text", "", " abc ", "More text"])
+        self.assertEqual(writer.get_sparse_pages(), [1, 2])
+
+
+class SetStoredFileTestCase(SimpleTestCase):
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        storages = override_settings(
+            STORAGES={
+                "default": {
+                    "BACKEND": "django.core.files.storage.FileSystemStorage",
+                    "OPTIONS": {"location": media_root},
+                },
+            }
+        )
+        storages.enable()
+        self.addCleanup(storages.disable)
+
+    def test_content_addressed_name(self):
+        document = Document()
+        set_stored_file(document, "file_text", io.BytesIO(b"Some text"), "txt")
+        self.assertRegex(
+            document.file_text.name, r"^sha256/[0-9a-f]{2}/[0-9a-f]{64}\.txt$"
+        )
+
+    def test_existing_file_reused(self):
+        document = Document()
+        set_stored_file(document, "file_text", io.BytesIO(b"Some text"), "txt")
+        stored_name = document.file_text.field.generate_filename(
+            document, document.file_text.name
+        )
+        document.file_text.storage.save(stored_name, io.BytesIO(b"Some text"))
+
+        other = Document()
+        set_stored_file(other, "file_text", io.BytesIO(b"Some text"), "txt")
+        self.assertEqual(other.file_text.name, stored_name)
+        self.assertTrue(other.file_text._committed)
+
+
+@override_settings(
+    PDF_EXTRACTORS=["first", "second"],
+    EXTRACTION_CACHE_ENABLED=False,
+    PDF_EXTRACT_MAX_BAD_CHARACTERS=0.01,
+)
+class ExtractorFallbackTestCase(SimpleTestCase):
+    good_pages = ["Report of the trustees", "Statement of financial activities"]
+    bad_pages = ["\ufffd\ufffd\ufffd", "\ufffd\ufffd"]
+
+    def use_extractors(self, *extractors):
+        extractors = {extractor.name: extractor for extractor in extractors}
+        patcher = mock.patch("documents.utils.get_extractor", extractors.__getitem__)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def write_text(self):
+        writer, extractor = write_text(io.BytesIO(b"%PDF"))
+        self.addCleanup(writer.close)
+        return [writer.read_page(page) for page in range(writer.pages)], extractor
+
+    def test_first_used(self):
+        self.use_extractors(
+            FakeExtractor("first", self.good_pages),
+            FakeExtractor("second", error=AssertionError("Shouldn't be used")),
+        )
+        texts, extractor = self.write_text()
+        self.assertEqual(texts, self.good_pages)
+        self.assertEqual(extractor.name, "first")
+
+    def test_error_falls_back(self):
+        self.use_extractors(
+            FakeExtractor("first", error=ValueError("Malformed PDF")),
+            FakeExtractor("second", self.good_pages),
+        )
+        texts, extractor = self.write_text()
+        self.assertEqual(texts, self.good_pages)
+        self.assertEqual(extractor.name, "second")
+
+    def test_quality_falls_back(self):
+        self.use_extractors(
+            FakeExtractor("first", self.bad_pages),
+            FakeExtractor("second", self.good_pages),
+        )
+        texts, extractor = self.write_text()
+        self.assertEqual(extractor.name, "second")
+
+    def test_last_error_uses_earlier_text(self):
+        self.use_extractors(
+            FakeExtractor("first", self.bad_pages),
+            FakeExtractor("second", error=ValueError("Malformed PDF")),
+        )
+        texts, extractor = self.write_text()
+        self.assertEqual(texts, self.bad_pages)
+        self.assertEqual(extractor.name, "first")
+
+    def test_all_errors_raised(self):
+        self.use_extractors(
+            FakeExtractor("first", error=ValueError("Malformed PDF")),
+            FakeExtractor("second", error=ValueError("Still malformed")),
+        )
+        with self.assertRaisesMessage(ValueError, "Still malformed"):
+            write_text(io.BytesIO(b"%PDF"))
+
+    def test_extract_text_falls_back(self):
+        self.use_extractors(
+            FakeExtractor("first", error=ValueError("Malformed PDF")),
+            FakeExtractor("second", self.good_pages),
+        )
+        texts, extractor = extract_text(io.BytesIO(b"%PDF"), [1])
+        self.assertEqual(texts, self.good_pages[1:])
+        self.assertEqual(extractor.name, "second")
+
+    def test_extract_text_opens_pdf_once(self):
+        extractor = FakeExtractor("first", self.good_pages * 3)
+        self.use_extractors(extractor, FakeExtractor("second"))
+        with mock.patch.object(
+            extractor, "iter_pages", wraps=extractor.iter_pages
+        ) as iter_pages:
+            texts, _ = extract_text(io.BytesIO(b"%PDF"), [4, 1, 2])
+        iter_pages.assert_called_once()
+        self.assertEqual(
+            texts, [self.good_pages[0], self.good_pages[1], self.good_pages[0]]
+        )
+
+
+@override_settings(MIN_PAGE_LENGTH=10, MIN_DOC_LENGTH=100, OCR_MIN_PAGE_RATIO=0.2)
+@mock.patch("documents.utils.get_image_pages")
+class GetOCRPagesTestCase(SimpleTestCase):
+    def get_writer(self, pages):
+        writer = PageTextWriter()
+        for text in pages:
+            writer.write_page(text)
+        self.addCleanup(writer.close)
+        return writer
+
+    def test_short_document(self, get_image_pages):
+        # a document with little text is probably scanned, so every page
+        # without enough text is OCRed
+        writer = self.get_writer(["", "Short text page", "", ""])
+        self.assertEqual(get_ocr_pages(None, writer), [0, 2, 3])
+        get_image_pages.assert_not_called()
+
+    def test_only_pages_with_images(self, get_image_pages):
+        get_image_pages.return_value = [1, 3]
+        writer = self.get_writer(["Some text " * 10, "", "", "", "More text here"])
+        self.assertEqual(get_ocr_pages(None, writer), [1, 3])
+        get_image_pages.assert_called_once_with(None, [1, 2, 3])
+
+    def test_too_few_pages(self, get_image_pages):
+        get_image_pages.return_value = [1]
+        writer = self.get_writer(
+            ["Some text " * 10, "", "More text"] + ["Text" * 5] * 7
+        )
+        self.assertEqual(get_ocr_pages(None, writer), [])
+
+    def test_no_sparse_pages(self, get_image_pages):
+        writer = self.get_writer(["Some text " * 10, "More text here"])
+        self.assertEqual(get_ocr_pages(None, writer), [])
+        get_image_pages.assert_not_called()
@@ -1,44 +1,424 @@
+import collections
 import datetime
-import io
+import hashlib
 import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
-import ocrmypdf
-import pdfplumber
 from django.conf import settings
+from django.core.files.base import File
 
+from documents import extraction_cache
 from documents.exceptions import DocumentUploadError
+from documents.extractors import (
+    TextQuality,
+    check_text_quality,
+    get_extractor,
+    get_image_pages,
+)
+from documents.ocr import ocr_file
 
 
-def convert_file(source):
-    with pdfplumber.open(source) as pdf:
-        content = "\n\n".join(
-            [
-                "<span id='page-{}'></span>\n{}".format(i, p.extract_text())
-                for i, p in enumerate(pdf.pages)
-                if p.extract_text()
-            ]
+def get_file_hash(source, chunk_size=1024 * 1024):
+    """
+    Get the SHA-256 hash of a file (or the file at a path), reading it in chunks.
+    """
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, "rb") as f:
+            return get_file_hash(f, chunk_size)
+    file_hash = hashlib.sha256()
+    source.seek(0)
+    for chunk in iter(lambda: source.read(chunk_size), b""):
+        file_hash.update(chunk)
+    source.seek(0)
+    return file_hash.hexdigest()
+
+
+def set_stored_file(instance, field_name, content, extension, file_hash=None):
+    """
+    Set a file field to `content`, stored under a name made from the SHA-256
+    hash of the file.
+
+    Documents made from the same PDF share its stored files (see
+    `documents.fetch.copy_document_content`), so stored files are never
+    overwritten with something different. If a file with the same hash is
+    already stored it is used rather than uploaded again.
+    """
+    file_hash = file_hash or get_file_hash(content)
+    name = "sha256/{}/{}.{}".format(file_hash[:2], file_hash, extension)
+    field = instance._meta.get_field(field_name)
+    stored_name = field.generate_filename(instance, name)
+    if field.storage.exists(stored_name):
+        setattr(instance, field_name, stored_name)
+    else:
+        if isinstance(content, File):
+            content = content.file
+        setattr(instance, field_name, File(content, name=name))
+
+
+def extract_page_text(extractor_name, path, start, end):
+    """
+    Get the text of pages `start` to `end` of a PDF, extracting each page once.
+
+    Run in the extraction process pool, so it only opens the PDF by its path.
+    """
+    return list(get_extractor(extractor_name).iter_pages(path, start, end))
+
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+
+def get_extract_executor():
+    """
+    Get the process pool for extracting text, which lasts as long as the worker.
+
+    Processes are started with "spawn" as the worker may have other threads
+    running (see `documents.engine`).
+    """
+    global _executor, _executor_pid
+    with _executor_lock:
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ProcessPoolExecutor(
+                max_workers=settings.PDF_EXTRACT_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+                max_tasks_per_child=settings.PDF_EXTRACT_MAX_TASKS_PER_CHILD,
+            )
+            _executor_pid = os.getpid()
+        return _executor
+
+
+def reset_extract_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+def use_extract_executor(extractor, pages):
+    # daemonic processes (eg django_q workers with `daemonize_workers`
+    # set) can't start child processes
+    return (
+        extractor.parallel
+        and settings.PDF_EXTRACT_WORKERS > 1
+        and pages >= settings.PDF_EXTRACT_PARALLEL_MIN_PAGES
+        and not multiprocessing.current_process().daemon
+    )
+
+
+def iter_pages_parallel(extractor, source, pages):
+    """
+    Yield the text of each page of a PDF, spreading the pages across the
+    extraction process pool.
+    """
+    # the processes need the PDF as a file on disk
+    if isinstance(source, (str, os.PathLike)):
+        path = source
+    else:
+        with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as f:
+            source.seek(0)
+            shutil.copyfileobj(source, f)
+            path = f.name
+
+    try:
+        executor = get_extract_executor()
+        futures = collections.deque(
+            executor.submit(
+                extract_page_text,
+                extractor.name,
+                path,
+                start,
+                min(start + settings.PDF_EXTRACT_PAGES_PER_TASK, pages),
+            )
+            for start in range(0, pages, settings.PDF_EXTRACT_PAGES_PER_TASK)
         )
-        if not content:
-            raise DocumentUploadError("No content found in PDF")
-        return {
-            "content": content,
-            "content_length": len(content),
-            "pages": len(pdf.pages),
-            "content_type": "application/pdf",
-            "language": "en",
-            "date": datetime.datetime.now(),
-        }
-
-
-def do_document_ocr(file):
+        # drop each range of pages once it has been used
+        while futures:
+            yield from futures.popleft().result()
+    finally:
+        if path is not source:
+            os.unlink(path)
+
+
+def iter_pages(source, extractor):
+    """
+    Yield the text of each page of a PDF.
+
+    Each page is only extracted once. Longer documents are split into ranges
+    of pages which are extracted in separate processes.
+    """
+    if not extractor.parallel:
+        yield from extractor.iter_pages(source)
+        return
+    pages = extractor.page_count(source)
+    if not use_extract_executor(extractor, pages):
+        yield from extractor.iter_pages(source)
+        return
+
+    done = 0
     try:
-        buffer = io.BytesIO()
-        ocrmypdf.ocr(file, buffer, **settings.OCRMYPDF_OPTIONS)
-        logging.info("OCRing PDF")
-        return buffer.getvalue()
-    except ocrmypdf.exceptions.PriorOcrFoundError:
-        logging.info("PDF already OCR'd")
-        return None
-    except ocrmypdf.exceptions.EncryptedPdfError:
-        logging.info("PDF is encrypted")
-        raise
+        for text in iter_pages_parallel(extractor, source, pages):
+            done += 1
+            yield text
+    except BrokenProcessPool as e:
+        logging.warning("Text extraction process pool failed: {}".format(e))
+        reset_extract_executor()
+        yield from extractor.iter_pages(source, done)
+
+
+class PageTextWriter:
+    """
+    Write the text of each page of a PDF to a temporary file as it is
+    extracted, so that the whole text is never held in memory.
+
+    The file has the same format as `Document.content`, and can be used as
+    the document's `file_text`.
+    """
+
+    separator = "\n\n"
+
+    def __init__(self):
+        self.file = tempfile.SpooledTemporaryFile(
+            max_size=settings.TEXT_SPOOL_MAX_MEMORY
+        )
+        self.content_length = 0
+        # number of characters on each page, ignoring surrounding whitespace
+        self.page_lengths = []
+        # start and end of the text of each page in the file (in bytes) and in
+        # the content (in characters), or None for pages without text
+        self.file_offsets = []
+        self.page_offsets = []
+
+    @classmethod
+    def from_content(cls, content, page_offsets):
+        """
+        Create a writer with the text of a document that has already been
+        extracted, using the start and end of each page in the content.
+        """
+        writer = cls()
+        for offsets in page_offsets:
+            writer.write_page(content[offsets[0] : offsets[1]] if offsets else "")
+        return writer
+
+    @property
+    def pages(self):
+        return len(self.page_lengths)
+
+    def write_page(self, text):
+        file_offsets = None
+        page_offsets = None
+        if text:
+            header = "<span id='page-{}'></span>\n".format(self.pages)
+            if self.content_length:
+                header = self.separator + header
+            self.file.write(header.encode("utf-8"))
+            start = self.file.tell()
+            self.file.write(text.encode("utf-8"))
+            file_offsets = (start, self.file.tell())
+            start = self.content_length + len(header)
+            page_offsets = [start, start + len(text)]
+            self.content_length += len(header) + len(text)
+        self.file_offsets.append(file_offsets)
+        self.page_offsets.append(page_offsets)
+        self.page_lengths.append(len(text.strip()))
+
+    def read_page(self, page):
+        if self.file_offsets[page] is None:
+            return ""
+        start, end = self.file_offsets[page]
+        position = self.file.tell()
+        self.file.seek(start)
+        text = self.file.read(end - start).decode("utf-8")
+        self.file.seek(position)
+        return text
+
+    def get_sparse_pages(self):
+        """
+        Find the pages with little or no text, which probably need OCR
+        """
+        return [
+            page
+            for page, length in enumerate(self.page_lengths)
+            if length < settings.MIN_PAGE_LENGTH
+        ]
+
+    def replace_pages(self, texts):
+        """
+        Create a new writer with the text of some pages replaced.
+
+        `texts` is a dictionary of page number to the new text of the page.
+        """
+        writer = PageTextWriter()
+        for page in range(self.pages):
+            writer.write_page(texts[page] if page in texts else self.read_page(page))
+        return writer
+
+    def get_content(self):
+        self.file.seek(0)
+        content = self.file.read().decode("utf-8")
+        self.file.seek(0)
+        return content
+
+    def close(self):
+        self.file.close()
+
+
+def get_ocr_pages(source, writer):
+    """
+    Choose the pages of a PDF to OCR, from the text written to `writer`.
+
+    If the document has less than `settings.MIN_DOC_LENGTH` characters of
+    text, all the pages with little or no text are OCRed. Otherwise only
+    those pages with an image on are OCRed (most reports have a few pages
+    that are blank or just a photo), and only if there are enough of them
+    (`settings.OCR_MIN_PAGE_RATIO` of the pages) to be worth it.
+    """
+    pages = writer.get_sparse_pages()
+    if not pages or writer.content_length < settings.MIN_DOC_LENGTH:
+        return pages
+    pages = get_image_pages(source, pages)
+    if len(pages) < writer.pages * settings.OCR_MIN_PAGE_RATIO:
+        return []
+    return pages
+
+
+def write_text(source):
+    """
+    Write the text of each page of a PDF to a `PageTextWriter`, using the
+    first of `settings.PDF_EXTRACTORS` that gives text that passes the
+    quality checks. If an extractor can't read the PDF the next one is tried.
+
+    If `settings.EXTRACTION_CACHE_ENABLED` is set then text that has already
+    been extracted from the same PDF by the same extractor is reused.
+
+    Returns the writer and the extractor used (the last one that could read
+    the PDF, if none of them gave text that passed the quality checks).
+    """
+    file_hash = None
+    if settings.EXTRACTION_CACHE_ENABLED:
+        file_hash = get_file_hash(source)
+
+    result = None
+    for extractor_name in settings.PDF_EXTRACTORS:
+        extractor = get_extractor(extractor_name)
+        writer = PageTextWriter()
+        try:
+            found, problem = False, None
+            if file_hash:
+                found, problem = extraction_cache.load_text(
+                    file_hash, extractor, writer
+                )
+            if not found:
+                quality = TextQuality()
+                for text in iter_pages(source, extractor):
+                    quality.add(text)
+                    writer.write_page(text)
+                problem = quality.get_problem()
+                if file_hash:
+                    extraction_cache.save_text(file_hash, extractor, writer, problem)
+        except Exception as e:
+            writer.close()
+            if result is None and extractor_name == settings.PDF_EXTRACTORS[-1]:
+                raise
+            logging.warning("Could not get text with {}: {}".format(extractor.name, e))
+            continue
+        if result:
+            result[0].close()
+        result = writer, extractor
+        if not problem:
+            break
+        logging.info(
+            "Text from {} failed quality checks ({})".format(extractor.name, problem)
+        )
+    return result
+
+
+def extract_text(source, pages):
+    """
+    Get the text of some pages of a PDF, using the first of
+    `settings.PDF_EXTRACTORS` that gives text that passes the quality checks.
+    If an extractor can't read the PDF the next one is tried.
+
+    Returns the text of each page and the extractor used.
+    """
+    result = None
+    for extractor_name in settings.PDF_EXTRACTORS:
+        extractor = get_extractor(extractor_name)
+        try:
+            # the PDF is only opened once, however many pages there are
+            texts = list(extractor.iter_pages(source, pages=pages))
+        except Exception as e:
+            if result is None and extractor_name == settings.PDF_EXTRACTORS[-1]:
+                raise
+            logging.warning("Could not get text with {}: {}".format(extractor.name, e))
+            continue
+        result = texts, extractor
+        problem = check_text_quality(texts)
+        if not problem:
+            break
+        logging.info(
+            "Text from {} failed quality checks ({})".format(extractor.name, problem)
+        )
+    return result
+
+
+def build_content(writer, extractor):
+    """
+    Get the details of a document from the text written by a `PageTextWriter`.
+
+    The writer's file is used for `file_text`, so it shouldn't be closed
+    until the document has been saved.
+    """
+    if not writer.content_length:
+        raise DocumentUploadError("No content found in PDF")
+    return {
+        "content": writer.get_content(),
+        "file_text": writer.file,
+        "content_length": writer.content_length,
+        "pages": writer.pages,
+        "page_offsets": writer.page_offsets,
+        "content_type": "application/pdf",
+        "language": "en",
+        "extractor": extractor.name,
+        "extractor_version": extractor.get_version(),
+        "date": datetime.datetime.now(),
+    }
+
+
+def convert_file(source):
+    return build_content(*write_text(source))
+
+
+def do_document_ocr(file, pages=None):
+    """
+    OCR a PDF, returning the new PDF as an open file (see `documents.ocr`).
+
+    If `settings.EXTRACTION_CACHE_ENABLED` is set then a PDF that has already
+    been OCRed with the same options isn't OCRed again.
+
+    If `pages` (numbered from 0) is given then only those pages are OCRed,
+    replacing any text they already have.
+    """
+    options = dict(settings.OCRMYPDF_OPTIONS)
+    if pages is not None:
+        options["pages"] = ",".join(str(page + 1) for page in pages)
+        options["force_ocr"] = True
+
+    if not settings.EXTRACTION_CACHE_ENABLED:
+        return ocr_file(file, options)
+
+    file_hash = get_file_hash(file)
+    cached = extraction_cache.load_ocr(file_hash, options)
+    if cached:
+        return cached
+    new_file = ocr_file(file, options)
+    if new_file:
+        extraction_cache.save_ocr(file_hash, options, new_file)
+    return new_file
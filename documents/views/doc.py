@@ -35,7 +35,7 @@ def doc_get(request, id):
 @login_required
 @xframe_options_sameorigin
 def doc_get_embed(request, id):
-    doc = get_doc(id)
+    doc = get_doc(id, with_content=True)
     doc_highlight = get_doc_highlight(id, request.GET.get("q"))
     return render(
         request,
@@ -48,6 +48,26 @@ def doc_get_embed(request, id):
     )
 
 
+@login_required
+@xframe_options_sameorigin
+def doc_get_page_embed(request, id, page):
+    # only the page is loaded, not the whole content
+    doc = get_doc(id)
+    try:
+        text = doc.get_page(page)
+    except IndexError:
+        raise Http404(f"Page {page} not found")
+    return render(
+        request,
+        "doc_display_embed.html.j2",
+        {
+            "content": markupsafe.Markup("<span id='page-{}'></span>\n{}").format(
+                page, text
+            ),
+        },
+    )
+
+
 @login_required
 @xframe_options_sameorigin
 def doc_get_pdf(request, id):
@@ -57,16 +77,17 @@ def doc_get_pdf(request, id):
     raise Http404("No PDF available")
 
 
-def get_doc(id):
+def get_doc(id, with_content=False):
+    documents = Document.objects.with_content() if with_content else Document.objects
     match = REGNO_REGEX.match(id)
     if match:
         return get_object_or_404(
-            Document,
+            documents,
             financial_year__charity__org_id=match.group("regno"),
             financial_year__financial_year_end=match.group("fyend"),
         )
     elif id.isdigit():
-        return get_object_or_404(Document, id=int(id))
+        return get_object_or_404(documents, id=int(id))
 
     raise Http404(f"Document '{id}' not found")
 
@@ -82,6 +103,7 @@ def get_doc_highlight(id, q=None):
     if q:
         s = s.highlight(
             "attachment.content",
+            type="unified",
             fragment_size=150,
             number_of_fragments=0,
             pre_tags=[f'<em class="bg-yellow b highlight" {highlight_class}>'],
@@ -27,6 +27,7 @@ def document_search(q=None, tags=None, highlight=True):
         if highlight:
             s = s.highlight(
                 "attachment.content",
+                type="unified",
                 fragment_size=150,
                 number_of_fragments=3,
                 pre_tags=['<em class="bg-yellow b highlight">'],
@@ -1 +1,5 @@
-python ./manage.py logcommand "queue_latest_documents -n 10000 -p 15"
\ No newline at end of file
+case "$DOCUMENT_PIPELINE" in
+    [tT]*) python ./manage.py logcommand "queue_latest_documents -n 10000 -g -b 3 -c 2" ;;
+    *) python ./manage.py logcommand "queue_latest_documents -n 10000" ;;
+esac
+python ./manage.py logcommand "index_documents --changed"